@@ -0,0 +1,414 @@
+"""Dense slim models built from masked ones, keeping only the unpruned filters."""
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import models.imagenet_resnet as imagenet_resnet
+import models.imagenet_resnet_small as imagenet_resnet_small
+import models.vgg as imagenet_vgg
+import models.vgg_cifar10 as vgg_cifar10
+from models.resnet import CifarResNet, ResNetBasicblock
+from models.resnet_small import CifarResNet as SmallCifarResNet, ResNetBasicblock as SmallBasicblock, conv_residue
+
+
+def unwrap(model):
+    """The model inside a DataParallel wrapper, or ``model`` itself."""
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def bn_constant(bn):
+    """Eval-mode output of ``bn`` for all-zero input channels, per channel."""
+    return bn.bias.data - bn.weight.data * bn.running_mean / torch.sqrt(bn.running_var + bn.eps)
+
+
+def split_filters(conv, pruned):
+    """(kept, pruned) filter indices of ``conv`` as sorted LongTensors on its device."""
+    keep = torch.ones(conv.out_channels, dtype=torch.bool, device=conv.weight.device)
+    pruned = [int(i) for i in pruned]
+    if pruned:
+        keep[torch.tensor(pruned, dtype=torch.long, device=keep.device)] = False
+    return torch.nonzero(keep).view(-1), torch.nonzero(~keep).view(-1)
+
+
+def conv_filters(model, pruned_index):
+    """Map every Conv2d of ``model`` to its (kept, pruned) filters, from ``Mask.pruned_index``."""
+    param_index = {id(param): index for index, param in enumerate(model.parameters())}
+    return {module: split_filters(module, pruned_index.get(param_index[id(module.weight)], []))
+            for module in model.modules() if isinstance(module, nn.Conv2d)}
+
+
+def pruned_constant(bn, kept):
+    """``bn_constant`` at the pruned channels, 0 at the ``kept`` ones."""
+    value = bn_constant(bn).clone()
+    value[kept] = 0
+    return value
+
+
+def copy_bn(small_bn, bn, kept):
+    small_bn.weight.data.copy_(bn.weight.data[kept])
+    small_bn.bias.data.copy_(bn.bias.data[kept])
+    small_bn.running_mean.copy_(bn.running_mean[kept])
+    small_bn.running_var.copy_(bn.running_var[kept])
+    if getattr(bn, 'num_batches_tracked', None) is not None:
+        small_bn.num_batches_tracked.copy_(bn.num_batches_tracked)
+
+
+def cifar_blocks(model):
+    """Blocks of a (slim) CifarResNet, in model order."""
+    return [block for stage in (model.stage_1, model.stage_2, model.stage_3) for block in stage]
+
+
+def dead_channels(width, live):
+    """Sorted indices of the ``width`` channels that are not in ``live``."""
+    dead = torch.ones(width, dtype=torch.bool, device=live.device)
+    dead[live] = False
+    return torch.nonzero(dead).view(-1)
+
+
+def cifar_stream(model, filters):
+    """Live channels of the residual stream of a masked CifarResNet after the stem and every block,
+    in the stream order of the slim model, and the constant values of all the channels (0 at the live
+    ones). ``filters`` is ``conv_filters(model, ...)``."""
+    device = model.conv_1_3x3.weight.device
+    live = [filters[model.conv_1_3x3][0]]
+    constant = [pruned_constant(model.bn_1, live[0]).clamp(min=0)]
+    for block in cifar_blocks(model):
+        # conv_b writes the first channels of the stream, the other live ones keep their order
+        kept_b = filters[block.conv_b][0]
+        width = block.conv_b.out_channels
+        written = torch.zeros(width, dtype=torch.bool, device=device)
+        written[kept_b] = True
+        live.append(torch.cat([kept_b, live[-1][~written[live[-1]]]]))
+        value = F.pad(constant[-1], (0, width - constant[-1].numel())) + pruned_constant(block.bn_b, kept_b)
+        value[live[-1]] = 0
+        constant.append(value.clamp(min=0))
+    return live, constant
+
+
+def compact_cifar_resnet(model, pruned_index):
+    """Dense ``models.resnet_small.CifarResNet`` holding only the unpruned filters of a masked CifarResNet;
+    it keeps the BN channels of the pruned filters, so it also trains like the masked model."""
+    model = unwrap(model)
+    assert isinstance(model, CifarResNet), 'expected a models.resnet.CifarResNet'
+    filters = conv_filters(model, pruned_index)
+    blocks = cifar_blocks(model)
+    convs = [model.conv_1_3x3] + [conv for block in blocks for conv in (block.conv_a, block.conv_b)]
+    device = model.conv_1_3x3.weight.device
+    live = cifar_stream(model, filters)[0]
+
+    plain = [torch.equal(stream_in, stream_out) for stream_in, stream_out in zip(live[:-1], live[1:])]
+    small = SmallCifarResNet(SmallBasicblock, 2 + 6 * len(model.stage_1), model.num_classes,
+                             [filters[conv][0].numel() for conv in convs], [stream.numel() for stream in live[1:]],
+                             plain)
+    small = small.to(device)
+    small_blocks = cifar_blocks(small)
+
+    with torch.no_grad():
+        kept, pruned = filters[model.conv_1_3x3]
+        small.conv_1_3x3.weight.copy_(model.conv_1_3x3.weight[kept])
+        copy_bn(small.bn_1, model.bn_1, kept)
+        if pruned.numel() > 0:
+            copy_bn(small.bn_1_pruned, model.bn_1, pruned)
+            small.stem_pruned.copy_(pruned)
+
+        for k, (small_block, block) in enumerate(zip(small_blocks, blocks)):
+            kept_a, pruned_a = filters[block.conv_a]
+            kept_b, pruned_b = filters[block.conv_b]
+            stream_in, stream_out = live[k], live[k + 1]
+            dead_in = dead_channels(block.conv_a.in_channels, stream_in)
+
+            small_block.conv_a.weight.copy_(block.conv_a.weight[kept_a][:, stream_in])
+            small_block.residue_a_weight.copy_(block.conv_a.weight[kept_a][:, dead_in])
+            small_block.dead_in.copy_(dead_in)
+            copy_bn(small_block.bn_a, block.bn_a, kept_a)
+            small_block.conv_b.weight.copy_(block.conv_b.weight[kept_b][:, kept_a])
+            small_block.residue_b_weight.copy_(block.conv_b.weight[kept_b][:, pruned_a])
+            copy_bn(small_block.bn_b, block.bn_b, kept_b)
+            if pruned_a.numel() > 0:
+                copy_bn(small_block.bn_a_pruned, block.bn_a, pruned_a)
+            if pruned_b.numel() > 0:
+                copy_bn(small_block.bn_b_pruned, block.bn_b, pruned_b)
+                small_block.pruned_b.copy_(pruned_b)
+
+            # positions of the residual in the output stream, and the channels taking the constants
+            if not plain[k]:
+                position = torch.full((block.conv_b.out_channels,), -1, dtype=torch.long, device=device)
+                position[stream_out] = torch.arange(stream_out.numel(), device=device)
+                small_block.res_index.copy_(position[stream_in])
+            small_block.stream_out.copy_(stream_out)
+
+        # the average pool keeps the constant channels constant, so the classifier reads them separately
+        dead = dead_channels(model.classifier.in_features, live[-1])
+        weight = model.classifier.weight
+        small.classifier.weight.copy_(weight[:, live[-1]])
+        small.classifier.bias.copy_(model.classifier.bias)
+        small.classifier_residue.copy_(weight[:, dead])
+        small.dead_out.copy_(dead)
+    return small.train(model.training)
+
+
+def cifar_resnet_slices(model, pruned_index):
+    """(parameter name, rows, columns) of the parameter of a masked CifarResNet that every parameter of
+    its slim model is cut from, by slim parameter name; None keeps the whole dim."""
+    model = unwrap(model)
+    filters = conv_filters(model, pruned_index)
+    live = cifar_stream(model, filters)[0]
+    slices = OrderedDict()
+
+    def add_bn(name, source, rows, optional=False):
+        # the slim model only has BN channels for pruned filters when there are some
+        if rows.numel() > 0 or not optional:
+            for param in ('weight', 'bias'):
+                slices['{}.{}'.format(name, param)] = ('{}.{}'.format(source, param), rows, None)
+
+    kept, pruned = filters[model.conv_1_3x3]
+    slices['conv_1_3x3.weight'] = ('conv_1_3x3.weight', kept, None)
+    add_bn('bn_1', 'bn_1', kept)
+    add_bn('bn_1_pruned', 'bn_1', pruned, optional=True)
+    for name, module in model.named_modules():
+        if isinstance(module, ResNetBasicblock):
+            stream_in = live[cifar_blocks(model).index(module)]
+            (kept_a, pruned_a), (kept_b, pruned_b) = filters[module.conv_a], filters[module.conv_b]
+            conv_a, conv_b = name + '.conv_a.weight', name + '.conv_b.weight'
+            slices[conv_a] = (conv_a, kept_a, stream_in)
+            slices[name + '.residue_a_weight'] = (conv_a, kept_a, dead_channels(module.conv_a.in_channels, stream_in))
+            add_bn(name + '.bn_a', name + '.bn_a', kept_a)
+            add_bn(name + '.bn_a_pruned', name + '.bn_a', pruned_a, optional=True)
+            slices[conv_b] = (conv_b, kept_b, kept_a)
+            slices[name + '.residue_b_weight'] = (conv_b, kept_b, pruned_a)
+            add_bn(name + '.bn_b', name + '.bn_b', kept_b)
+            add_bn(name + '.bn_b_pruned', name + '.bn_b', pruned_b, optional=True)
+    slices['classifier.weight'] = ('classifier.weight', None, live[-1])
+    slices['classifier.bias'] = ('classifier.bias', None, None)
+    dead = dead_channels(model.classifier.in_features, live[-1])
+    slices['classifier_residue'] = ('classifier.weight', None, dead)
+    return slices
+
+
+def channel_map(model, pruned_index):
+    """Original indices of the filters every conv of the slim model keeps, by module name, and of the
+    residual stream channels after every block of a CifarResNet, in slim order, by block name."""
+    model = unwrap(model)
+    filters = conv_filters(model, pruned_index)
+    channels = OrderedDict((name, filters[module][0].tolist()) for name, module in model.named_modules()
+                           if isinstance(module, nn.Conv2d))
+    if isinstance(model, CifarResNet):
+        live = cifar_stream(model, filters)[0]
+        names = [name for name, module in model.named_modules() if isinstance(module, ResNetBasicblock)]
+        channels.update((name + '.stream', stream.tolist()) for name, stream in zip(names, live[1:]))
+    return channels
+
+
+def live_inputs(model, pruned_index):
+    """Input channels of every Conv2d and Linear of a masked CifarResNet, VGG or ImageNet ResNet that
+    are not constants, as LongTensors by module; layers not listed read all their inputs."""
+    model = unwrap(model)
+    filters = conv_filters(model, pruned_index)
+    live = {}
+    if isinstance(model, CifarResNet):
+        stream = cifar_stream(model, filters)[0]
+        for block, stream_in in zip(cifar_blocks(model), stream):
+            live[block.conv_a] = stream_in
+            live[block.conv_b] = filters[block.conv_a][0]
+        live[model.classifier] = stream[-1]
+    elif isinstance(model, (vgg_cifar10.vgg, imagenet_vgg.VGG)):
+        kept, last = None, None
+        for module in vgg_features(model):
+            if isinstance(module, nn.Conv2d):
+                if kept is not None:
+                    live[module] = kept
+                kept, last = filters[module][0], module
+        # flattened features are channel major
+        first = model.classifier[0]
+        spatial = first.in_features // last.out_channels
+        live[first] = (kept.view(-1, 1) * spatial + torch.arange(spatial, device=kept.device)).view(-1)
+    elif isinstance(model, imagenet_resnet.ResNet):
+        stream = filters[model.conv1][0]
+        for layer in (model.layer1, model.layer2, model.layer3, model.layer4):
+            for block in layer:
+                bottleneck = isinstance(block, imagenet_resnet.Bottleneck)
+                convs = [block.conv1, block.conv2] + ([block.conv3] if bottleneck else [])
+                live[convs[0]] = stream
+                for conv_in, conv in zip(convs[:-1], convs[1:]):
+                    live[conv] = filters[conv_in][0]
+                residual = stream
+                if block.downsample is not None:
+                    live[block.downsample[0]] = stream
+                    residual = filters[block.downsample[0]][0]
+                stream = torch.unique(torch.cat([filters[convs[-1]][0], residual]))
+        live[model.fc] = stream
+    return live
+
+
+def compact_optimizer(optimizer, model, small, slices):
+    """``optimizer`` rebuilt over the parameters of ``small``, with the momentum buffers of ``model``
+    cut down to the ``slices`` every slim parameter is taken from (see cifar_resnet_slices)."""
+    params = dict(unwrap(model).named_parameters())
+    small_params = list(unwrap(small).named_parameters())
+    groups = [dict((key, value) for key, value in group.items() if key != 'params')
+              for group in optimizer.param_groups]
+    assert len(groups) == 1, 'expected a single parameter group'
+    compact = type(optimizer)([param for name, param in small_params], **groups[0])
+    for name, param in small_params:
+        source, rows, columns = slices[name]
+        buffer = optimizer.state.get(params[source], {}).get('momentum_buffer')
+        if buffer is None:
+            continue
+        if rows is not None:
+            buffer = buffer[rows]
+        if columns is not None:
+            buffer = buffer[:, columns]
+        compact.state[param]['momentum_buffer'] = buffer.clone()
+    return compact
+
+
+def strip_module(state_dict):
+    """``state_dict`` without the ``module.`` prefixes of DataParallel."""
+    return OrderedDict((key[len('module.'):] if key.startswith('module.') else key, value)
+                       for key, value in state_dict.items())
+
+
+def zero_filters(model):
+    """``Mask.pruned_index`` of a masked model rebuilt from its weights: the all-zero filters of every conv."""
+    pruned_index = {}
+    for index, param in enumerate(model.parameters()):
+        if param.dim() == 4:
+            pruned_index[index] = torch.nonzero(param.data.view(param.size(0), -1).abs().sum(1) == 0).view(-1).tolist()
+    return pruned_index
+
+
+def resnet_small_from_checkpoint(arch, state_dict, pruned_index=None):
+    """``models.imagenet_resnet_small.ResNet_small`` from the ``state_dict`` of a pruned ImageNet ``arch``;
+    without ``pruned_index`` the all-zero filters are taken as pruned."""
+    model = imagenet_resnet.__dict__[arch]()
+    model.load_state_dict(strip_module(state_dict))
+    model.eval()
+    filters = conv_filters(model, zero_filters(model) if pruned_index is None else pruned_index)
+    bottleneck = isinstance(model.layer1[0], imagenet_resnet.Bottleneck)
+    names = ['layer{}'.format(i) for i in range(1, 5)]
+
+    num_for_construct = [model.conv1.out_channels]
+    index, bn_value = OrderedDict(), OrderedDict()
+    for name in names:
+        inner, outer = set(), set()
+        for i, block in enumerate(getattr(model, name)):
+            last_conv, last_bn = (block.conv3, block.bn3) if bottleneck else (block.conv2, block.bn2)
+            inner.update(filters[conv][0].numel() for conv in (block.conv1, block.conv2))
+            kept = filters[last_conv][0]
+            outer.add(kept.numel())
+            # ResNet_small matches these keys by substring, so they go in block order
+            index['{}.{}.conv3'.format(name, i)] = kept
+            bn_value['{}.{}.bn3'.format(name, i)] = pruned_constant(last_bn, kept).view(-1, 1, 1)
+        if len(inner) != 1 or len(outer) != 1:
+            raise ValueError('ResNet_small needs the same number of pruned filters in every block of '
+                             '{} (got {} and {})'.format(name, sorted(inner), sorted(outer)))
+        num_for_construct += [inner.pop(), outer.pop()]
+
+    small = imagenet_resnet_small.__dict__[arch + '_small'](index=index, bn_value=bn_value,
+                                                            num_for_construct=num_for_construct,
+                                                            num_classes=model.fc.out_features)
+    with torch.no_grad():
+        for module in ('conv1', 'bn1', 'fc'):
+            getattr(small, module).load_state_dict(getattr(model, module).state_dict())
+        for name in names:
+            for small_block, block in zip(getattr(small, name), getattr(model, name)):
+                kept_1, pruned_1 = filters[block.conv1]
+                kept_2, pruned_2 = filters[block.conv2]
+                small_block.conv1.weight.copy_(block.conv1.weight[kept_1])
+                copy_bn(small_block.bn1, block.bn1, kept_1)
+                small_block.conv2.weight.copy_(block.conv2.weight[kept_2][:, kept_1])
+                copy_bn(small_block.bn2, block.bn2, kept_2)
+                if pruned_1.numel() > 0:
+                    small_block.residue_value = F.relu(bn_constant(block.bn1)[pruned_1])
+                    small_block.residue_weight = block.conv2.weight[kept_2][:, pruned_1].clone()
+                if bottleneck:
+                    kept_3 = filters[block.conv3][0]
+                    small_block.conv3.weight.copy_(block.conv3.weight[kept_3][:, kept_2])
+                    copy_bn(small_block.bn3, block.bn3, kept_3)
+                    # the pruned filters of conv2 add a uniform constant through the 1x1 conv3: fold it into bn3
+                    if pruned_2.numel() > 0:
+                        weight = block.conv3.weight[kept_3][:, pruned_2].view(kept_3.numel(), -1)
+                        small_block.bn3.running_mean.sub_(torch.mv(weight, F.relu(bn_constant(block.bn2)[pruned_2])))
+                if block.downsample is not None:
+                    small_block.downsample.load_state_dict(block.downsample.state_dict())
+    return small.eval()
+
+
+class ResidueConv2d(nn.Conv2d):
+    """3x3 Conv2d that adds the constant maps of its pruned input channels back (see conv_residue)."""
+
+    def forward(self, x):
+        return super(ResidueConv2d, self).forward(x) + conv_residue(self.residue_value, self.residue_weight, x,
+                                                                    self.stride[0])
+
+
+def vgg_features(model):
+    """The features Sequential of a CIFAR ``vgg`` or ImageNet ``VGG``."""
+    model = unwrap(model)
+    return unwrap(model.feature if isinstance(model, vgg_cifar10.vgg) else model.features)
+
+
+def vgg_cfg(model, pruned_index):
+    """cfg of the slim VGG with the unpruned filters of every conv of a masked ``model``."""
+    filters = conv_filters(unwrap(model), pruned_index)
+    return ['M' if isinstance(module, nn.MaxPool2d) else filters[module][0].numel()
+            for module in vgg_features(model) if isinstance(module, (nn.Conv2d, nn.MaxPool2d))]
+
+
+def pruned_output(conv, bn, pruned):
+    """Eval-mode output after the ReLU of the ``pruned`` (all-zero) filters of ``conv``, with its ``bn``."""
+    value = conv.bias[pruned] if conv.bias is not None else conv.weight.new_zeros(pruned.numel())
+    if bn is not None:
+        value = (value - bn.running_mean[pruned]) * bn.weight[pruned] / torch.sqrt(bn.running_var[pruned] + bn.eps) \
+                + bn.bias[pruned]
+    return F.relu(value)
+
+
+def compact_vgg(model, pruned_index):
+    """Slim ``vgg``/``VGG`` built from ``vgg_cfg``, holding only the unpruned filters of a masked VGG."""
+    model = unwrap(model)
+    filters = conv_filters(model, pruned_index)
+    cfg = vgg_cfg(model, pruned_index)
+    features = vgg_features(model)
+    first = model.classifier[0]
+    if isinstance(model, vgg_cifar10.vgg):
+        dataset = {10: 'cifar10', 100: 'cifar100'}[model.classifier[-1].out_features]
+        small = vgg_cifar10.vgg(dataset, cfg=cfg, init_weights=False)
+    else:
+        batch_norm = any(isinstance(module, nn.BatchNorm2d) for module in features)
+        small = imagenet_vgg.VGG(imagenet_vgg.make_layers(cfg, batch_norm), model.classifier[-1].out_features)
+    small_features = vgg_features(small)
+
+    with torch.no_grad():
+        layers = list(features)
+        kept_in, pruned_in, value = torch.arange(3), torch.arange(0), None
+        for i, (module, small_module) in enumerate(zip(layers, small_features)):
+            if isinstance(module, nn.Conv2d):
+                kept, pruned = filters[module]
+                kept_in, pruned_in = kept_in.to(kept.device), pruned_in.to(kept.device)
+                if value is not None and value.abs().sum() > 0:
+                    small_module = ResidueConv2d(kept_in.numel(), kept.numel(), kernel_size=3, padding=1,
+                                                 bias=module.bias is not None)
+                    small_module.register_buffer('residue_value', value.clone())
+                    small_module.register_buffer('residue_weight', module.weight[kept][:, pruned_in].clone())
+                    setattr(small_features, str(i), small_module)
+                small_module.weight.copy_(module.weight[kept][:, kept_in])
+                if module.bias is not None:
+                    small_module.bias.copy_(module.bias[kept])
+                bn = layers[i + 1] if isinstance(layers[i + 1], nn.BatchNorm2d) else None
+                value = pruned_output(module, bn, pruned)
+                kept_in, pruned_in = kept, pruned
+            elif isinstance(module, nn.BatchNorm2d):
+                copy_bn(small_module, module, kept_in)
+
+        # flattened features are channel major; the pooled constants fold into the bias of the first linear layer
+        spatial = first.in_features // (kept_in.numel() + pruned_in.numel())
+        weight = first.weight.view(first.out_features, -1, spatial)
+        setattr(small.classifier, '0', nn.Linear(kept_in.numel() * spatial, first.out_features))
+        small.classifier[0].weight.copy_(weight[:, kept_in].reshape(first.out_features, -1))
+        small.classifier[0].bias.copy_(first.bias + torch.mv(weight[:, pruned_in].sum(2), value))
+        for small_module, module in list(zip(small.classifier, model.classifier))[1:]:
+            small_module.load_state_dict(module.state_dict())
+    return small.to(first.weight.device).train(model.training)
@@ -0,0 +1,74 @@
+"""Multiply-accumulate counts of dense, masked and compact models."""
+import torch
+import torch.nn as nn
+
+from compact import conv_filters, live_inputs, unwrap, zero_filters
+
+
+def _layer_macs(module, inputs, output, in_channels=None, out_channels=None):
+    """MACs of one sample through a Conv2d or Linear ``module``, with only ``in_channels`` inputs and
+    ``out_channels`` outputs (all of them by default)."""
+    if in_channels is None:
+        in_channels = module.in_channels if isinstance(module, nn.Conv2d) else module.in_features
+    if out_channels is None:
+        out_channels = module.out_channels if isinstance(module, nn.Conv2d) else module.out_features
+    if isinstance(module, nn.Conv2d):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        return output.size(2) * output.size(3) * kernel * in_channels // module.groups * out_channels
+    return in_channels * out_channels
+
+
+def _forward_hooks(model, hook):
+    handles = [module.register_forward_hook(hook) for module in model.modules()
+               if isinstance(module, (nn.Conv2d, nn.Linear))]
+    return handles
+
+
+def count_macs(model, input_size=(3, 32, 32)):
+    """MACs of one forward of a single ``input_size`` sample through the Conv2d and Linear layers of ``model``."""
+    total = [0]
+
+    def hook(module, inputs, output):
+        total[0] += _layer_macs(module, inputs, output)
+
+    handles = _forward_hooks(model, hook)
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.randn(1, *input_size, device=next(model.parameters()).device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+    return total[0]
+
+
+def pruned_macs(model, pruned_index=None, input_size=(3, 32, 32)):
+    """(dense, masked, co-pruned) MACs per sample of a masked ``model``; co-pruned also drops the input
+    channels the pruned filters of ``pruned_index`` (by default the all-zero ones) leave constant."""
+    macs = [0, 0, 0]
+    model = unwrap(model)
+    if pruned_index is None:
+        pruned_index = zero_filters(model)
+    filters = conv_filters(model, pruned_index)
+    live = live_inputs(model, pruned_index)
+
+    def hook(module, inputs, output):
+        out_channels = filters[module][0].numel() if module in filters else None
+        in_channels = live[module].numel() if module in live else None
+        macs[0] += _layer_macs(module, inputs, output)
+        macs[1] += _layer_macs(module, inputs, output, out_channels=out_channels)
+        macs[2] += _layer_macs(module, inputs, output, in_channels, out_channels)
+
+    handles = _forward_hooks(model, hook)
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, *input_size, device=next(model.parameters()).device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+    return tuple(macs)
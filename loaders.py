@@ -0,0 +1,386 @@
+"""Data loading helpers of the pruning scripts: on-device CIFAR batches, packed ImageNet shards, the val
+crop cache, draft-mode JPEG decoding and a background prefetcher."""
+import io
+import json
+import os
+import random
+import threading
+import time
+from queue import Empty, Full, Queue
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+def dataset_tensors(dataset):
+    """(images, targets) of a torchvision CIFAR10/CIFAR100/SVHN/STL10 ``dataset``: the images as one
+    uint8 [N, H, W, C] tensor and the targets as a LongTensor."""
+    images = np.asarray(dataset.data)
+    if images.shape[-1] not in (1, 3):
+        # SVHN and STL10 keep their images as [N, C, H, W]
+        images = images.transpose(0, 2, 3, 1)
+    for name in ('targets', 'labels', 'train_labels', 'test_labels'):
+        targets = getattr(dataset, name, None)
+        if targets is not None:
+            break
+    return torch.from_numpy(np.ascontiguousarray(images)), torch.as_tensor(np.asarray(targets), dtype=torch.long)
+
+
+def augment(images, flip, top, left, crop, padding):
+    """RandomHorizontalFlip then RandomCrop(``crop``, ``padding``) of every image of ``images`` (uint8
+    [B, H, W, C]), at the given offsets and flips, in one gather per batch."""
+    if padding > 0:
+        images = F.pad(images, (0, 0, padding, padding, padding, padding))
+    steps = torch.arange(crop, device=images.device)
+    rows = (top.view(-1, 1) + steps).view(-1, crop, 1)
+    cols = left.view(-1, 1) + torch.where(flip.view(-1, 1), crop - 1 - steps, steps)
+    batch = torch.arange(images.size(0), device=images.device).view(-1, 1, 1)
+    return images[batch, rows, cols.view(-1, 1, crop)]
+
+
+def normalization(mean, std, device=None):
+    """(scale, shift) doing ToTensor and Normalize(mean, std) in one multiply-add."""
+    std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+    mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+    return (1 / (255 * std)).to(device), (-mean / std).to(device)
+
+
+def normalize(images, scale, shift):
+    """Float [B, C, H, W] batch of uint8 [B, H, W, C] ``images``, normalized with ``normalization``."""
+    return images.permute(0, 3, 1, 2).float().mul_(scale).add_(shift).contiguous()
+
+
+class TensorLoader(object):
+    """Minibatches of a torchvision dataset held as one uint8 tensor on ``device``, augmented (train only)
+    and normalized there, like a DataLoader over ToTensor and Normalize."""
+
+    def __init__(self, dataset, batch_size, mean, std, train=False, crop=32, padding=4, device=None, seed=0):
+        images, targets = dataset_tensors(dataset)
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self.images = images.to(self.device)
+        self.targets = targets.to(self.device)
+        self.batch_size = batch_size
+        self.train = train
+        self.crop, self.padding = crop, padding
+        self.scale, self.shift = normalization(mean, std, self.device)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def __len__(self):
+        return (self.images.size(0) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        count = self.images.size(0)
+        if self.train:
+            order = torch.randperm(count, generator=self.generator).to(self.device)
+        else:
+            order = torch.arange(count, device=self.device)
+        for start in range(0, count, self.batch_size):
+            index = order[start:start + self.batch_size]
+            images = self.images.index_select(0, index)
+            if self.train:
+                size = index.numel()
+                limit = 2 * self.padding + images.size(1) - self.crop + 1
+                flip = torch.rand(size, generator=self.generator) < 0.5
+                top = torch.randint(0, limit, (size,), generator=self.generator, dtype=torch.long)
+                left = torch.randint(0, limit, (size,), generator=self.generator, dtype=torch.long)
+                images = augment(images, flip.to(self.device), top.to(self.device), left.to(self.device),
+                                 self.crop, self.padding)
+            yield normalize(images, self.scale, self.shift), self.targets.index_select(0, index)
+
+
+def is_packed(root):
+    """Whether ``root`` holds train and val splits packed by pack_imagenet.py."""
+    return all(os.path.isfile(os.path.join(root, split, 'index.npz')) for split in ('train', 'val'))
+
+
+class ShardDataset(torch.utils.data.Dataset):
+    """Random-access view of a split packed by pack_imagenet.py, giving (transform(PIL image), label)
+    like ImageFolder, with the same classes and labels. The shards are memory-mapped on first access
+    in each worker. With ``lazy`` JPEG images reach the transform undecoded (see open_lazy)."""
+
+    def __init__(self, root, transform=None, lazy=False):
+        self.root = root
+        self.transform = transform
+        self.lazy = lazy
+        with np.load(os.path.join(root, 'index.npz')) as index:
+            self.classes = [str(name) for name in index['classes']]
+            self.raw = str(index['mode']) == 'jpeg'
+            self.shard, self.offset, self.length = index['shard'], index['offset'], index['length']
+            self.height, self.width, self.targets = index['height'], index['width'], index['label']
+        self.shards = None
+
+    def __getstate__(self):
+        # memory maps are reopened by every worker
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, 'shard-{:05d}.bin'.format(shard))
+
+    def read(self, i):
+        """Stored bytes of image ``i``, copied out of its shard."""
+        if self.shards is None:
+            self.shards = [np.memmap(self.shard_path(shard), dtype=np.uint8, mode='r')
+                           for shard in range(int(self.shard.max()) + 1)]
+        return np.array(self.shards[self.shard[i]][self.offset[i]:self.offset[i] + self.length[i]])
+
+    def sample(self, i, data):
+        """(transform(image), label) of image ``i`` from its stored bytes ``data``."""
+        if self.raw:
+            image = Image.open(io.BytesIO(data.tobytes()))
+            if not self.lazy:
+                image = image.convert('RGB')
+        else:
+            image = Image.fromarray(data.reshape(self.height[i], self.width[i], 3))
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.targets[i])
+
+    def __getitem__(self, i):
+        return self.sample(i, self.read(i))
+
+
+class ShuffledShards(torch.utils.data.IterableDataset):
+    """Training stream over a ShardDataset: the shards in a random order, read front to back through a
+    shuffle buffer of ``buffer_size`` images. Call ``set_epoch`` before each epoch for a new order."""
+
+    def __init__(self, root, transform=None, buffer_size=1024, seed=0, lazy=False):
+        self.dataset = ShardDataset(root, transform, lazy)
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        seed = self.seed * 1000003 + self.epoch
+        shards = list(range(int(self.dataset.shard.max()) + 1))
+        random.Random(seed).shuffle(shards)
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id::worker.num_workers]
+            seed = seed * 1009 + worker.id
+        generator = random.Random(seed)
+        buffer = []
+        for shard in shards:
+            records = np.nonzero(self.dataset.shard == shard)[0]
+            for i in records[np.argsort(self.dataset.offset[records])]:
+                record = (i, self.dataset.read(i))
+                if len(buffer) < self.buffer_size:
+                    buffer.append(record)
+                    continue
+                slot = generator.randrange(self.buffer_size)
+                buffer[slot], record = record, buffer[slot]
+                yield self.dataset.sample(*record)
+        generator.shuffle(buffer)
+        for record in buffer:
+            yield self.dataset.sample(*record)
+
+def open_lazy(path):
+    """ImageFolder loader that only reads the header: the transform decodes the image (in RGB)."""
+    return Image.open(path)
+
+
+class DraftRandomResizedCrop(object):
+    """RandomResizedCrop for images from ``open_lazy`` that decodes a JPEG at the smallest DCT scale
+    the drawn crop box allows."""
+
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), interpolation=Image.BILINEAR):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.interpolation = interpolation
+
+    def __call__(self, image):
+        top, left, height, width = transforms.RandomResizedCrop.get_params(image, self.scale, self.ratio)
+        full_width, full_height = image.size
+        if image.format == 'JPEG' and image.mode in ('RGB', 'L') and image.tile:
+            # not decoded yet
+            factor = 1
+            while factor < 8 and width // (2 * factor) >= self.size[1] and height // (2 * factor) >= self.size[0]:
+                factor *= 2
+            if factor > 1:
+                image.draft('RGB', (full_width // factor, full_height // factor))
+        image = image.convert('RGB')
+        scale_x, scale_y = full_width / image.size[0], full_height / image.size[1]
+        box = (left / scale_x, top / scale_y, (left + width) / scale_x, (top + height) / scale_y)
+        return image.resize((self.size[1], self.size[0]), self.interpolation, box=box)
+
+
+def cache_val(dataset, root, meta=None, batch_size=256, workers=4):
+    """Run the transform of ``dataset`` (deterministic, ending in PIL images of one size, e.g. Resize(256)
+    and CenterCrop(224)) over it once, and store the uint8 [N, H, W, C] images and the labels in
+    ``root``/images.npy and labels.npy, and ``meta`` (what the cache was built from) in meta.json."""
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    if os.path.isfile(os.path.join(root, 'meta.json')):
+        os.remove(os.path.join(root, 'meta.json'))
+    transform = dataset.transform
+    dataset.transform = transforms.Compose([transform, np.asarray])
+    try:
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+        images, labels, position = None, np.zeros(len(dataset), np.int64), 0
+        for batch, targets in loader:
+            if images is None:
+                images = np.lib.format.open_memmap(os.path.join(root, 'images.tmp.npy'), mode='w+', dtype=np.uint8,
+                                                   shape=(len(dataset),) + tuple(batch.shape[1:]))
+            images[position:position + len(batch)] = batch.numpy()
+            labels[position:position + len(batch)] = targets.numpy()
+            position += len(batch)
+        images.flush()
+        del images
+    finally:
+        dataset.transform = transform
+    np.save(os.path.join(root, 'labels.npy'), labels)
+    os.replace(os.path.join(root, 'images.tmp.npy'), os.path.join(root, 'images.npy'))
+    # written last: an interrupted run leaves no valid cache behind
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump(meta or {}, f)
+
+
+def has_val_cache(root, meta=None):
+    """Whether ``root`` holds a complete val cache built from ``meta``"""
+    if not all(os.path.isfile(os.path.join(root, name)) for name in ('images.npy', 'labels.npy', 'meta.json')):
+        return False
+    with open(os.path.join(root, 'meta.json')) as f:
+        return json.load(f) == json.loads(json.dumps(meta or {}))
+
+
+class CachedLoader(object):
+    """Batches of a val cache written by ``cache_val``: contiguous slices of the memory-mapped uint8
+    images, normalized on ``device`` like ToTensor and Normalize(mean, std)."""
+
+    def __init__(self, root, batch_size, mean, std, device=None):
+        self.images = np.load(os.path.join(root, 'images.npy'), mmap_mode='r')
+        self.targets = torch.from_numpy(np.load(os.path.join(root, 'labels.npy')))
+        self.batch_size = batch_size
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self.scale, self.shift = normalization(mean, std, self.device)
+
+    def __len__(self):
+        return (len(self.images) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.images), self.batch_size):
+            images = torch.from_numpy(np.array(self.images[start:start + self.batch_size]))
+            if self.device.type == 'cuda':
+                images = images.pin_memory()
+            images = images.to(self.device, non_blocking=True)
+            targets = self.targets[start:start + self.batch_size].to(self.device, non_blocking=True)
+            yield normalize(images, self.scale, self.shift), targets
+
+
+def _to_device(batch, device):
+    # pinned, then copied without blocking the host
+    if torch.is_tensor(batch):
+        if batch.device == device:
+            return batch
+        if device.type == 'cuda' and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(item, device) for item in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            _record_stream(item, stream)
+
+
+class Prefetcher(object):
+    """Iterates ``loader`` on a background thread, up to ``depth`` batches ahead, copying them to a CUDA
+    ``device`` on a side stream; ``wait`` is the time the last iteration spent blocked on batches."""
+
+    def __init__(self, loader, device=None, depth=2):
+        self.loader = loader
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        if self.device.type == 'cuda' and self.device.index is None:
+            self.device = torch.device('cuda', torch.cuda.current_device())
+        self.depth = depth
+        self.wait = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # dataset, batch_size, ... of the wrapped loader
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _fill(self, queue, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            if stream is not None:
+                torch.cuda.set_device(self.device)
+            for batch in self.loader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = _to_device(batch, self.device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch, event = _to_device(batch, self.device), None
+                if not self._put(queue, (batch, event, None), stop):
+                    return
+        except Exception as error:
+            self._put(queue, (None, None, error), stop)
+            return
+        self._put(queue, (None, None, None), stop)
+
+    @staticmethod
+    def _put(queue, item, stop):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __iter__(self):
+        queue, stop = Queue(self.depth), threading.Event()
+        thread = threading.Thread(target=self._fill, args=(queue, stop))
+        thread.daemon = True
+        thread.start()
+        self.wait = 0.
+        try:
+            while True:
+                start = time.time()
+                batch, event, error = queue.get()
+                self.wait += time.time() - start
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    # the copies were allocated on the side stream
+                    _record_stream(batch, stream)
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            thread.join()
@@ -0,0 +1,211 @@
+"""Per-filter mask helpers shared by the ``Mask`` classes of both pruning scripts."""
+import torch
+import torch.nn as nn
+
+
+def filter_view(keep, ndim):
+    """Reshape a [N] filter mask so it broadcasts against an ``ndim``-dim weight."""
+    return keep.view(-1, *([1] * (ndim - 1)))
+
+
+def expand_filter_mask(keep, length):
+    """Materialize the flat float codebook of ``length`` entries for a filter mask."""
+    return keep.to(torch.float32).unsqueeze(1).expand(keep.numel(), length // keep.numel()).reshape(length)
+
+
+def residual_groups(model):
+    """Parameter indices of the convs summing into the same residual stream, one list per stage
+    (empty for models without residual streams)."""
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    if hasattr(model, 'stage_1'):
+        stem, stages = model.conv_1_3x3, [model.stage_1, model.stage_2, model.stage_3]
+    elif hasattr(model, 'layer1'):
+        stem, stages = model.conv1, [model.layer1, model.layer2, model.layer3, model.layer4]
+    else:
+        return []
+    param_index = {id(param): index for index, param in enumerate(model.parameters())}
+    groups = []
+    for stage in stages:
+        convs = [stem] if stage is stages[0] and stage[0].downsample is None else []
+        for block in stage:
+            convs.append([conv for conv in block.children() if isinstance(conv, nn.Conv2d)][-1])
+            if block.downsample is not None:
+                convs.extend(conv for conv in block.downsample.modules() if isinstance(conv, nn.Conv2d))
+        groups.append(sorted(param_index[id(conv.weight)] for conv in convs))
+    return groups
+
+
+class FilterCodebook(object):
+    """Dict-like view that materializes the old flat codebooks from the filter masks on access."""
+
+    def __init__(self, filter_mask, model_length):
+        self.filter_mask = filter_mask
+        self.model_length = model_length
+
+    def __getitem__(self, index):
+        return expand_filter_mask(self.filter_mask[index], self.model_length[index])
+
+    def __contains__(self, index):
+        return index in self.filter_mask
+
+    def __len__(self):
+        return len(self.filter_mask)
+
+    def __iter__(self):
+        return iter(self.filter_mask)
+
+    def keys(self):
+        return self.filter_mask.keys()
+
+
+def _mul_(tensors, masks):
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(tensors, masks)
+    else:
+        for tensor, mask in zip(tensors, masks):
+            tensor.mul_(mask)
+
+
+class FusedMask(object):
+    """Masked parameters and their stride-0 expanded filter masks, applied in one ``_foreach_mul_``."""
+
+    def __init__(self, params, keeps):
+        self.params = list(params)
+        self.keeps = list(keeps)
+        self.masks = [filter_view(keep, param.dim()).to(param.dtype).expand_as(param)
+                      for param, keep in zip(self.params, self.keeps)]
+        self.hooks = []
+
+    def apply_(self):
+        if self.params:
+            _mul_([param.data for param in self.params], self.masks)
+
+    def apply_grad_(self):
+        grads, masks = [], []
+        for param, mask in zip(self.params, self.masks):
+            if param.grad is not None:
+                grads.append(param.grad.data)
+                masks.append(mask)
+        if grads:
+            _mul_(grads, masks)
+
+    def register_grad_hooks(self):
+        """Mask each gradient as soon as backward produces it, overlapping with the rest of backward."""
+        self.remove_grad_hooks()
+        for param, mask in zip(self.params, self.masks):
+            self.hooks.append(param.register_hook(lambda grad, mask=mask: grad * mask))
+
+    def remove_grad_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+
+class MaskedSGD(torch.optim.SGD):
+    """SGD that only updates, and keeps momentum for, the kept filters of the ``masks`` parameters;
+    ``state_dict`` stores full-width buffers, so a checkpoint resumes with either optimizer."""
+
+    def __init__(self, params, lr, momentum=0, dampening=0, weight_decay=0, nesterov=False, masks=None, **kwargs):
+        super(MaskedSGD, self).__init__(params, lr, momentum=momentum, dampening=dampening,
+                                        weight_decay=weight_decay, nesterov=nesterov, **kwargs)
+        self._check_groups()
+        self.masks = {}
+        self.set_masks(masks or {})
+
+    @classmethod
+    def from_optimizer(cls, optimizer, masks):
+        """MaskedSGD taking over the param groups, with all their options, and the state of the SGD ``optimizer``"""
+        masked = cls.__new__(cls)
+        torch.optim.Optimizer.__init__(masked, [dict(group) for group in optimizer.param_groups], optimizer.defaults)
+        masked._check_groups()
+        masked.state.update(optimizer.state)
+        masked.masks = {}
+        masked.set_masks(masks)
+        return masked
+
+    def _check_groups(self):
+        # maximize is applied in _update and foreach only picks the kernels of the plain update, which _update
+        # replaces by its per-parameter loop; the other SGD options change the update in ways it does not follow
+        for group in self.param_groups:
+            for option in ('differentiable', 'fused'):
+                if group.get(option):
+                    raise ValueError('MaskedSGD does not support {}=True'.format(option))
+
+    @staticmethod
+    def _full_buffer(param, state):
+        """Momentum buffer of ``param`` at full width, zero on the pruned filters"""
+        buf = state.get('momentum_buffer')
+        if buf is not None and 'kept' in state:
+            buf = param.new_zeros(param.size()).index_copy_(0, state['kept'], buf)
+        return buf
+
+    def set_masks(self, masks):
+        """Restrict every parameter of ``masks`` to its kept filters, zeroing the pruned ones and
+        slicing their momentum buffers (expanded first if they were sliced by earlier masks)"""
+        with torch.no_grad():
+            for param, keep in masks.items():
+                keep = keep.to(device=param.device, dtype=torch.bool)
+                kept = torch.nonzero(keep).view(-1)
+                state = self.state[param]
+                buf = self._full_buffer(param, state)
+                if buf is not None:
+                    state['momentum_buffer'] = buf.index_select(0, kept)
+                param.data.mul_(filter_view(keep, param.dim()).to(param.dtype))
+                state['kept'] = kept
+                state['prefix'] = bool(keep[:kept.numel()].all())
+                self.masks[param] = keep
+
+    def state_dict(self):
+        """SGD state dict: full-width momentum buffers and no mask entries, so plain SGD can resume from it"""
+        state_dict = super(MaskedSGD, self).state_dict()
+        index = {id(param): i for i, param in enumerate(p for group in self.param_groups for p in group['params'])}
+        for param in self.masks:
+            state = self.state.get(param)
+            if state:
+                full = {key: value for key, value in state.items() if key not in ('kept', 'prefix')}
+                if 'momentum_buffer' in full:
+                    full['momentum_buffer'] = self._full_buffer(param, state)
+                state_dict['state'][index[id(param)]] = full
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(MaskedSGD, self).load_state_dict(state_dict)
+        self._check_groups()
+        self.set_masks(dict(self.masks))
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        with torch.no_grad():
+            for group in self.param_groups:
+                for param in group['params']:
+                    if param.grad is not None:
+                        self._update(param, group)
+        return loss
+
+    def _update(self, param, group):
+        state = self.state[param]
+        kept = state.get('kept')
+        weight, grad = param.data, param.grad.data
+        if kept is not None and state['prefix']:
+            weight, grad = weight.narrow(0, 0, kept.numel()), grad.narrow(0, 0, kept.numel())
+        elif kept is not None:
+            weight, grad = weight.index_select(0, kept), grad.index_select(0, kept)
+        d_p = grad
+        if group.get('maximize', False):
+            d_p = -d_p
+        if group['weight_decay'] != 0:
+            d_p = d_p.add(weight, alpha=group['weight_decay'])
+        if group['momentum'] != 0:
+            buf = state.get('momentum_buffer')
+            if buf is None:
+                buf = state['momentum_buffer'] = d_p.clone()
+            else:
+                buf.mul_(group['momentum']).add_(d_p, alpha=1 - group['dampening'])
+            d_p = d_p.add(buf, alpha=group['momentum']) if group['nesterov'] else buf
+        if kept is None or state['prefix']:
+            weight.add_(d_p, alpha=-group['lr'])
+        else:
+            param.data.index_add_(0, kept, d_p.mul(-group['lr']))
@@ -1,4 +1,5 @@
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 import torch.utils.model_zoo as model_zoo
 from torch.autograd import Variable
@@ -22,6 +23,34 @@ def conv3x3(in_planes, out_planes, stride=1):
                      padding=1, bias=False)
 
 
+def conv_residue(value, weight, x, stride=1):
+    "3x3 convolution of the constant maps of pruned filters; not uniform because of the zero padding"
+    constant = value.view(1, -1, 1, 1).expand(1, value.numel(), x.size(2), x.size(3))
+    return F.conv2d(constant, weight, stride=stride, padding=1)
+
+
+def pruned_channels(index, channels):
+    "Channels of a residual stream of ``channels`` that ``index`` does not write to"
+    keep = torch.ones(channels, dtype=torch.bool, device=index.device)
+    keep[index] = False
+    return torch.nonzero(keep).view(-1)
+
+
+def merge(residual, index, out, pruned, bn_value):
+    """residual with out added at channels index (all of them, in order, when None) and bn_value at the
+    pruned channels, in place.
+
+    bn_value is 0 at index (the BN constants of the pruned filters), so the constants are scattered to
+    the pruned channels only, from a stride-0 expansion, instead of being added to the whole residual.
+    """
+    if pruned.numel() > 0:
+        constant = bn_value.view(1, -1, 1, 1).index_select(1, pruned)
+        residual.index_add_(1, pruned, constant.expand(residual.size(0), -1, residual.size(2), residual.size(3)))
+    if index is None:
+        return residual.add_(out)
+    return residual.index_add_(1, index, out)
+
+
 class BasicBlock(nn.Module):
     expansion = 1
 
@@ -37,9 +66,14 @@ class BasicBlock(nn.Module):
         self.stride = stride
 
         # for residual index match
-        self.index = Variable(index)
+        self.register_buffer('index', torch.as_tensor(index, dtype=torch.long))
         # for bn add
-        self.bn_value = bn_value
+        self.register_buffer('bn_value', torch.as_tensor(bn_value))
+        self.register_buffer('pruned', pruned_channels(self.index, self.bn_value.numel()))
+        self.identity = torch.equal(self.index.cpu(), torch.arange(self.bn_value.numel()))
+        # for the pruned filters of conv1, whose constant output conv2 still reads
+        self.register_buffer('residue_value', None)
+        self.register_buffer('residue_weight', None)
 
         # self.out = torch.autograd.Variable(
         #     torch.rand(batch, self.planes_before_prune, 64 * 56 // self.planes_before_prune,
@@ -52,7 +86,10 @@ class BasicBlock(nn.Module):
         out = self.bn1(out)
         out = self.relu(out)
 
-        out = self.conv2(out)
+        if self.residue_weight is not None:
+            out = self.conv2(out) + conv_residue(self.residue_value, self.residue_weight, out)
+        else:
+            out = self.conv2(out)
         out = self.bn2(out)
 
         if self.downsample is not None:
@@ -63,8 +100,7 @@ class BasicBlock(nn.Module):
         # out = self.relu(out)
 
         # setting: with index match
-        residual += self.bn_value.cuda()
-        residual.index_add_(1, self.index.cuda(), out)
+        residual = merge(residual, None if self.identity else self.index, out, self.pruned, self.bn_value)
 
         residual = self.relu(residual)
 
@@ -96,9 +132,14 @@ class Bottleneck(nn.Module):
         self.downsample = downsample
         self.stride = stride
         # for residual index match
-        self.index = Variable(index)
+        self.register_buffer('index', torch.as_tensor(index, dtype=torch.long))
         # for bn add
-        self.bn_value = bn_value
+        self.register_buffer('bn_value', torch.as_tensor(bn_value))
+        self.register_buffer('pruned', pruned_channels(self.index, self.bn_value.numel()))
+        self.identity = torch.equal(self.index.cpu(), torch.arange(self.bn_value.numel()))
+        # for the pruned filters of conv1, whose constant output conv2 still reads
+        self.register_buffer('residue_value', None)
+        self.register_buffer('residue_weight', None)
 
         # self.extend = torch.autograd.Variable(
         #     torch.rand(self.planes_before_prune * 4, 64 * 56 // self.planes_before_prune,
@@ -110,7 +151,10 @@ class Bottleneck(nn.Module):
         out = self.bn1(out)
         out = self.relu(out)
 
-        out = self.conv2(out)
+        if self.residue_weight is not None:
+            out = self.conv2(out) + conv_residue(self.residue_value, self.residue_weight, out, self.stride)
+        else:
+            out = self.conv2(out)
         out = self.bn2(out)
         out = self.relu(out)
 
@@ -126,8 +170,7 @@ class Bottleneck(nn.Module):
         # out = self.relu(out)
 
         # setting: with index match
-        residual += self.bn_value.cuda()
-        residual.index_add_(1, self.index.cuda(), out)
+        residual = merge(residual, None if self.identity else self.index, out, self.pruned, self.bn_value)
 
         residual = self.relu(residual)
 
@@ -315,3 +358,47 @@ def resnet152_small(pretrained=False, **kwargs):
     if pretrained:
         model.load_state_dict(model_zoo.load_url(model_urls['resnet152']))
     return model
+
+
+if __name__ == '__main__':
+    # per-batch latency of the residual merges of a pruned ResNet-50 (30% of the conv3 filters of every
+    # block), before (bn_value added to the whole residual, then index_add_) and after (merge)
+    def legacy_merge(residual, index, out, pruned, bn_value):
+        residual += bn_value
+        return residual.index_add_(1, index, out)
+
+    def time_merges(fn, shapes, device, repeat=10):
+        batches = []
+        for channels, size, blocks in shapes:
+            index = torch.randperm(channels, device=device)[:int(channels * 0.7)].sort()[0]
+            bn_value = torch.randn(channels, 1, 1, device=device)
+            bn_value[index] = 0
+            pruned = pruned_channels(index, channels)
+            for i in range(blocks):
+                batches.append((torch.randn(32, channels, size, size, device=device), index,
+                                torch.randn(32, index.numel(), size, size, device=device), pruned, bn_value))
+        times = []
+        for i in range(repeat + 1):
+            inputs = [(batch[0].clone(),) + batch[1:] for batch in batches]
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for args in inputs:
+                fn(*args)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - start)
+        return sorted(times[1:])[repeat // 2]
+
+    residual, index, out = torch.randn(2, 8, 4, 4), torch.tensor([0, 2, 3, 6]), torch.randn(2, 4, 4, 4)
+    bn_value = torch.randn(8, 1, 1)
+    bn_value[index] = 0
+    assert torch.equal(legacy_merge(residual.clone(), index, out, None, bn_value),
+                       merge(residual.clone(), index, out, pruned_channels(index, 8), bn_value))
+
+    shapes = [(256, 56, 3), (512, 28, 4), (1024, 14, 6), (2048, 7, 3)]
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+    for device in devices:
+        before, after = time_merges(legacy_merge, shapes, device), time_merges(merge, shapes, device)
+        print('{}: merges per batch of 32: before {:.1f} ms, after {:.1f} ms, speedup {:.2f}x'.format(
+            device, before * 1000, after * 1000, before / after))
@@ -0,0 +1,88 @@
+"""Inference-only copies of the CIFAR/ImageNet ResNets and VGGs, full or compact, with BN folded into the convs."""
+import copy
+
+import torch
+import torch.nn as nn
+
+# (conv, bn) attribute pairs of the blocks and stems of the ResNets, and the residues added between them
+_PAIRS = [('conv_1_3x3', 'bn_1'), ('conv_a', 'bn_a'), ('conv_b', 'bn_b'), ('conv1', 'bn1'), ('conv2', 'bn2'),
+          ('conv3', 'bn3'), ('conv', 'bn')]
+_RESIDUES = {'conv_a': 'residue_a_weight', 'conv_b': 'residue_b_weight', 'conv2': 'residue_weight'}
+
+
+def fold_bn(conv, bn, residues=()):
+    """Fold the eval-mode ``bn`` into ``conv``, in place, and scale the residue weights in ``residues``
+    that are added to the conv output before ``bn``."""
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.weight is not None:
+            scale = scale * bn.weight
+        bias = -bn.running_mean * scale
+        if bn.bias is not None:
+            bias = bias + bn.bias
+        if conv.bias is not None:
+            bias = bias + conv.bias * scale
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        for weight in list(residues) + [getattr(conv, 'residue_weight', None)]:
+            if weight is not None:
+                weight.mul_(scale.view(-1, 1, 1, 1))
+        if conv.bias is None:
+            conv.bias = nn.Parameter(bias)
+        else:
+            conv.bias.copy_(bias)
+
+
+def _fold_module(module):
+    for conv_name, bn_name in _PAIRS:
+        conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            residue = getattr(module, _RESIDUES.get(conv_name, ''), None)
+            fold_bn(conv, bn, [] if residue is None else [residue])
+            setattr(module, bn_name, nn.Identity())
+    if isinstance(module, nn.Sequential):
+        children = list(module._modules.items())
+        for (conv_name, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                fold_bn(conv, bn)
+                module._modules[bn_name] = nn.Identity()
+
+
+def _register_buffers(module):
+    # imagenet_resnet_small blocks pickled before index and bn_value were buffers, which .to() does not move
+    for name in ('index', 'bn_value'):
+        value = module.__dict__.get(name)
+        if torch.is_tensor(value):
+            delattr(module, name)
+            module.register_buffer(name, value.data)
+
+
+class Frozen(nn.Module):
+    """Eval-only wrapper of a model prepared by ``freeze``: runs without autograd and cannot be trained."""
+
+    def __init__(self, model):
+        super(Frozen, self).__init__()
+        self.model = model
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError('a frozen model is for inference only')
+        return super(Frozen, self).train(False)
+
+    def forward(self, x):
+        with torch.no_grad():
+            return self.model(x)
+
+
+def freeze(model):
+    """Frozen eval-only copy of ``model`` (optionally DataParallel) with its BatchNorms folded."""
+    model = model.module if isinstance(model, nn.DataParallel) else model
+    model = copy.deepcopy(model).eval()
+    if getattr(model, 'perm_1', None) is not None:
+        # back from the masked conv mode of models.resnet
+        model.skip_pruned(None)
+    for module in list(model.modules()):
+        _register_buffers(module)
+        _fold_module(module)
+    for param in model.parameters():
+        param.requires_grad = False
+    return Frozen(model).eval()
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class DownsampleA(nn.Module):  
 
@@ -9,7 +10,15 @@ class DownsampleA(nn.Module):
 
   def forward(self, x):   
     x = self.avg(x)  
-    return torch.cat((x, x.mul(0)), 1)  
+    # one zero-filled output, no zero copy of x to concatenate
+    return F.pad(x, (0, 0, 0, 0, 0, x.size(1)))
+
+  def add_into(self, x, out):
+    """out + forward(x) with the padded zero channels never built: the subsampled x is added to the
+    first channels of out in place"""
+    x = self.avg(x)
+    out.narrow(1, 0, x.size(1)).add_(x)
+    return out
 
 class DownsampleC(nn.Module):     
 
@@ -6,6 +6,60 @@ from .res_utils import DownsampleA, DownsampleC, DownsampleD
 import math
 
 
+def kept_first(channels, pruned, device=None):
+  """Permutation of ``channels`` filters putting the ones not in ``pruned`` first, both in order"""
+  keep = torch.ones(channels, dtype=torch.bool, device=device)
+  if len(pruned) > 0:
+    keep[torch.as_tensor(list(pruned), dtype=torch.long, device=device)] = False
+  return torch.cat([torch.nonzero(keep).view(-1), torch.nonzero(~keep).view(-1)])
+
+
+def permute(layout, optimizer=None):
+  """Permute dim ``dim`` of the parameters and buffers of every (module, perm, dim) in ``layout``, and the
+  state ``optimizer`` holds for them"""
+  with torch.no_grad():
+    for module, perm, dim in layout:
+      for tensor in [tensor for tensor in list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))
+                     if tensor.dim() > dim and tensor.size(dim) == perm.numel()]:
+        state = optimizer.state.get(tensor, {}) if optimizer is not None else {}
+        for value in [tensor.data] + [value for value in state.values()
+                                      if torch.is_tensor(value) and value.size() == tensor.size()]:
+          value.copy_(value.index_select(dim, perm))
+
+
+def scatter_kept(residual, out, perm, bias):
+  """residual (if any) plus ``out`` at channels perm[:kept] and the constants ``bias`` of the pruned filters
+  at perm[kept:]"""
+  kept = out.size(1)
+  constant = out.new_zeros(perm.numel()).index_copy(0, perm[kept:], bias).view(1, -1, 1, 1)
+  if residual is None:
+    joined = constant.expand(out.size(0), -1, out.size(2), out.size(3)).contiguous()
+  elif kept < perm.numel():
+    joined = residual + constant
+  else:
+    joined = residual.clone()
+  return joined.index_add_(1, perm[:kept], out)
+
+
+def narrow_bn(bn, x, length):
+  """bn on the first ``length`` channels of its parameters and running statistics"""
+  if bn.training:
+    bn.num_batches_tracked += 1
+  return F.batch_norm(x, bn.running_mean.narrow(0, 0, length), bn.running_var.narrow(0, 0, length),
+                      bn.weight.narrow(0, 0, length), bn.bias.narrow(0, 0, length), bn.training, bn.momentum, bn.eps)
+
+
+def zero_bn(bn, start):
+  """bn output for all-zero channels from ``start`` on: the batch statistics of zeros are 0 in training,
+  where the running statistics decay towards them"""
+  if bn.training:
+    with torch.no_grad():
+      bn.running_mean[start:].mul_(1 - bn.momentum)
+      bn.running_var[start:].mul_(1 - bn.momentum)
+    return bn.bias[start:]
+  return bn.bias[start:] - bn.weight[start:] * bn.running_mean[start:] / torch.sqrt(bn.running_var[start:] + bn.eps)
+
+
 class ResNetBasicblock(nn.Module):
   expansion = 1
   """
@@ -22,7 +76,40 @@ class ResNetBasicblock(nn.Module):
 
     self.downsample = downsample
 
+    # masked conv mode, see skip_pruned
+    self.register_buffer('perm_a', None)
+    self.register_buffer('perm_b', None)
+    self.kept_a = planes
+    self.kept_b = planes
+
+  def skip_pruned(self, pruned_a=None, pruned_b=None, optimizer=None):
+    """Masked conv mode: permute the filters of conv_a and conv_b (with their BN and the conv_b inputs)
+    so that the kept ones come first, and run the convs on the kept filters only. The pruned filters
+    must be zero (Mask.do_similar_mask); their constant BN outputs are added back, so forward and
+    backward match the masked block. None restores the original layout. The state of ``optimizer``
+    (momentum buffers) is permuted along."""
+    if getattr(self, 'perm_a', None) is not None:
+      self._permute(self.perm_a.argsort(), self.perm_b.argsort(), optimizer)
+      self.perm_a, self.perm_b = None, None
+      self.kept_a, self.kept_b = self.conv_a.out_channels, self.conv_b.out_channels
+    if pruned_a is None:
+      return
+    device = self.conv_a.weight.device
+    perm_a = kept_first(self.conv_a.out_channels, pruned_a, device)
+    perm_b = kept_first(self.conv_b.out_channels, pruned_b, device)
+    self._permute(perm_a, perm_b, optimizer)
+    self.perm_a, self.perm_b = perm_a, perm_b
+    self.kept_a = self.conv_a.out_channels - len(set(pruned_a))
+    self.kept_b = self.conv_b.out_channels - len(set(pruned_b))
+
+  def _permute(self, perm_a, perm_b, optimizer=None):
+    permute([(self.conv_a, perm_a, 0), (self.bn_a, perm_a, 0), (self.conv_b, perm_a, 1), (self.conv_b, perm_b, 0),
+             (self.bn_b, perm_b, 0)], optimizer)
+
   def forward(self, x):
+    # getattr: blocks pickled before the masked conv mode have no perm_a
+    if getattr(self, 'perm_a', None) is not None:
+      return self.forward_kept(x)
     residual = x
 
     basicblock = self.conv_a(x)
@@ -32,11 +119,36 @@ class ResNetBasicblock(nn.Module):
     basicblock = self.conv_b(basicblock)
     basicblock = self.bn_b(basicblock)
 
+    if isinstance(self.downsample, DownsampleA):
+      return F.relu(self.downsample.add_into(x, basicblock), inplace=True)
     if self.downsample is not None:
       residual = self.downsample(x)
     
     return F.relu(residual + basicblock, inplace=True)
 
+  def forward_kept(self, x):
+    kept_a, kept_b = self.kept_a, self.kept_b
+    residual = x
+
+    basicblock = F.conv2d(x, self.conv_a.weight.narrow(0, 0, kept_a), None, self.conv_a.stride, 1)
+    basicblock = narrow_bn(self.bn_a, basicblock, kept_a)
+    basicblock = F.relu(basicblock, inplace=True)
+
+    weight_b = self.conv_b.weight.narrow(0, 0, kept_b)
+    out = F.conv2d(basicblock, weight_b.narrow(1, 0, kept_a), None, 1, 1)
+    if kept_a < self.conv_a.out_channels:
+      # conv_b still reads the constant maps of the pruned filters of conv_a; not uniform because of the padding
+      constant = F.relu(zero_bn(self.bn_a, kept_a)).view(1, -1, 1, 1)
+      constant = constant.expand(1, constant.size(1), basicblock.size(2), basicblock.size(3))
+      out = out + F.conv2d(constant, weight_b.narrow(1, kept_a, constant.size(1)), None, 1, 1)
+    out = narrow_bn(self.bn_b, out, kept_b)
+
+    if self.downsample is not None:
+      residual = self.downsample(x)
+
+    # back to the stream layout: the kept filters at perm_b[:kept_b], the constant of the pruned ones elsewhere
+    return F.relu(scatter_kept(residual, out, self.perm_b, zero_bn(self.bn_b, kept_b)), inplace=True)
+
 class CifarResNet(nn.Module):
   """
   ResNet optimized for the Cifar dataset, as specified in
@@ -68,6 +180,10 @@ class CifarResNet(nn.Module):
     self.avgpool = nn.AvgPool2d(8)
     self.classifier = nn.Linear(64*block.expansion, num_classes)
 
+    # masked conv mode, see skip_pruned
+    self.register_buffer('perm_1', None)
+    self.kept_1 = 16
+
     for m in self.modules():
       if isinstance(m, nn.Conv2d):
         n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -93,9 +209,49 @@ class CifarResNet(nn.Module):
 
     return nn.Sequential(*layers)
 
+  def skip_pruned(self, pruned_index=None, optimizer=None):
+    """Masked conv mode for the stem and every block (see ResNetBasicblock.skip_pruned); ``pruned_index``
+    is Mask.pruned_index, None restores the original layout"""
+    param_index = {id(param): index for index, param in enumerate(self.parameters())}
+    if getattr(self, 'perm_1', None) is not None:
+      permute([(self.conv_1_3x3, self.perm_1.argsort(), 0), (self.bn_1, self.perm_1.argsort(), 0)], optimizer)
+      self.perm_1, self.kept_1 = None, self.conv_1_3x3.out_channels
+    if pruned_index is not None:
+      pruned = pruned_index.get(param_index[id(self.conv_1_3x3.weight)], [])
+      self.perm_1 = kept_first(self.conv_1_3x3.out_channels, pruned, self.conv_1_3x3.weight.device)
+      self.kept_1 = self.conv_1_3x3.out_channels - len(set(pruned))
+      permute([(self.conv_1_3x3, self.perm_1, 0), (self.bn_1, self.perm_1, 0)], optimizer)
+    for stage in (self.stage_1, self.stage_2, self.stage_3):
+      for block in stage:
+        if pruned_index is None:
+          block.skip_pruned(optimizer=optimizer)
+        else:
+          block.skip_pruned(pruned_index.get(param_index[id(block.conv_a.weight)], []),
+                            pruned_index.get(param_index[id(block.conv_b.weight)], []), optimizer)
+
+  def kept_masks(self):
+    """Filter masks of the convs in masked conv mode, where the kept filters come first (for
+    masking.MaskedSGD)"""
+    convs = [(self.conv_1_3x3, getattr(self, 'kept_1', self.conv_1_3x3.out_channels))]
+    for stage in (self.stage_1, self.stage_2, self.stage_3):
+      for block in stage:
+        convs += [(block.conv_a, getattr(block, 'kept_a', block.conv_a.out_channels)),
+                  (block.conv_b, getattr(block, 'kept_b', block.conv_b.out_channels))]
+    masks = {}
+    for conv, kept in convs:
+      keep = torch.zeros(conv.out_channels, dtype=torch.bool, device=conv.weight.device)
+      keep[:kept] = True
+      masks[conv.weight] = keep
+    return masks
+
   def forward(self, x):
-    x = self.conv_1_3x3(x)
-    x = F.relu(self.bn_1(x), inplace=True)
+    if getattr(self, 'perm_1', None) is not None:
+      out = F.conv2d(x, self.conv_1_3x3.weight.narrow(0, 0, self.kept_1), None, 1, 1)
+      out = narrow_bn(self.bn_1, out, self.kept_1)
+      x = F.relu(scatter_kept(None, out, self.perm_1, zero_bn(self.bn_1, self.kept_1)), inplace=True)
+    else:
+      x = self.conv_1_3x3(x)
+      x = F.relu(self.bn_1(x), inplace=True)
     x = self.stage_1(x)
     x = self.stage_2(x)
     x = self.stage_3(x)
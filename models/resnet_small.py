@@ -2,127 +2,158 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
-#from .res_utils import DownsampleA, DownsampleC, DownsampleD
-import math,time
+import math
 
-class DownsampleA(nn.Module):  
 
-  def __init__(self, nIn, nOut, stride):
-    super(DownsampleA, self).__init__() 
-    self.avg = nn.AvgPool2d(kernel_size=1, stride=stride)   
+def conv_residue(value, weight, x, stride=1):
+  """3x3 convolution of the constant maps of pruned channels; not uniform because of the zero padding"""
+  constant = value.view(1, -1, 1, 1).expand(1, value.numel(), x.size(2), x.size(3))
+  return F.conv2d(constant, weight, stride=stride, padding=1)
 
-  def forward(self, x):   
-    x = self.avg(x)  
-    return torch.cat((x, x.mul(0)), 1)  
+
+def zero_response(bn):
+  """Output of bn for all-zero input channels; in train mode it updates the running statistics as the
+  all-zero channels of the masked model do"""
+  return bn(bn.running_mean.new_zeros(2, bn.num_features, 1, 1))[0, :, 0, 0]
+
+
+def join(residual, res_index, out, bias):
+  """Output stream of a block: out fills its first channels, residual is added at res_index (channel
+  by channel when None) and bias holds the constants of everything they do not write"""
+  if res_index is None and out.size(1) == residual.size(1):
+    # every channel is written by both, nothing is constant
+    return residual + out
+  bias = bias.view(1, -1, 1, 1)
+  if res_index is None:
+    joined = residual + bias
+  else:
+    joined = bias.expand(residual.size(0), -1, residual.size(2), residual.size(3)).contiguous()
+    joined.index_add_(1, res_index, residual)
+  joined.narrow(1, 0, out.size(1)).add_(out)
+  return joined
 
 
 class ResNetBasicblock(nn.Module):
   expansion = 1
   """
-  RexNet basicblock (https://github.com/facebook/fb.resnet.torch/blob/master/models/resnet.lua)
+  Slim RexNet basicblock of a pruned CifarResNet (see compact.compact_cifar_resnet)
+
+  The residual stream only carries its live channels, the ones an unpruned filter of the stem or
+  of a conv_b has written to; the others hold constants. So
+    - conv_a reads the live input channels and writes its unpruned filters,
+    - conv_b reads those and writes its own unpruned filters,
+    - the output stream starts with the channels conv_b writes, followed by the other live input
+      channels; the input is added at res_index, or as is for a plain block whose input already
+      has this layout, and the constant stream channels fill everything not written.
+  With one mask shared by the stage (Mask --share_residual_masks) every block after the first of a
+  stage is plain.
+  The constant stream channels conv_a would read and the constant output of the pruned filters
+  of conv_a that conv_b would read are added back as residues before bn_a and bn_b.
+  The constants are computed in every forward from the BN channels of the pruned filters, kept in
+  bn_a_pruned and bn_b_pruned, so they train along like in the masked model. The block takes and
+  returns the constants of the whole input and output stream, zero at the live channels.
   """
-  def __init__(self, inplanes, planes, supply, index, stride=1, downsample=None):
+  def __init__(self, stream_planes, inplanes, planes, planes_a, planes_b, outplanes, stride=1, downsample=None,
+               plain=False):
     super(ResNetBasicblock, self).__init__()
 
-    self.conv_a = nn.Conv2d(inplanes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
-    self.bn_a = nn.BatchNorm2d(planes)
+    self.conv_a = nn.Conv2d(inplanes, planes_a, kernel_size=3, stride=stride, padding=1, bias=False)
+    self.bn_a = nn.BatchNorm2d(planes_a)
 
-    self.conv_b = nn.Conv2d(planes, planes, kernel_size=3, stride=1, padding=1, bias=False)
-    self.bn_b = nn.BatchNorm2d(planes)
+    self.conv_b = nn.Conv2d(planes_a, planes_b, kernel_size=3, stride=1, padding=1, bias=False)
+    self.bn_b = nn.BatchNorm2d(planes_b)
 
     self.downsample = downsample
-    self.inplanes = inplanes
-    self.index = index
-    self.supply = supply
-    self.size = 0
-    self.out = torch.autograd.Variable(torch.rand(128, self.supply, 16*32//self.supply, 16*32//self.supply))
-    self.i = 0
-    self.time = []
-    self.sum = []
-    
-  def forward(self, x):
-        
+    self.stride = stride
+
+    self.planes = planes
+    # for residual index match
+    assert not plain or inplanes == outplanes, 'a plain block keeps the stream width'
+    self.register_buffer('res_index', None if plain else torch.arange(inplanes))
+    # stream channels of the output, for the constants added to it
+    self.register_buffer('stream_out', torch.arange(outplanes))
+    # for the constant stream channels and the pruned filters of conv_a
+    self.register_buffer('dead_in', torch.arange(inplanes, stream_planes))
+    self.residue_a_weight = nn.Parameter(torch.zeros(planes_a, stream_planes - inplanes, 3, 3))
+    self.bn_a_pruned = nn.BatchNorm2d(planes - planes_a) if planes > planes_a else None
+    self.residue_b_weight = nn.Parameter(torch.zeros(planes_b, planes - planes_a, 3, 3))
+    # for the pruned filters of conv_b
+    self.bn_b_pruned = nn.BatchNorm2d(planes - planes_b) if planes > planes_b else None
+    self.register_buffer('pruned_b', torch.arange(planes_b, planes))
+
+  def forward(self, x, constant):
     residual = x
 
     basicblock = self.conv_a(x)
+    if self.dead_in.numel() > 0:
+      basicblock = basicblock + conv_residue(constant[self.dead_in], self.residue_a_weight, x, self.stride)
     basicblock = self.bn_a(basicblock)
     basicblock = F.relu(basicblock, inplace=True)
 
-    basicblock = self.conv_b(basicblock)
+    if self.bn_a_pruned is not None:
+      residue = F.relu(zero_response(self.bn_a_pruned))
+      basicblock = self.conv_b(basicblock) + conv_residue(residue, self.residue_b_weight, basicblock)
+    else:
+      basicblock = self.conv_b(basicblock)
     basicblock = self.bn_b(basicblock)
 
     if self.downsample is not None:
       residual = self.downsample(x)
-    
-    out = self.out
-#    out.zero_()
-#    out = torch.FloatTensor(self.inplanes, basicblock.size()[1], basicblock.size()[2]).zero_()
-#    out.index_add_(0, self.index[0], residual.data)
-#    out.index_add_(0, self.index[1], basicblock.data)
-#    out = torch.rand(self.inplanes, basicblock.size()[1], basicblock.size()[2])
-#    time1 =time.time()
-#    self.i += 1
-#    if  self.i  == 1:
-#      self.out = torch.autograd.Variable(torch.rand(basicblock.size()[0], self.supply, basicblock.size()[2], basicblock.size()[3]))
-#      print("set out")
-#      print(self.i,basicblock.size()[0])
-#    elif self.i in [79]:
-#      self.out = torch.autograd.Variable(torch.rand(basicblock.size()[0], self.supply, basicblock.size()[2], basicblock.size()[3]))
-#    else:
-#      print(self.i)
-#      pass
-#    out = self.out.cuda()
-#    time2 = time.time()
-#    print ('function took %0.3f ms' % ((time2-time1)*1000.0))
-#    self.time.append((time2-time1)*1000.0)
-#    self.sum.append(sum(self.time))
-#    print("sum:",self.sum)
-#    print('                                            self.time %f',self.time)
-#    time2 = time.time()
-#
-#    self.out = torch.autograd.Variable(torch.rand(basicblock.size()[0], self.supply, basicblock.size()[2], basicblock.size()[3]))
-#    out = self.out.cuda()
-#    time3 = time.time()
-#    print ('function                 took %0.3f ms' % ((time2-time1)*1000.0))
-#
-#    print ('function took %0.3f ms' % ((time3-time2)*1000.0))
-#    self.time .append((time3-time2)*1000.0)
-#    #print('                                            self.time %f',self.time)
-##    print("sum:",sum(self.time))
-#    self.sum .append(sum(self.time))
-#    print(self.sum)
-    return F.relu(out, inplace=True)
+
+    # constants of the whole output stream before the ReLU; DownsampleA pads the stream with zeros
+    value = F.pad(constant, (0, self.planes - constant.numel()))
+    if self.bn_b_pruned is not None:
+      value = value.index_add(0, self.pruned_b, zero_response(self.bn_b_pruned))
+    out = F.relu(join(residual, self.res_index, basicblock, value[self.stream_out]), inplace=True)
+    return out, F.relu(value.index_fill(0, self.stream_out, 0))
 
 class CifarResNet(nn.Module):
   """
-  ResNet optimized for the Cifar dataset, as specified in
-  https://arxiv.org/abs/1512.03385.pdf
+  Slim ResNet for the Cifar dataset: a models.resnet.CifarResNet with its pruned filters removed
   """
-  def __init__(self, block, depth, num_classes, index, rate=[16, 16, 32, 64, 16, 32, 64]):
+  def __init__(self, block, depth, num_classes, widths=None, stream=None, plain=None):
     """ Constructor
     Args:
       depth: number of layers.
       num_classes: number of classes
-      base_width: base width
+      widths: number of unpruned filters of every conv, in model order
+        (conv_1_3x3, then conv_a and conv_b of every block); None for the unpruned model
+      stream: number of live residual stream channels after every block; None for all of them
+      plain: whether every block adds its input to the output stream as is; None for the blocks
+        keeping the stream width
     """
     super(CifarResNet, self).__init__()
 
-    #Model type specifies number of layers for CIFAR-10 and CIFAR-100 model   
+    #Model type specifies number of layers for CIFAR-10 and CIFAR-100 model
     assert (depth - 2) % 6 == 0, 'depth should be one of 20, 32, 44, 56, 110'
     layer_blocks = (depth - 2) // 6
-    self.stage_num = (depth - 2) // 3
     print ('CifarResNet : Depth : {} , Layers for each block : {}'.format(depth, layer_blocks))
+
     self.num_classes = num_classes
-    self.rate = rate
-    print(layer_blocks)
-    self.conv_1_3x3 = nn.Conv2d(3, rate[0], kernel_size=3, stride=1, padding=1, bias=False)
-    self.bn_1 = nn.BatchNorm2d(rate[0])
-    self.inplanes = rate[0]
-    self.stage_1 = self._make_layer(block, rate[4], rate[1], rate[4], index, layer_blocks, 1)
-    self.stage_2 = self._make_layer(block, rate[5], rate[2], rate[5], index, layer_blocks, 2)
-    self.stage_3 = self._make_layer(block, rate[6], rate[3], rate[6], index, layer_blocks, 2)
+    planes = [16] + [plane for plane in (16, 32, 64) for i in range(2 * layer_blocks)]
+    self.widths = planes if widths is None else list(widths)
+    self.stream = planes[2::2] if stream is None else list(stream)
+    assert len(self.widths) == len(planes), 'widths should give {} conv widths'.format(len(planes))
+    assert len(self.stream) == 3 * layer_blocks, 'stream should give {} stream widths'.format(3 * layer_blocks)
+    streams = [self.widths[0]] + self.stream
+    self.plain = [streams[i] == streams[i + 1] for i in range(3 * layer_blocks)] if plain is None else list(plain)
+
+    self.conv_1_3x3 = nn.Conv2d(3, self.widths[0], kernel_size=3, stride=1, padding=1, bias=False)
+    self.bn_1 = nn.BatchNorm2d(self.widths[0])
+    # the BN channels of the pruned stem filters, for the constants of the stream
+    self.bn_1_pruned = nn.BatchNorm2d(16 - self.widths[0]) if self.widths[0] < 16 else None
+    self.register_buffer('stem_pruned', torch.arange(self.widths[0], 16))
+
+    self.inplanes = 16
+    self.inlive = self.widths[0]
+    self.stage_1 = self._make_layer(block, 16, layer_blocks, 0, 1)
+    self.stage_2 = self._make_layer(block, 32, layer_blocks, layer_blocks, 2)
+    self.stage_3 = self._make_layer(block, 64, layer_blocks, 2 * layer_blocks, 2)
     self.avgpool = nn.AvgPool2d(8)
-    self.classifier = nn.Linear(64*block.expansion, num_classes)
+    self.classifier = nn.Linear(self.inlive*block.expansion, num_classes)
+    # the classifier weights of the constant stream channels, which the average pool keeps constant
+    self.register_buffer('dead_out', torch.arange(self.inlive, self.inplanes))
+    self.classifier_residue = nn.Parameter(torch.zeros(num_classes, self.inplanes - self.inlive))
 
     for m in self.modules():
       if isinstance(m, nn.Conv2d):
@@ -136,74 +167,88 @@ class CifarResNet(nn.Module):
         init.kaiming_normal(m.weight)
         m.bias.data.zero_()
 
-  def _make_layer(self, block, inplanes, planes, supply, index, blocks, stride=1):
+  def _make_layer(self, block, planes, blocks, first, stride=1):
     downsample = None
-    if stride != 1 :
-        
-      downsample = DownsampleA(self.inplanes, planes * block.expansion, stride)
-    layers = []
-
-#    print('first inplane, out plane, supply', self.inplanes,planes,supply)
-    
-    layers.append(block(self.inplanes, planes, supply, index, stride, downsample))
-#    self.inplanes = planes * block.expansion
+    if stride != 1:
+      # the zero channels DownsampleA would concatenate are constant, so only the subsampling is left
+      downsample = nn.AvgPool2d(kernel_size=1, stride=stride)
 
-    self.inplanes = inplanes 
-#    print('seconde inplane, out plane,supply', self.inplanes,planes,supply)
-    for i in range(1, blocks):
-      layers.append(block(self.inplanes, planes, supply, index))
+    layers = []
+    for i in range(first, first + blocks):
+      layers.append(block(self.inplanes, self.inlive, planes, self.widths[1 + 2 * i], self.widths[2 + 2 * i],
+                          self.stream[i], stride if i == first else 1, downsample if i == first else None,
+                          self.plain[i]))
+      self.inplanes, self.inlive = planes * block.expansion, self.stream[i]
 
     return nn.Sequential(*layers)
 
   def forward(self, x):
     x = self.conv_1_3x3(x)
     x = F.relu(self.bn_1(x), inplace=True)
-#    print(x.size())
-#    x = torch.autograd.Variable(torch.rand(x.size()[0], 16, x.size()[2], x.size()[3])).cuda()
-
-    x = self.stage_1(x)
-    x = self.stage_2(x)
-    x = self.stage_3(x)
+    constant = x.new_zeros(16)
+    if self.bn_1_pruned is not None:
+      constant = F.relu(constant.index_add(0, self.stem_pruned, zero_response(self.bn_1_pruned)))
+    for stage in (self.stage_1, self.stage_2, self.stage_3):
+      for block in stage:
+        x, constant = block(x, constant)
     x = self.avgpool(x)
     x = x.view(x.size(0), -1)
-    return self.classifier(x)
+    x = self.classifier(x)
+    if self.dead_out.numel() > 0:
+      x = x + F.linear(constant[self.dead_out], self.classifier_residue)
+    return x
 
-def resnet20_small(index, rate,num_classes=10):
-  """Constructs a ResNet-20 model for CIFAR-10 (by default)
+def resnet20_small(num_classes=10, widths=None, stream=None, plain=None):
+  """Constructs a slim ResNet-20 model for CIFAR-10 (by default)
   Args:
     num_classes (uint): number of classes
+    widths (list): number of unpruned filters of every conv
+    stream (list): number of live residual stream channels after every block
+    plain (list): whether every block adds its input to the output stream as is
   """
-  model = CifarResNet(ResNetBasicblock, 20, num_classes, index, rate)
+  model = CifarResNet(ResNetBasicblock, 20, num_classes, widths, stream, plain)
   return model
 
-def resnet32_small(index, rate,num_classes=10):
-  """Constructs a ResNet-32 model for CIFAR-10 (by default)
+def resnet32_small(num_classes=10, widths=None, stream=None, plain=None):
+  """Constructs a slim ResNet-32 model for CIFAR-10 (by default)
   Args:
     num_classes (uint): number of classes
+    widths (list): number of unpruned filters of every conv
+    stream (list): number of live residual stream channels after every block
+    plain (list): whether every block adds its input to the output stream as is
   """
-  model = CifarResNet(ResNetBasicblock, 32, num_classes,index, rate)
+  model = CifarResNet(ResNetBasicblock, 32, num_classes, widths, stream, plain)
   return model
 
-def resnet44_small(index, rate,num_classes=10):
-  """Constructs a ResNet-44 model for CIFAR-10 (by default)
+def resnet44_small(num_classes=10, widths=None, stream=None, plain=None):
+  """Constructs a slim ResNet-44 model for CIFAR-10 (by default)
   Args:
     num_classes (uint): number of classes
+    widths (list): number of unpruned filters of every conv
+    stream (list): number of live residual stream channels after every block
+    plain (list): whether every block adds its input to the output stream as is
   """
-  model = CifarResNet(ResNetBasicblock, 44, num_classes,index, rate)
+  model = CifarResNet(ResNetBasicblock, 44, num_classes, widths, stream, plain)
   return model
 
-def resnet56_small(index, rate,num_classes=10):
-  """Constructs a ResNet-56 model for CIFAR-10 (by default)
+def resnet56_small(num_classes=10, widths=None, stream=None, plain=None):
+  """Constructs a slim ResNet-56 model for CIFAR-10 (by default)
   Args:
     num_classes (uint): number of classes
+    widths (list): number of unpruned filters of every conv
+    stream (list): number of live residual stream channels after every block
+    plain (list): whether every block adds its input to the output stream as is
   """
-  model = CifarResNet(ResNetBasicblock, 56, num_classes,index, rate)
+  model = CifarResNet(ResNetBasicblock, 56, num_classes, widths, stream, plain)
   return model
 
-def resnet110_small(index, rate,num_classes=10):
-  """Constructs a ResNet-110 model for CIFAR-10 (by default)
+def resnet110_small(num_classes=10, widths=None, stream=None, plain=None):
+  """Constructs a slim ResNet-110 model for CIFAR-10 (by default)
   Args:
     num_classes (uint): number of classes
+    widths (list): number of unpruned filters of every conv
+    stream (list): number of live residual stream channels after every block
+    plain (list): whether every block adds its input to the output stream as is
   """
-  model = CifarResNet(ResNetBasicblock, 110, num_classes,index, rate)
+  model = CifarResNet(ResNetBasicblock, 110, num_classes, widths, stream, plain)
   return model
@@ -0,0 +1,85 @@
+"""Pack an ImageFolder ImageNet (train/ and val/) into shard files for pruning_imagenet.py:
+
+    python pack_imagenet.py --data /path/to/ILSVRC2012 --out /path/to/packed"""
+import argparse
+import functools
+import os
+import random
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torchvision.datasets as datasets
+from PIL import Image
+
+parser = argparse.ArgumentParser(description='Pack ImageNet into memory-mappable shards')
+parser.add_argument('--data', metavar='DIR', required=True, help='ImageFolder root with train/ and val/')
+parser.add_argument('--out', metavar='DIR', required=True, help='folder of the packed train/ and val/')
+parser.add_argument('--mode', default='jpeg', choices=['jpeg', 'uint8'],
+                    help='jpeg: original JPEG bytes; uint8: pixels resized to a shorter side of --size')
+parser.add_argument('--size', type=int, default=256, help='shorter side of the uint8 images')
+parser.add_argument('--shard_mb', type=float, default=1024, help='size of a shard file')
+parser.add_argument('--workers', type=int, default=8, help='processes reading and resizing the images')
+parser.add_argument('--seed', type=int, default=0, help='seed of the order of the train images')
+parser.add_argument('--splits', nargs='+', default=['train', 'val'], help='splits to pack')
+
+
+def encode(item, mode, size):
+    """(bytes, height, width, label) of one ImageFolder sample."""
+    path, label = item
+    if mode == 'jpeg':
+        with open(path, 'rb') as f:
+            data = f.read()
+        # only the header is read
+        width, height = Image.open(path).size
+        return data, height, width, label
+    image = Image.open(path).convert('RGB')
+    width, height = image.size
+    if width < height:
+        width, height = size, int(size * height / width)
+    else:
+        width, height = int(size * width / height), size
+    # the default interpolation of transforms.Resize
+    image = image.resize((width, height), Image.BILINEAR)
+    return image.tobytes(), height, width, label
+
+
+def pack_split(folder, out, mode, size, shard_bytes, workers, shuffle=False, seed=0):
+    folder = datasets.ImageFolder(folder)
+    samples = list(folder.samples)
+    if shuffle:
+        random.Random(seed).shuffle(samples)
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    count = len(samples)
+    shard, offset = np.zeros(count, np.int32), np.zeros(count, np.int64)
+    length, height, width = np.zeros(count, np.int64), np.zeros(count, np.int32), np.zeros(count, np.int32)
+    label = np.zeros(count, np.int64)
+    current, position = 0, 0
+    f = open(os.path.join(out, 'shard-{:05d}.bin'.format(current)), 'wb')
+    start = time.time()
+    with Pool(workers) as pool:
+        records = pool.imap(functools.partial(encode, mode=mode, size=size), samples, chunksize=64)
+        for i, record in enumerate(records):
+            data, height[i], width[i], label[i] = record
+            if position > 0 and position + len(data) > shard_bytes:
+                f.close()
+                current, position = current + 1, 0
+                f = open(os.path.join(out, 'shard-{:05d}.bin'.format(current)), 'wb')
+            f.write(data)
+            shard[i], offset[i], length[i] = current, position, len(data)
+            position += len(data)
+            if (i + 1) % 10000 == 0:
+                print('{}: {}/{} images, {:.0f} images/s'.format(out, i + 1, count, (i + 1) / (time.time() - start)))
+    f.close()
+    # written last: loaders.is_packed only sees complete splits
+    np.savez(os.path.join(out, 'index.npz'), shard=shard, offset=offset, length=length, height=height,
+             width=width, label=label, classes=np.array(folder.classes), mode=np.array(mode))
+    print('{}: {} images in {} shards, {:.1f} GB'.format(out, count, current + 1, length.sum() / 2 ** 30))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for split in args.splits:
+        pack_split(os.path.join(args.data, split), os.path.join(args.out, split), args.mode, args.size,
+                   int(args.shard_mb * 2 ** 20), args.workers, shuffle=split == 'train', seed=args.seed)
@@ -0,0 +1,698 @@
+"""Parity checks and CPU benchmarks of the scoring, masking, compaction, folding, MAC counting and data
+loading helpers against the code they replace. Run all of them, or the named ones:
+
+    python parity_check.py [scoring|masked_sgd|compact|freeze|flops|loaders ...]
+"""
+import copy
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+from PIL import Image
+
+import models
+import models.imagenet_resnet as imagenet_resnet
+import models.vgg as imagenet_vgg
+import models.vgg_cifar10 as vgg_cifar10
+from compact import (channel_map, cifar_blocks, cifar_resnet_slices, compact_cifar_resnet, compact_optimizer,
+                     compact_vgg, resnet_small_from_checkpoint, vgg_cfg)
+from flops import count_macs, pruned_macs
+from loaders import (CachedLoader, DraftRandomResizedCrop, Prefetcher, ShardDataset, ShuffledShards, TensorLoader,
+                     augment, cache_val, has_val_cache, open_lazy)
+from masking import FusedMask, MaskedSGD, filter_view, residual_groups
+from models.inference import freeze
+from models.resnet import CifarResNet, ResNetBasicblock
+from pack_imagenet import pack_split
+from scoring import (DIST_TYPES, SCORE_DTYPES, SCORE_MODES, _DENSE_TEMPORARIES, batch_filter_scores,
+                     batch_multi_filter_scores, filter_scores, multi_filter_scores, pruned_mismatch, rank_filters,
+                     scipy_filter_scores, sketch_dim, sketch_dim_if_faster)
+
+
+def time_forward(model, inputs, repeat=20, warmup=3):
+    """Median wall time (s) of one no-grad forward of ``inputs``."""
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            start = time.time()
+            model(inputs)
+            times.append(time.time() - start)
+    return sorted(times[warmup:])[repeat // 2]
+
+
+def random_masked(model, rate, seed=0, groups=()):
+    """Randomize the BN statistics of ``model`` and zero a ``rate`` of the filters of every conv, like
+    ``Mask.do_similar_mask``; the convs of every group in ``groups`` (parameter indices, as given by
+    ``masking.residual_groups``) share their mask. Returns the pruned_index."""
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    leader = {index: group[0] for group in groups for index in group}
+    pruned_index = {}
+    with torch.no_grad():
+        for index, param in enumerate(model.parameters()):
+            if param.dim() == 4:
+                if leader.get(index, index) in pruned_index:
+                    pruned_index[index] = pruned_index[leader[index]]
+                else:
+                    pruned_index[index] = torch.randperm(param.size(0), generator=generator)[
+                                          :int(param.size(0) * rate)].tolist()
+                param[pruned_index[index]] = 0
+    # non-trivial statistics, so that the pruned filters have a non-zero BN output
+        for module in model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5, generator=generator)
+                module.running_var.uniform_(0.5, 1.5, generator=generator)
+                module.weight.uniform_(0.5, 1.5, generator=generator)
+                module.bias.uniform_(-0.5, 0.5, generator=generator)
+    return pruned_index
+
+
+def report_macs(name, model, pruned_index, input_size, rate, small=None):
+    dense, masked, co_pruned = pruned_macs(model, pruned_index, input_size)
+    line = '{:<12s} rate {:.1f}: dense {:8.2f} M, masked {:8.2f} M ({:5.1%}), co-pruned {:8.2f} M ({:5.1%})'.format(
+        name, rate, dense / 1e6, masked / 1e6, masked / dense, co_pruned / 1e6, co_pruned / dense)
+    if small is not None:
+        line += ', compact {:8.2f} M'.format(count_macs(small, input_size) / 1e6)
+    print(line)
+
+
+def check_scoring():
+    # parity check of the torch engine against the scipy implementation
+    torch.manual_seed(0)
+    for shape in [(16, 16, 3, 3), (64, 32, 3, 3), (256, 64, 1, 1)]:
+        weight_vec = torch.randn(*shape).view(shape[0], -1)
+        pruned_num = shape[0] // 4
+        for dist_type in DIST_TYPES:
+            expected = scipy_filter_scores(weight_vec.double().numpy(), dist_type)
+            for mode in SCORE_MODES:
+                for name, dtype in SCORE_DTYPES.items():
+                    scores = filter_scores(weight_vec, dist_type, dtype, mode).double().numpy()
+                    rtol = 1e-8 if dtype == torch.float64 else 1e-4
+                    assert np.allclose(scores, expected, rtol=rtol, atol=rtol), (shape, dist_type, mode, name)
+                _, pruned = rank_filters(weight_vec, pruned_num, dist_type, mode=mode)
+                assert set(pruned.tolist()) == set(expected.argsort()[:pruned_num].tolist()), (shape, dist_type, mode)
+            print('{:>30s} {} ok'.format(dist_type, shape))
+
+    # near-duplicate filters keep their exact FPGM ranking in the Gram scorer, float32 requested or not
+    weight_vec = torch.randn(64, 64 * 9)
+    weight_vec[1::2] = weight_vec[::2] + 1e-2 * torch.randn(32, 64 * 9)
+    expected = scipy_filter_scores(weight_vec.double().numpy(), 'l2').argsort()
+    for dtype in SCORE_DTYPES.values():
+        for max_bytes in [None, 16 * 16 * 8 * _DENSE_TEMPORARIES]:
+            scores = filter_scores(weight_vec, 'l2', dtype, 'gram', max_bytes)
+            assert scores.dtype == dtype and np.array_equal(scores.argsort().numpy(), expected), (dtype, max_bytes)
+
+    # batched scoring of same-shaped layers matches layer-by-layer scoring
+    weights = OrderedDict((index, torch.randn(16, 16, 3, 3)) for index in range(6))
+    weights[6] = torch.randn(32, 16, 3, 3)
+    for dist_type in DIST_TYPES:
+        for mode in SCORE_MODES:
+            batched = batch_filter_scores(weights, dist_type, mode=mode)
+            threaded = batch_filter_scores(weights, dist_type, mode=mode, max_bytes=16 * 16 * 8 * 4, workers=4)
+            for index, weight in weights.items():
+                single = filter_scores(weight.view(weight.size(0), -1), dist_type, mode=mode)
+                assert torch.allclose(batched[index], single), (dist_type, mode, index)
+                assert torch.equal(batched[index].argsort(), threaded[index].argsort()), (dist_type, mode, index)
+
+    # tiled scoring under a memory cap gives the same ranking as the dense path
+    weight_vec = torch.randn(300, 64 * 9)
+    for dist_type in DIST_TYPES:
+        dense = filter_scores(weight_vec, dist_type, mode='gram')
+        tiled = filter_scores(weight_vec, dist_type, mode='gram', max_bytes=64 * 64 * 8 * _DENSE_TEMPORARIES)
+        assert torch.allclose(dense, tiled) and torch.equal(dense.argsort(), tiled.argsort()), dist_type
+
+    # a sketched Gram stays close to the exact one and prunes nearly the same filters
+    weight_vec = torch.randn(1024, 512 * 9)
+    for eps in [0.3, 0.5]:
+        assert sketch_dim_if_faster(1024, 512 * 9, eps) is not None, eps
+        for dist_type in DIST_TYPES:
+            _, pruned = rank_filters(weight_vec, 512, dist_type, mode='gram', sketch_eps=eps)
+            mismatch = pruned_mismatch(weight_vec, pruned, dist_type, mode='gram')
+            batched = filter_scores(torch.stack([weight_vec, weight_vec]), dist_type, sketch_eps=eps)
+            tiled = filter_scores(weight_vec, dist_type, sketch_eps=eps, max_bytes=256 * 256 * 8 * _DENSE_TEMPORARIES)
+            assert torch.allclose(batched[0], tiled) and torch.allclose(batched[1], tiled), (dist_type, eps)
+            print('{:>30s} eps={} k={}: {}/512 pruned filters differ'.format(
+                dist_type, eps, sketch_dim(1024, eps), mismatch))
+    # layers where sketching would not pay off are scored exactly
+    weight_vec = torch.randn(128, 512 * 9)
+    assert sketch_dim_if_faster(128, 512 * 9, 0.3) is None
+    assert torch.equal(filter_scores(weight_vec, 'l2', mode='gram', sketch_eps=0.3),
+                       filter_scores(weight_vec, 'l2', mode='gram'))
+
+    # the sketched path is faster than the exact one where it is used
+    weight_vec = torch.randn(2048, 512 * 9)
+    for eps in [0.3, 0.5]:
+        filter_scores(weight_vec, 'proposed_one_abs_cos', mode='gram', sketch_eps=eps)  # draws the projection
+        timings = []
+        for sketch_eps in [None, eps]:
+            start = time.time()
+            filter_scores(weight_vec, 'proposed_one_abs_cos', mode='gram', sketch_eps=sketch_eps)
+            timings.append(time.time() - start)
+        print('N=2048 D=4608 eps={} k={}: exact {:.3f}s, sketched {:.3f}s'.format(
+            eps, sketch_dim(2048, eps), *timings))
+        assert timings[1] < timings[0], (eps, timings)
+
+    # all the criteria from one shared Gram matrix match scoring them one by one
+    weight_vec = torch.randn(3, 96, 64 * 9)
+    for max_bytes, eps in [(None, None), (48 * 48 * 8 * _DENSE_TEMPORARIES, None), (None, 0.3)]:
+        multi = multi_filter_scores(weight_vec, max_bytes=max_bytes, sketch_eps=eps)
+        batched = batch_multi_filter_scores(OrderedDict(enumerate(weight_vec)), max_bytes=max_bytes, sketch_eps=eps)
+        for dist_type in DIST_TYPES:
+            single = filter_scores(weight_vec, dist_type, mode='gram', max_bytes=max_bytes, sketch_eps=eps)
+            assert torch.allclose(multi[dist_type], single), (dist_type, max_bytes, eps)
+            for index, layer in enumerate(single):
+                assert torch.allclose(batched[dist_type][index], layer), (dist_type, max_bytes, eps, index)
+    print('parity check passed')
+
+
+def check_masked_sgd():
+    # MaskedSGD against SGD with masked gradients on a random mask of a ResNet-56: same kept rows, pruned
+    # rows exactly zero, and the optimizer state and step time it saves
+    torch.manual_seed(0)
+    model = models.resnet56(10)
+    params = list(model.parameters())
+    masks = {}
+    for index, param in enumerate(params):
+        if param.dim() == 4:
+            keep = torch.rand(param.size(0)) > 0.5
+            keep[0] = True
+            masks[param] = keep
+            param.data.mul_(filter_view(keep, param.dim()).to(param.dtype))
+    fused = FusedMask(masks.keys(), masks.values())
+    reference = [param.data.clone() for param in params]
+
+    def run(optimizer, mask_grads, steps=5):
+        torch.manual_seed(1)
+        start = time.time()
+        for step in range(steps):
+            optimizer.zero_grad()
+            model(torch.randn(8, 3, 32, 32)).pow(2).mean().backward()
+            if mask_grads:
+                fused.apply_grad_()
+            optimizer.step()
+        return time.time() - start
+
+    def state_numel(optimizer):
+        return sum(state['momentum_buffer'].numel() for state in optimizer.state.values()
+                   if 'momentum_buffer' in state)
+
+    sgd = torch.optim.SGD(params, 0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
+    sgd_time = run(sgd, True)
+    expected = [param.data.clone() for param in params]
+    for param, value in zip(params, reference):
+        param.data.copy_(value)
+    masked = MaskedSGD(params, 0.1, momentum=0.9, weight_decay=5e-4, nesterov=True, masks=masks)
+    masked_time = run(masked, False)
+    for param, value in zip(params, expected):
+        assert torch.allclose(param.data, value, atol=1e-6), 'MaskedSGD differs from masked SGD'
+    for param, keep in masks.items():
+        assert param.data[~keep].abs().sum() == 0, 'pruned filters changed'
+    plain = torch.optim.SGD(params, 0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
+    plain.load_state_dict(masked.state_dict())
+    for param in params:
+        assert plain.state[param]['momentum_buffer'].size() == param.size(), 'saved momentum is not full width'
+    masked.load_state_dict(sgd.state_dict())
+    assert state_numel(masked) < state_numel(sgd), 'loaded momentum is not sliced'
+    print('momentum state: SGD {} floats, MaskedSGD {} floats'.format(state_numel(sgd), state_numel(masked)))
+    print('5 steps: SGD + grad mask {:.3f} s, MaskedSGD {:.3f} s'.format(sgd_time, masked_time))
+
+
+def check_compact():
+    # the compact model gives the logits of the masked model, and runs faster on CPU
+    torch.manual_seed(0)
+    inputs = torch.randn(128, 3, 32, 32)
+    for depth in [20, 56, 110]:
+        for rate in [0.3, 0.5, 0.7]:
+            model = CifarResNet(ResNetBasicblock, depth, 10)
+            pruned_index = random_masked(model, rate)
+            model.eval()
+            small = compact_cifar_resnet(model, pruned_index).eval()
+            with torch.no_grad():
+                expected, logits = model(inputs), small(inputs)
+            assert torch.allclose(expected, logits, rtol=1e-4, atol=1e-4), \
+                (depth, rate, (expected - logits).abs().max().item())
+            masked_time, small_time = time_forward(model, inputs), time_forward(small, inputs)
+            print('resnet{:<3d} rate {:.1f}: max |diff| {:.2e}, masked {:.1f} ms, compact {:.1f} ms, '
+                  'speedup {:.2f}x'.format(depth, rate, (expected - logits).abs().max().item(),
+                                           masked_time * 1000, small_time * 1000, masked_time / small_time))
+
+    # with one mask per residual stream only the first block of stages 2 and 3 has to scatter its input
+    for depth in [20, 56, 110]:
+        model = CifarResNet(ResNetBasicblock, depth, 10)
+        pruned_index = random_masked(model, 0.5, groups=residual_groups(model))
+        model.eval()
+        small = compact_cifar_resnet(model, pruned_index).eval()
+        with torch.no_grad():
+            expected, logits = model(inputs), small(inputs)
+        assert torch.allclose(expected, logits, rtol=1e-4, atol=1e-4), \
+            (depth, (expected - logits).abs().max().item())
+        layer_blocks = len(model.stage_1)
+        assert [i for i, plain in enumerate(small.plain) if not plain] == [layer_blocks, 2 * layer_blocks], depth
+        masked_time, small_time = time_forward(model, inputs), time_forward(small, inputs)
+        print('resnet{:<3d} shared masks: masked {:.1f} ms, compact {:.1f} ms, speedup {:.2f}x'.format(
+            depth, masked_time * 1000, small_time * 1000, masked_time / small_time))
+
+    # the momentum buffers follow the parameters into the slim model
+    model = CifarResNet(ResNetBasicblock, 20, 10)
+    pruned_index = random_masked(model, 0.5)
+    optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
+    model(inputs).sum().backward()
+    optimizer.step()
+    small = compact_cifar_resnet(model, pruned_index)
+    compact = compact_optimizer(optimizer, model, small, cifar_resnet_slices(model, pruned_index))
+    for name, param in small.named_parameters():
+        assert compact.state[param]['momentum_buffer'].size() == param.size(), name
+    channels = channel_map(model, pruned_index)
+    assert len(channels['stage_3.2.stream']) == small.classifier.in_features
+
+    # the compact model also trains like the masked model: the constants of the pruned channels follow
+    # their BN parameters and statistics, and the weights reading them keep training
+    for depth in [20, 56]:
+        model = CifarResNet(ResNetBasicblock, depth, 10)
+        pruned_index = random_masked(model, 0.5)
+        optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9, weight_decay=5e-4, nesterov=True)
+        small = compact_cifar_resnet(model, pruned_index)
+        compact = compact_optimizer(optimizer, model, small, cifar_resnet_slices(model, pruned_index))
+        params = list(model.parameters())
+        for step in range(3):
+            expected, logits = model(inputs), small(inputs)
+            assert torch.allclose(expected, logits, rtol=1e-3, atol=1e-3), \
+                (depth, step, (expected - logits).abs().max().item())
+            optimizer.zero_grad()
+            compact.zero_grad()
+            expected.pow(2).mean().backward()
+            logits.pow(2).mean().backward()
+            for index, pruned in pruned_index.items():
+                params[index].grad[pruned] = 0
+            optimizer.step()
+            compact.step()
+        with torch.no_grad():
+            expected, logits = model.eval()(inputs), small.eval()(inputs)
+        assert torch.allclose(expected, logits, rtol=1e-3, atol=1e-3), (depth, (expected - logits).abs().max().item())
+
+    # the masked conv mode of models/resnet.py trains like the masked model, at close to compact speed
+    def time_step(model, inputs, repeat=5):
+        times = []
+        for i in range(repeat + 1):
+            start = time.time()
+            model(inputs).pow(2).mean().backward()
+            times.append(time.time() - start)
+        return sorted(times[1:])[repeat // 2]
+
+    for depth in [20, 56, 110]:
+        model = CifarResNet(ResNetBasicblock, depth, 10)
+        pruned_index = random_masked(model, 0.5)
+        fast = copy.deepcopy(model)
+        fast.skip_pruned(pruned_index)
+        expected, outputs = model(inputs), fast(inputs)
+        assert torch.allclose(expected, outputs, rtol=1e-4, atol=1e-4), (depth, 'train')
+        expected.pow(2).mean().backward()
+        outputs.pow(2).mean().backward()
+        assert torch.allclose(model.classifier.weight.grad, fast.classifier.weight.grad, rtol=1e-3, atol=1e-5)
+        for block, fast_block in zip(cifar_blocks(model), cifar_blocks(fast)):
+            kept_a, kept_b = fast_block.perm_a[:fast_block.kept_a], fast_block.perm_b[:fast_block.kept_b]
+            assert torch.allclose(block.conv_b.weight.grad[kept_b][:, fast_block.perm_a],
+                                  fast_block.conv_b.weight.grad[:fast_block.kept_b], rtol=1e-3, atol=1e-5)
+            assert torch.allclose(block.conv_a.weight.grad[kept_a], fast_block.conv_a.weight.grad[:fast_block.kept_a],
+                                  rtol=1e-3, atol=1e-5)
+        with torch.no_grad():
+            expected, outputs = model.eval()(inputs), fast.eval()(inputs)
+        assert torch.allclose(expected, outputs, rtol=1e-4, atol=1e-4), (depth, 'eval')
+        fast.skip_pruned(None)
+        for (name, value), fast_value in zip(model.state_dict().items(), fast.state_dict().values()):
+            assert torch.allclose(value.float(), fast_value.float(), rtol=1e-5, atol=1e-6), name
+        fast.skip_pruned(pruned_index)
+        small = compact_cifar_resnet(model, pruned_index)
+        model.train(), fast.train(), small.train()
+        masked_time, fast_time, small_time = time_step(model, inputs), time_step(fast, inputs), time_step(small, inputs)
+        print('resnet{:<3d} train step: masked {:.1f} ms, kept filters {:.1f} ms, compact {:.1f} ms'.format(
+            depth, masked_time * 1000, fast_time * 1000, small_time * 1000))
+
+    # the slim VGG built from the masks gives the logits of the masked VGG
+    for depth in [16, 19]:
+        for rate in [0.3, 0.5, 0.7]:
+            model = vgg_cifar10.vgg(depth=depth)
+            pruned_index = random_masked(model, rate)
+            model.eval()
+            small = compact_vgg(model, pruned_index).eval()
+            with torch.no_grad():
+                expected, logits = model(inputs), small(inputs)
+            assert torch.allclose(expected, logits, rtol=1e-4, atol=1e-4), \
+                (depth, rate, (expected - logits).abs().max().item())
+            masked_time, small_time = time_forward(model, inputs), time_forward(small, inputs)
+            print('vgg{} rate {:.1f}: cfg {}, MACs {:.1f}x fewer, speedup {:.2f}x'.format(
+                depth, rate, vgg_cfg(model, pruned_index), count_macs(model) / count_macs(small),
+                masked_time / small_time))
+
+    # the CP_5x and ThiNet-conv configurations of pruning_imagenet.py
+    cfgs = {'CP_5x': [24, 22, 41, 51, 108, 89, 111, 184, 276, 228, 512, 512, 512],
+            'Thinet_conv': [32, 32, 64, 64, 128, 128, 128, 256, 256, 256, 512, 512, 512]}
+    inputs_224 = torch.randn(2, 3, 224, 224)
+    for arch in ['vgg16', 'vgg16_bn']:
+        for style, cfg in cfgs.items():
+            model = imagenet_vgg.__dict__[arch]()
+            random_masked(model, 0)
+            generator = torch.Generator()
+            generator.manual_seed(0)
+            pruned_index = {}
+            with torch.no_grad():
+                convs = [(index, param) for index, param in enumerate(model.parameters()) if param.dim() == 4]
+                for (index, param), width in zip(convs, cfg):
+                    pruned_index[index] = torch.randperm(param.size(0), generator=generator)[width:].tolist()
+                    param[pruned_index[index]] = 0
+                for module in model.features:
+                    if isinstance(module, nn.Conv2d):
+                        module.bias.uniform_(-0.1, 0.1, generator=generator)
+            model.eval()
+            small = compact_vgg(model, pruned_index).eval()
+            with torch.no_grad():
+                expected, logits = model(inputs_224), small(inputs_224)
+            assert torch.allclose(expected, logits, rtol=1e-3, atol=1e-3), \
+                (arch, style, (expected - logits).abs().max().item())
+            masked_time, small_time = (time_forward(model, inputs_224, repeat=5, warmup=1),
+                                       time_forward(small, inputs_224, repeat=5, warmup=1))
+            print('{} {}: max |diff| {:.2e}, MACs {:.1f}x fewer, speedup {:.2f}x'.format(
+                arch, style, (expected - logits).abs().max().item(),
+                count_macs(model, (3, 224, 224)) / count_macs(small, (3, 224, 224)), masked_time / small_time))
+
+    # ImageNet ResNet_small rebuilt from a pruned checkpoint gives the masked model's logits
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    inputs = torch.randn(4, 3, 224, 224, device=device)
+    for arch in ['resnet18', 'resnet34', 'resnet50']:
+        model = imagenet_resnet.__dict__[arch]()
+        pruned_index = random_masked(model, 0.3)
+        small = resnet_small_from_checkpoint(arch, model.state_dict(), pruned_index).to(device)
+        model.to(device).eval()
+        with torch.no_grad():
+            expected, logits = model(inputs), small(inputs.clone())
+            zero_logits = resnet_small_from_checkpoint(arch, model.state_dict()).to(device)(inputs.clone())
+        assert torch.allclose(expected, logits, rtol=1e-3, atol=1e-3), \
+            (arch, (expected - logits).abs().max().item())
+        assert torch.allclose(logits, zero_logits), arch
+        print('{}: max |diff| {:.2e}'.format(arch, (expected - logits).abs().max().item()))
+    print('compaction check passed')
+
+
+def check_freeze():
+    # CPU latency of the eval models before and after freezing; the frozen ones give the same logits
+
+    def report(name, model, inputs, repeat=20, warmup=3):
+        model.eval()
+        frozen = freeze(model)
+        with torch.no_grad():
+            expected, outputs = model(inputs), frozen(inputs)
+        diff = (expected - outputs).abs().max().item()
+        assert torch.allclose(expected, outputs, rtol=1e-3, atol=1e-3), (name, diff)
+        eval_time, frozen_time = (time_forward(model, inputs, repeat, warmup),
+                                  time_forward(frozen, inputs, repeat, warmup))
+        print('{:<22s} max |diff| {:.2e}, eval {:7.1f} ms, frozen {:7.1f} ms, speedup {:.2f}x'.format(
+            name, diff, eval_time * 1000, frozen_time * 1000, eval_time / frozen_time))
+
+    torch.manual_seed(0)
+    inputs = torch.randn(64, 3, 32, 32)
+    for depth in [20, 56, 110]:
+        model = models.__dict__['resnet{}'.format(depth)](10)
+        pruned_index = random_masked(model, 0.5)
+        report('resnet{}'.format(depth), model, inputs)
+        report('resnet{} compact'.format(depth), compact_cifar_resnet(model.eval(), pruned_index), inputs)
+    model = models.vgg(depth=16)
+    pruned_index = random_masked(model, 0.5)
+    report('vgg16', model, inputs)
+    report('vgg16 compact', compact_vgg(model.eval(), pruned_index), inputs)
+
+    inputs = torch.randn(4, 3, 224, 224)
+    for arch in ['resnet18', 'resnet50']:
+        model = imagenet_resnet.__dict__[arch]()
+        pruned_index = random_masked(model, 0.3)
+        report(arch, model, inputs, 5, 1)
+        report(arch + ' compact', resnet_small_from_checkpoint(arch, model.state_dict(), pruned_index), inputs, 5, 1)
+    model = imagenet_vgg.vgg16_bn()
+    pruned_index = random_masked(model, 0.5)
+    report('vgg16_bn', model, inputs, 5, 1)
+    report('vgg16_bn compact', compact_vgg(model.eval(), pruned_index), inputs, 5, 1)
+
+
+def check_flops():
+    # FLOPs before and after pruning every supported arch, with a random rate of the filters of every conv
+    # pruned; the compact CIFAR ResNets and VGGs run exactly the co-pruned MACs
+    rates = [0.3, 0.5, 0.7]
+    for depth in [20, 32, 44, 56, 110]:
+        for rate in rates:
+            model = models.__dict__['resnet{}'.format(depth)](10)
+            pruned_index = random_masked(model, rate)
+            small = compact_cifar_resnet(model, pruned_index).eval()
+            report_macs('resnet{}'.format(depth), model, pruned_index, (3, 32, 32), rate, small)
+            assert count_macs(small) == pruned_macs(model, pruned_index)[2], (depth, rate)
+            # the all-zero filters give the same masks back
+            assert pruned_macs(model) == pruned_macs(model, pruned_index), (depth, rate)
+            # one mask per residual stream (Mask --share_residual_masks) also narrows the stream itself
+            model = models.__dict__['resnet{}'.format(depth)](10)
+            pruned_index = random_masked(model, rate, groups=residual_groups(model))
+            small = compact_cifar_resnet(model, pruned_index).eval()
+            report_macs('  shared', model, pruned_index, (3, 32, 32), rate, small)
+            assert count_macs(small) == pruned_macs(model, pruned_index)[2], (depth, rate, 'shared')
+    for depth in [16, 19]:
+        for rate in rates:
+            model = models.vgg(depth=depth)
+            pruned_index = random_masked(model, rate)
+            small = compact_vgg(model.eval(), pruned_index).eval()
+            report_macs('vgg{}'.format(depth), model, pruned_index, (3, 32, 32), rate, small)
+            assert count_macs(small) == pruned_macs(model, pruned_index)[2], (depth, rate)
+
+    for arch in ['resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152']:
+        for rate in rates:
+            model = imagenet_resnet.__dict__[arch]()
+            pruned_index = random_masked(model, rate)
+            report_macs(arch, model, pruned_index, (3, 224, 224), rate)
+            model = imagenet_resnet.__dict__[arch]()
+            pruned_index = random_masked(model, rate, groups=residual_groups(model))
+            report_macs('  shared', model, pruned_index, (3, 224, 224), rate)
+    for arch in ['vgg16', 'vgg16_bn']:
+        for rate in rates:
+            model = models.__dict__[arch]()
+            pruned_index = random_masked(model, rate)
+            report_macs(arch, model, pruned_index, (3, 224, 224), rate)
+
+
+def check_loaders():
+    # the batched augmentation matches flip + padded crop image by image, its offsets and flips are uniform,
+    # and it outruns the per-sample PIL pipeline on a CIFAR-sized dataset
+    class Fake(object):
+        def __init__(self, count, size=32):
+            generator = np.random.RandomState(0)
+            self.data = generator.randint(0, 256, (count, size, size, 3)).astype(np.uint8)
+            self.targets = generator.randint(0, 10, count).tolist()
+
+        def __len__(self):
+            return len(self.data)
+
+        def __getitem__(self, index):
+            return self.transform(Image.fromarray(self.data[index])), self.targets[index]
+
+    images = torch.from_numpy(Fake(16).data)
+    flip = torch.tensor([True, False] * 8)
+    top, left = torch.randint(0, 9, (16,)), torch.randint(0, 9, (16,))
+    crops = augment(images, flip, top, left, 32, 4)
+    for i in range(16):
+        padded = F.pad(images[i], (0, 0, 4, 4, 4, 4))
+        expected = padded[top[i]:top[i] + 32, left[i]:left[i] + 32]
+        if flip[i]:
+            expected = expected.flip(1)
+        assert torch.equal(crops[i], expected), i
+
+    mean, std = [x / 255 for x in [125.3, 123.0, 113.9]], [x / 255 for x in [63.0, 62.1, 66.7]]
+    loader = TensorLoader(Fake(16), 16, mean, std)
+    reference = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)])
+    images, targets = next(iter(loader))
+    data = Fake(16)
+    assert torch.allclose(images, torch.stack([reference(Image.fromarray(image)) for image in data.data]), atol=1e-5)
+
+    # every offset and flip equally likely: all the pixels of the image differ, so a crop tells where it
+    # was taken and whether it was flipped
+    data = Fake(9000, 8)
+    data.data[:] = np.arange(8 * 8 * 3).reshape(8, 8, 3) + 1
+    loader = TensorLoader(data, 9000, [0, 0, 0], [1 / 255.] * 3, train=True, crop=8, padding=2, seed=1)
+    images, targets = next(iter(loader))
+    counts = {}
+    for image in images:
+        key = tuple(image.flatten().round().long().tolist())
+        counts[key] = counts.get(key, 0) + 1
+    assert len(counts) == 50, len(counts)
+    print('distinct crops: {}, min/max count {}/{} (expected {:.0f})'.format(
+        len(counts), min(counts.values()), max(counts.values()), 9000 / 50))
+
+    data = Fake(50000)
+    data.transform = transforms.Compose([transforms.RandomHorizontalFlip(), transforms.RandomCrop(32, padding=4),
+                                         transforms.ToTensor(), transforms.Normalize(mean, std)])
+    for workers in [0, 2]:
+        pil_loader = torch.utils.data.DataLoader(data, batch_size=128, shuffle=True, num_workers=workers)
+        start = time.time()
+        for i, batch in enumerate(pil_loader):
+            if i == 99:
+                break
+        print('PIL transforms, {} workers: {:.1f} ms per batch of 128'.format(workers, (time.time() - start) * 10))
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        loader = TensorLoader(data, 128, mean, std, train=True, device=device)
+        start = time.time()
+        for i, batch in enumerate(loader):
+            if i == 99:
+                break
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        print('TensorLoader on {}: {:.2f} ms per batch of 128'.format(device, (time.time() - start) * 10))
+
+    # a packed ImageFolder gives the same images and labels, and the shuffled stream covers it once per epoch
+    folder = tempfile.mkdtemp()
+    try:
+        generator = np.random.RandomState(0)
+        for c in range(3):
+            os.makedirs(os.path.join(folder, 'images', 'class{}'.format(c)))
+            for i in range(20):
+                size = tuple(generator.randint(40, 80, 2))
+                Image.fromarray(generator.randint(0, 256, size + (3,)).astype(np.uint8)).save(
+                    os.path.join(folder, 'images', 'class{}'.format(c), '{}.jpg'.format(i)))
+        reference = datasets.ImageFolder(os.path.join(folder, 'images'))
+        for mode in ['jpeg', 'uint8']:
+            out = os.path.join(folder, mode)
+            pack_split(os.path.join(folder, 'images'), out, mode, 48, 20000, 2)
+            packed = ShardDataset(out)
+            assert packed.classes == reference.classes and len(packed) == len(reference)
+            for i in range(len(reference)):
+                image, target = reference[i]
+                packed_image, packed_target = packed[i]
+                assert target == packed_target
+                if mode == 'jpeg':
+                    assert np.array_equal(np.asarray(image), np.asarray(packed_image)), i
+                else:
+                    assert min(packed_image.size) == 48, packed_image.size
+            for workers in [0, 2]:
+                stream = ShuffledShards(out, transforms.ToTensor(), buffer_size=8)
+                loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=workers)
+                orders = []
+                for epoch in range(2):
+                    stream.set_epoch(epoch)
+                    orders.append([int(image.sum() * 255 + 0.5) * 10 + target for image, target in loader])
+                    assert sorted(orders[-1]) == sorted(int(image.sum() * 255 + 0.5) * 10 + target
+                                                        for image, target in ShardDataset(out, transforms.ToTensor()))
+                assert orders[0] != orders[1]
+            print('{} shards: {} images in {} shards'.format(mode, len(packed), int(packed.shard.max()) + 1))
+
+        # the val cache serves the batches of the per-epoch val pipeline
+        crop = transforms.Compose([transforms.Resize(56), transforms.CenterCrop(48)])
+        reference = datasets.ImageFolder(os.path.join(folder, 'images'),
+                                         transforms.Compose([crop, transforms.ToTensor(),
+                                                             transforms.Normalize(mean, std)]))
+        meta = {'source': os.path.join(folder, 'images'), 'crop': repr(crop), 'length': len(reference)}
+        cache_val(datasets.ImageFolder(os.path.join(folder, 'images'), crop), os.path.join(folder, 'cache'), meta,
+                  batch_size=16, workers=2)
+        assert has_val_cache(os.path.join(folder, 'cache'), meta)
+        assert not has_val_cache(os.path.join(folder, 'cache'), dict(meta, length=len(reference) - 1))
+        batches = zip(torch.utils.data.DataLoader(reference, batch_size=16),
+                      CachedLoader(os.path.join(folder, 'cache'), 16, mean, std))
+        for (images, targets), (cached, cached_targets) in batches:
+            assert torch.equal(targets, cached_targets)
+            assert torch.allclose(images, cached, atol=1e-5)
+        print('val cache: {} images'.format(len(reference)))
+    finally:
+        shutil.rmtree(folder)
+
+    # the draft-mode crop draws the same boxes and gives close to the same pixels as decoding everything,
+    # at a fraction of the decode cost
+    folder = tempfile.mkdtemp()
+    try:
+        generator = np.random.RandomState(0)
+        paths = []
+        for i in range(40):
+            # smooth photo-like content at a typical ImageNet size
+            height, width = generator.randint(300, 500), 500
+            y, x = np.mgrid[0:height, 0:width]
+            image = np.stack([np.sin(x / (20. + c * 7) + generator.rand() * 6) * np.cos(y / (30. + c * 5)) for c in
+                              range(3)], 2) * 100 + 128 + generator.randn(height, width, 3) * 4
+            paths.append(os.path.join(folder, '{}.jpg'.format(i)))
+            Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(paths[-1], quality=90)
+
+        def pil_loader(path):
+            with open(path, 'rb') as f:
+                return Image.open(f).convert('RGB')
+
+        full = transforms.RandomResizedCrop(224)
+        draft = DraftRandomResizedCrop(224)
+        diffs = []
+        for path in paths:
+            for k in range(5):
+                random.seed(k)
+                torch.manual_seed(k)
+                expected = np.asarray(full(pil_loader(path)), dtype=np.float32)
+                random.seed(k)
+                torch.manual_seed(k)
+                image = np.asarray(draft(open_lazy(path)), dtype=np.float32)
+                diffs.append(np.abs(expected - image).mean())
+        print('draft crop: mean |diff| per pixel {:.2f} (max over crops {:.2f}) of 255'.format(
+            np.mean(diffs), np.max(diffs)))
+        assert np.mean(diffs) < 4, np.mean(diffs)
+
+        for name, loader, transform in [('full decode', pil_loader, full), ('draft decode', open_lazy, draft)]:
+            pipeline = transforms.Compose([transform, transforms.RandomHorizontalFlip(), transforms.ToTensor()])
+            start = time.time()
+            for repeat in range(5):
+                for path in paths:
+                    pipeline(loader(path))
+            print('{}: {:.0f} images/s per worker'.format(name, 5 * len(paths) / (time.time() - start)))
+    finally:
+        shutil.rmtree(folder)
+
+    # the prefetcher keeps the batches in order, passes loader errors on, and hides a loader as slow as the step
+    batches = list(Prefetcher(range(10), depth=3))
+    assert batches == list(range(10)), batches
+
+    def failing():
+        yield torch.zeros(1)
+        raise ValueError('loader error')
+
+    try:
+        list(Prefetcher(failing()))
+        assert False, 'the loader error was lost'
+    except ValueError:
+        pass
+    for i, batch in enumerate(Prefetcher(range(100), depth=2)):
+        if i == 3:
+            break
+
+    class Slow(object):
+        def __len__(self):
+            return 20
+
+        def __iter__(self):
+            for i in range(20):
+                time.sleep(0.01)
+                yield torch.full((4,), i)
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        for loader in [Slow(), Prefetcher(Slow(), device, depth=4)]:
+            start, waited = time.time(), 0.
+            end = time.time()
+            for batch in loader:
+                waited += time.time() - end
+                time.sleep(0.01)
+                end = time.time()
+            total = time.time() - start
+            print('{} {}: {:.0f} ms per step, {:.0%} data-bound'.format(
+                device, type(loader).__name__, total / 20 * 1000, waited / total))
+
+
+if __name__ == '__main__':
+    checks = sys.argv[1:] or ['scoring', 'masked_sgd', 'compact', 'freeze', 'flops', 'loaders']
+    for name in checks:
+        print('=> {}'.format(name))
+        globals()['check_' + name]()
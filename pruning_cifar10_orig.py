@@ -7,7 +7,7 @@ from utils import AverageMeter, RecorderMeter, time_string, convert_secs2time, t
 import models
 import numpy as np
 import pickle
-from scipy.spatial import distance
+from collections import OrderedDict
 import pdb
 
 model_names = sorted(name for name in models.__dict__
@@ -56,6 +56,44 @@ parser.add_argument('--use_state_dict', dest='use_state_dict', action='store_tru
 parser.add_argument('--use_pretrain', dest='use_pretrain', action='store_true', help='use pre-trained model or not')
 parser.add_argument('--pretrain_path', default='', type=str, help='..path of pre-trained model')
 parser.add_argument('--dist_type', default='l2', type=str,  help='distance type of GM')
+parser.add_argument('--score_dtype', default='float64', choices=['float32', 'float64'],
+                    help='precision of the pairwise filter scoring and of the scores (the Gram scoring always runs '
+                         'in float64)')
+parser.add_argument('--score_mode', default='gram', choices=['pairwise', 'gram'],
+                    help='pairwise: full criterion matrix; gram: closed form from one Gram matrix')
+parser.add_argument('--score_memory_mb', type=float, default=1024,
+                    help='memory cap of the scoring temporaries; larger layers are scored tile by tile (0: no cap)')
+parser.add_argument('--layerwise_scoring', dest='layerwise_scoring', action='store_true',
+                    help='score layers one by one instead of batching same-shaped layers')
+parser.add_argument('--ranking_cache', default='', type=str,
+                    help='folder of per-layer filter rankings shared across runs (empty: do not cache)')
+parser.add_argument('--grad_mask_hooks', dest='grad_mask_hooks', action='store_true',
+                    help='mask gradients with hooks during backward instead of after it')
+parser.add_argument('--sketch_eps', type=float, default=0,
+                    help='score from a random projection of the filters with this distortion bound, on the layers '
+                         'where that is cheaper than the exact Gram (0: exact)')
+parser.add_argument('--sketch_report', dest='sketch_report', action='store_true',
+                    help='log how many pruned filters per layer differ from the exact ranking')
+parser.add_argument('--mask_workers', type=int, default=1,
+                    help='threads scoring independent layers in parallel when building the masks')
+parser.add_argument('--all_criteria', dest='all_criteria', action='store_true',
+                    help='score every criterion in one pass and save all their rankings to the ranking cache')
+parser.add_argument('--share_residual_masks', dest='share_residual_masks', action='store_true',
+                    help='prune the convs summing into the same residual stream with one mask, '
+                         'scored on their joint filters')
+parser.add_argument('--compact_finetune', dest='compact_finetune', action='store_true',
+                    help='fine-tune the physically compacted model once the masks are applied; it trains '
+                         'like the masked model, pruned BN channels included')
+parser.add_argument('--skip_pruned', dest='skip_pruned', action='store_true',
+                    help='fine-tune the full-width model on its kept filters only (masked conv mode)')
+parser.add_argument('--masked_optimizer', dest='masked_optimizer', action='store_true',
+                    help='SGD keeping momentum and updating the kept filters only, instead of masking gradients')
+parser.add_argument('--tensor_loader', dest='tensor_loader', action='store_true',
+                    help='hold the dataset as one uint8 tensor on the GPU and augment whole batches there '
+                         '(no loader workers)')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='batches staged on the device ahead of the step by a background thread (0: off; '
+                         'ignored with --tensor_loader, whose batches are already on the device)')
 
 parser.add_argument('--exp', type=int, default=0, help='exp')
 
@@ -73,8 +111,16 @@ import torch
 import torch.backends.cudnn as cudnn
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
+from scoring import (filter_scores, batch_filter_scores, batch_multi_filter_scores, pruned_mismatch, map_layers,
+                     ranking_key, checkpoint_id, load_rankings, save_rankings, DIST_TYPES, SCORE_DTYPES)
+from masking import FilterCodebook, FusedMask, MaskedSGD, expand_filter_mask, residual_groups
+from compact import compact_cifar_resnet, cifar_resnet_slices, channel_map, compact_optimizer
+from loaders import TensorLoader, Prefetcher
 
 args.use_cuda = args.ngpu > 0 and torch.cuda.is_available()
+# the checkpoint the pruned weights come from keys the ranking cache (None: fingerprint the weights)
+args.weights_source = None
+args.score_max_bytes = int(args.score_memory_mb * 2 ** 20) or None
 
 if args.manualSeed is None:
     args.manualSeed = random.randint(1, 10000)
@@ -170,10 +216,22 @@ def main():
     else:
         assert False, 'Do not support dataset : {}'.format(args.dataset)
 
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=True,
-                                               num_workers=args.workers, pin_memory=True)
-    test_loader = torch.utils.data.DataLoader(test_data, batch_size=args.batch_size, shuffle=False,
-                                              num_workers=args.workers, pin_memory=True)
+    if args.tensor_loader:
+        # same flip, padded crop and normalization, applied to whole batches on the device
+        device = 'cuda' if args.use_cuda else 'cpu'
+        train_loader = TensorLoader(train_data, args.batch_size, mean, std, train=True, device=device,
+                                    seed=args.manualSeed)
+        test_loader = TensorLoader(test_data, args.batch_size, mean, std, device=device)
+    else:
+        train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=True,
+                                                   num_workers=args.workers, pin_memory=True)
+        test_loader = torch.utils.data.DataLoader(test_data, batch_size=args.batch_size, shuffle=False,
+                                                  num_workers=args.workers, pin_memory=True)
+    if args.prefetch > 0 and not args.tensor_loader:
+        # the next batches are collated and copied while the current step runs
+        device = 'cuda' if args.use_cuda else 'cpu'
+        train_loader = Prefetcher(train_loader, device, args.prefetch)
+        test_loader = Prefetcher(test_loader, device, args.prefetch)
 
     # print_log("=> creating model '{}'".format(args.arch), log)
     # Init model, criterion, and optimizer
@@ -204,6 +262,7 @@ def main():
             args.pretrain_path = './ckpt/orig/'+args.dataset+'_'+args.arch+'_base'+base_name+'/'+'checkpoint.pth.tar'
             print_log("Pretrain path: {}".format(args.pretrain_path), log)
         pretrain = torch.load(args.pretrain_path)
+        args.weights_source = checkpoint_id(args.pretrain_path)
         if args.use_state_dict:
             net.load_state_dict(pretrain['state_dict'])
         else:
@@ -215,6 +274,7 @@ def main():
         if os.path.isfile(args.resume):
             print_log("=> loading checkpoint '{}'".format(args.resume), log)
             checkpoint = torch.load(args.resume)
+            args.weights_source = checkpoint_id(args.resume)
             recorder = checkpoint['recorder']
             args.start_epoch = checkpoint['epoch']
             if args.use_state_dict:
@@ -263,6 +323,32 @@ def main():
     val_acc_2, val_los_2 = validate(test_loader, net, criterion, log)
     print(" accu after is: %s %%" % val_acc_2)
 
+    channels = None
+    if args.compact_finetune:
+        # the masks never change from here on, so fine-tune the model without the pruned filters
+        small = compact_cifar_resnet(net, m.pruned_index)
+        optimizer = compact_optimizer(optimizer, net, small, cifar_resnet_slices(net, m.pruned_index))
+        channels = channel_map(net, m.pruned_index)
+        net = torch.nn.DataParallel(small, device_ids=list(range(args.ngpu)))
+        if args.use_cuda:
+            net = net.cuda()
+        m = None
+        print_log("=> compact network :\n {}".format(net), log)
+        val_acc_2, val_los_2 = validate(test_loader, net, criterion, log)
+        print(" accu compact is: %s %%" % val_acc_2)
+    elif args.skip_pruned:
+        # the masks never change from here on, so the convs run on their kept filters only; the pruned
+        # ones stay zero without grad masking, and net.module.skip_pruned(None) restores the layout
+        net.module.skip_pruned(m.pruned_index, optimizer)
+        m = None
+    if args.masked_optimizer and not args.compact_finetune:
+        # the pruned filters are skipped by the update and stay zero, no gradient masking needed; after
+        # skip_pruned the kept filters come first and the update runs on narrowed views
+        optimizer = MaskedSGD.from_optimizer(optimizer, net.module.kept_masks() if m is None else m.kept_filters())
+    elif args.grad_mask_hooks and m is not None:
+        # only the masked model in its original layout still needs its gradients masked
+        m.register_grad_hooks()
+
     # Main loop
     start_time = time.time()
     epoch_time = AverageMeter()
@@ -287,8 +373,9 @@ def main():
         # evaluate on validation set
         # val_acc_1, val_los_1 = validate(test_loader, net, criterion, log)
 
-        m.model = net
-        
+        if m is not None:
+            m.model = net
+
 
         # if epoch % args.epoch_prune == 0 or epoch == args.epochs - 1:
         #     m.model = net
@@ -304,7 +391,8 @@ def main():
         val_acc_2, val_los_2 = validate(test_loader, net, criterion, log)
 
 
-        m.if_change()
+        if m is not None:
+            m.if_change()
 
         is_best = recorder.update(epoch, train_los, train_acc, val_los_2, val_acc_2)
 
@@ -314,6 +402,7 @@ def main():
             'state_dict': net,
             'recorder': recorder,
             'optimizer': optimizer.state_dict(),
+            'channels': channels,
         }, is_best, args.save_path, 'checkpoint.pth.tar')
 
         # measure elapsed time
@@ -344,7 +433,7 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
         data_time.update(time.time() - end)
 
         if args.use_cuda:
-            target = target.cuda(async=True)
+            target = target.cuda(non_blocking=True)
             input = input.cuda()
         input_var = torch.autograd.Variable(input)
         target_var = torch.autograd.Variable(target)
@@ -364,7 +453,8 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
         loss.backward()
 
         # Mask grad for iteration
-        m.do_grad_mask()
+        if m is not None and not args.masked_optimizer:
+            m.do_grad_mask()
         optimizer.step()
 
         # measure elapsed time
@@ -384,6 +474,8 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
         '  **Train** Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f} Error@1 {error1:.3f}'.format(top1=top1, top5=top5,
                                                                                               error1=100 - top1.avg),
         log)
+    print_log('  **Data-bound** {:.1%} of the step time spent waiting for batches'.format(
+        data_time.sum / max(batch_time.sum, 1e-12)), log)
     return top1.avg, losses.avg
 
 
@@ -397,7 +489,7 @@ def validate(val_loader, model, criterion, log):
 
     for i, (input, target) in enumerate(val_loader):
         if args.use_cuda:
-            target = target.cuda(async=True)
+            target = target.cuda(non_blocking=True)
             input = input.cuda()
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
@@ -479,13 +571,25 @@ class Mask:
         self.model_length = {}
         self.compress_rate = {}
         self.distance_rate = {}
-        self.mat = {}
+        # per-filter boolean masks, True for kept filters
+        self.filter_mask = {}
+        self.similar_filter_mask = {}
         self.model = model
         self.mask_index = []
         self.filter_small_index = {}
         self.filter_large_index = {}
-        self.similar_matrix = {}
+        # flat codebooks, materialized from the filter masks on access
+        self.mat = FilterCodebook(self.filter_mask, self.model_length)
+        self.similar_matrix = FilterCodebook(self.similar_filter_mask, self.model_length)
+        # masked parameters with their masks, resolved once in init_fused_mask
+        self.fused_mask = None
+        self.fused_similar_mask = None
+        self.fused_grad_mask = None
         self.pruned_index = {}
+        self.ranking = {}
+        # residual groups: their convs by leader, and the leader of every conv
+        self.groups = {}
+        self.group_leader = {}
         self.norm_matrix = {}
 
     def get_codebook(self, weight_torch, compress_rate, length):
@@ -503,24 +607,21 @@ class Mask:
         print("codebook done")
         return weight_np
 
-    def get_filter_codebook(self, weight_torch, compress_rate, length):
-        codebook = np.ones(length)
+    def get_filter_mask(self, weight_torch, compress_rate):
+        keep = torch.ones(weight_torch.size()[0], dtype=torch.bool, device=weight_torch.device)
         if len(weight_torch.size()) == 4:
             filter_pruned_num = int(weight_torch.size()[0] * (1 - compress_rate))
             weight_vec = weight_torch.view(weight_torch.size()[0], -1)
             norm2 = torch.norm(weight_vec, 2, 1)
-            norm2_np = norm2.cpu().numpy()
-            filter_index = norm2_np.argsort()[:filter_pruned_num]
-            #            norm1_sort = np.sort(norm1_np)
-            #            threshold = norm1_sort[int (weight_torch.size()[0] * (1-compress_rate) )]
-            kernel_length = weight_torch.size()[1] * weight_torch.size()[2] * weight_torch.size()[3]
-            for x in range(0, len(filter_index)):
-                codebook[filter_index[x] * kernel_length: (filter_index[x] + 1) * kernel_length] = 0
-
-            # print("filter codebook done")
+            filter_index = norm2.argsort()[:filter_pruned_num]
+            keep[filter_index] = False
+            # print("filter mask done")
         else:
             pass
-        return codebook
+        return keep
+
+    def get_filter_codebook(self, weight_torch, compress_rate, length):
+        return expand_filter_mask(self.get_filter_mask(weight_torch, compress_rate), length)
 
     def get_filter_index(self, weight_torch, compress_rate, length):
         if len(weight_torch.size()) == 4:
@@ -542,9 +643,24 @@ class Mask:
             pass
         return filter_small_index, filter_large_index
 
+    def get_filter_ranking(self, index, weight_torch, dist_type="l2", similar_sum=None):
+        # filters sorted by ascending score; independent of the distance rate
+        if similar_sum is None:
+            weight_vec = weight_torch.view(weight_torch.size()[0], -1)
+            # distance using torch, on the device the weights live on
+            similar_sum = filter_scores(weight_vec, dist_type, dtype=SCORE_DTYPES[args.score_dtype],
+                                        mode=args.score_mode, max_bytes=args.score_max_bytes,
+                                        sketch_eps=args.sketch_eps)
+        if index==3:
+            with open(os.path.join(args.save_path, 'log_seed_{}.txt'.format(args.manualSeed)), 'a+') as f:
+                f.write('similar_sum:\n'+str(similar_sum.cpu().numpy())+'\n\n')
+                f.flush()
+        return similar_sum.argsort()
+
     # optimize for fast ccalculation
-    def get_filter_similar(self, index, weight_torch, compress_rate, distance_rate, length, dist_type="l2"):
-        codebook = np.ones(length)
+    def get_filter_similar(self, index, weight_torch, compress_rate, distance_rate, length, dist_type="l2",
+                           ranking=None):
+        keep = torch.ones(weight_torch.size()[0], dtype=torch.bool, device=weight_torch.device)
         if len(weight_torch.size()) == 4:
             filter_pruned_num = int(weight_torch.size()[0] * (1 - compress_rate))
             similar_pruned_num = int(weight_torch.size()[0] * distance_rate)
@@ -574,62 +690,6 @@ class Mask:
             # # more similar with other filter indicates large in the sum of row
             # similar_sum = torch.sum(torch.abs(similar_matrix), 0).numpy()
 
-            # distance using numpy function
-            indices = torch.LongTensor(filter_large_index).cuda()
-            weight_vec_after_norm = torch.index_select(weight_vec, 0, indices).cpu().numpy()
-
-            # FPGM
-            if dist_type == "l2" or dist_type== "l1":
-                similar_matrix = distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'euclidean')
-                similar_sum = np.sum(np.abs(similar_matrix), axis=0)
-
-            # WHC
-            elif dist_type == 'proposed_one_abs_cos':
-                l2_norm = np.linalg.norm(weight_vec_after_norm, 2, 1)
-                assert(len(l2_norm.shape)==1)
-                l2_norm_diag = np.diag(l2_norm)
-
-                similar_matrix = 1-np.abs(1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine'))
-                similar_matrix = np.matmul(l2_norm_diag,np.matmul(similar_matrix, l2_norm_diag))  #the larger, the better
-                similar_sum = np.sum(similar_matrix, axis=0)
-
-            # literally_cosine in the Decoupling experiment
-            elif dist_type == 'literally_cosine':
-                similar_matrix = 1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine')
-                similar_sum = np.sum(similar_matrix, axis=0)
-
-            # L2_Norm in the Decoupling experiment
-            elif dist_type == 'L2_Norm':
-                similar_sum = np.linalg.norm(weight_vec_after_norm, 2, 1)
-
-            # DM  in the Decoupling experiment
-            elif dist_type == 'one_minus_abs_cos':   
-
-                similar_matrix = 1-np.abs(1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine'))
-                similar_sum = np.sum(similar_matrix, axis=0)
-
-            # the correlation version of WHC in the ablation experiment
-            elif dist_type == 'proposed_one_abs_corr':
-                l2_norm = np.linalg.norm(weight_vec_after_norm, 2, 1)
-                assert(len(l2_norm.shape)==1)
-                l2_norm_diag = np.diag(l2_norm)    
-
-                similar_matrix = 1-np.abs(1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'correlation'))
-                similar_matrix = np.matmul(l2_norm_diag,np.matmul(similar_matrix, l2_norm_diag))  #the larger, the better
-                similar_sum = np.sum(similar_matrix, axis=0)
-
-
-            # the L1 Norm version of WHC in the ablation experiment
-            elif dist_type == 'proposed_one_abs_cos_L1_norm':
-                l1_norm = np.linalg.norm(weight_vec_after_norm, 1, 1)
-                assert(len(l1_norm.shape)==1)
-                l1_norm_diag = np.diag(l1_norm)
-
-                similar_matrix = 1-np.abs(1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine'))
-                similar_matrix = np.matmul(l1_norm_diag,np.matmul(similar_matrix, l1_norm_diag))  #the larger, the better
-                similar_sum = np.sum(similar_matrix, axis=0)
-
-
             if dist_type == 'random':
                 similar_index_for_filter = range(weight_torch.size()[0])
                 np.random.shuffle(similar_index_for_filter)
@@ -638,16 +698,12 @@ class Mask:
 
 
             else:
-                # for distance similar: get the filter index with largest similarity == small distance
-                similar_large_index = similar_sum.argsort()[similar_pruned_num:]
-                similar_small_index = similar_sum.argsort()[:  similar_pruned_num]
-                similar_index_for_filter = [filter_large_index[i] for i in similar_small_index]
-
-            if index==3:
-                with open(os.path.join(args.save_path, 'log_seed_{}.txt'.format(args.manualSeed)), 'a+') as f:
-                    f.write('similar_sum:\n'+str(similar_sum)+'\n\n')
-                    f.flush()
+                if ranking is None:
+                    ranking = self.get_filter_ranking(index, weight_torch, dist_type=dist_type)
 
+                # for distance similar: get the filter index with largest similarity == small distance
+                similar_small_index = ranking[:  similar_pruned_num]
+                similar_index_for_filter = [filter_large_index[i] for i in similar_small_index.tolist()]
 
                 # print('filter_large_index', filter_large_index)
                 # print('filter_small_index', filter_small_index)
@@ -655,16 +711,13 @@ class Mask:
                 # print('similar_large_index', similar_large_index)
                 # print('similar_small_index', similar_small_index)
                 # print('similar_index_for_filter', similar_index_for_filter)
-            kernel_length = weight_torch.size()[1] * weight_torch.size()[2] * weight_torch.size()[3]
-            for x in range(0, len(similar_index_for_filter)):
-                codebook[
-                similar_index_for_filter[x] * kernel_length: (similar_index_for_filter[x] + 1) * kernel_length] = 0
+            keep[torch.as_tensor(similar_index_for_filter, dtype=torch.long, device=keep.device)] = False
             # input('here')
             # print("similar index done")
             # print('\n\n')
         else:
             pass
-        return codebook, similar_index_for_filter
+        return keep, similar_index_for_filter
 
     def convert2tensor(self, x):
         x = torch.FloatTensor(x)
@@ -702,55 +755,138 @@ class Mask:
 
     #        self.mask_index =  [x for x in range (0,330,3)]
 
+    def init_groups(self):
+        # convs summing into the same residual stream are pruned with the mask of the first one, the leader
+        self.groups = {}
+        self.group_leader = {}
+        if not args.share_residual_masks:
+            return
+        for group in residual_groups(self.model):
+            group = [index for index in group if index in self.mask_index]
+            if len(group) > 1:
+                self.groups[group[0]] = group
+                self.group_leader.update((index, group[0]) for index in group)
+
+    def scored_weight(self, index, weight_torch):
+        # a group is scored on the joint filters of its convs, each scaled to unit norm so no conv dominates
+        if index not in self.groups:
+            return weight_torch
+        params = list(self.model.parameters())
+        return torch.cat([params[member].data.view(weight_torch.size()[0], -1, 1, 1) /
+                          params[member].data.norm().clamp(min=1e-12) for member in self.groups[index]], 1)
+
+    def init_ranking(self, dist_type):
+        # rankings do not depend on the rates, so a rate sweep shares one scoring pass
+        self.ranking = {}
+        if dist_type == 'random':
+            return
+        # group members other than the leader take its masks, so only leaders are scored
+        masked = [(index, self.scored_weight(index, item.data)) for index, item in enumerate(self.model.parameters())
+                  if index in self.mask_index and self.group_leader.get(index, index) == index]
+        if args.ranking_cache:
+            # every criterion scored on a set of weights gets its own file under that key; both score
+            # modes give the same rankings, so --all_criteria (always gram) fills the cache for either
+            key = ranking_key(args.weights_source, [item.data for index, item in masked], args.arch,
+                              [index for index, item in masked], args.share_residual_masks,
+                              args.score_dtype, args.sketch_eps)
+            rankings = load_rankings(args.ranking_cache, key)
+            if rankings is not None and dist_type in rankings:
+                print("{} ranking loaded from {}".format(dist_type, args.ranking_cache))
+                self.ranking = {index: rankings[dist_type][index].to(item.device) for index, item in masked}
+                return
+        weights = OrderedDict((index, item.data) for index, item in masked)
+        if args.all_criteria:
+            # every criterion from one shared Gram matrix per layer, all written to the ranking cache
+            similar_sums = batch_multi_filter_scores(weights, DIST_TYPES, dtype=SCORE_DTYPES[args.score_dtype],
+                                                     max_bytes=args.score_max_bytes, sketch_eps=args.sketch_eps,
+                                                     workers=args.mask_workers)
+            rankings = {name: {index: similar_sum[index].argsort() for index, item in masked}
+                        for name, similar_sum in similar_sums.items()}
+            for index, item in masked:
+                self.ranking[index] = self.get_filter_ranking(index, item.data, dist_type=dist_type,
+                                                              similar_sum=similar_sums[dist_type][index])
+        elif args.layerwise_scoring:
+            def rank(masked_item):
+                index, item = masked_item
+                return self.get_filter_ranking(index, item.data, dist_type=dist_type)
+
+            # layers are independent, so they are scored on a thread pool and merged in layer order
+            rankings = map_layers(rank, masked, args.mask_workers)
+            self.ranking = {index: ranking for (index, item), ranking in zip(masked, rankings)}
+        else:
+            # same-shaped layers are scored together in one batched call
+            similar_sum = batch_filter_scores(weights, dist_type, dtype=SCORE_DTYPES[args.score_dtype],
+                                              mode=args.score_mode, max_bytes=args.score_max_bytes,
+                                              sketch_eps=args.sketch_eps, workers=args.mask_workers)
+            for index, item in masked:
+                self.ranking[index] = self.get_filter_ranking(index, item.data, dist_type=dist_type,
+                                                              similar_sum=similar_sum[index])
+        if args.ranking_cache:
+            rankings = rankings if args.all_criteria else {dist_type: self.ranking}
+            print("rankings saved to {}".format(save_rankings(args.ranking_cache, key, rankings)))
+
     def init_mask(self, rate_norm_per_layer, rate_dist_per_layer, dist_type):
         self.init_rate(rate_norm_per_layer, rate_dist_per_layer)
+        self.init_groups()
+        self.init_ranking(dist_type)
         for index, item in enumerate(self.model.parameters()):
             if index in self.mask_index:
+                leader = self.group_leader.get(index, index)
+                if leader != index:
+                    # the leader comes first, so its masks are already set
+                    self.filter_mask[index] = self.filter_mask[leader].clone()
+                    self.similar_filter_mask[index] = self.similar_filter_mask[leader].clone()
+                    self.pruned_index[index] = list(self.pruned_index[leader])
+                    continue
+                weight = self.scored_weight(index, item.data)
                 # mask for norm criterion
-                self.mat[index] = self.get_filter_codebook(item.data, self.compress_rate[index],
-                                                           self.model_length[index])
-                self.mat[index] = self.convert2tensor(self.mat[index])
-                if args.use_cuda:
-                    self.mat[index] = self.mat[index].cuda()
+                self.filter_mask[index] = self.get_filter_mask(weight, self.compress_rate[index])
 
                 # # get result about filter index
                 # self.filter_small_index[index], self.filter_large_index[index] = \
                 #     self.get_filter_index(item.data, self.compress_rate[index], self.model_length[index])
 
                 # mask for distance criterion
-                self.similar_matrix[index],self.pruned_index[index] = self.get_filter_similar(index, item.data, self.compress_rate[index],
+                self.similar_filter_mask[index],self.pruned_index[index] = self.get_filter_similar(index, weight, self.compress_rate[index],
                                                                      self.distance_rate[index],
-                                                                     self.model_length[index], dist_type=dist_type)
-                self.similar_matrix[index] = self.convert2tensor(self.similar_matrix[index])
-                if args.use_cuda:
-                    self.similar_matrix[index] = self.similar_matrix[index].cuda()
+                                                                     self.model_length[index], dist_type=dist_type,
+                                                                     ranking=self.ranking.get(index))
+                if args.sketch_eps and args.sketch_report and dist_type != 'random':
+                    mismatch = pruned_mismatch(weight.view(weight.size()[0], -1), self.pruned_index[index], dist_type,
+                                               dtype=SCORE_DTYPES[args.score_dtype], mode=args.score_mode,
+                                               max_bytes=args.score_max_bytes)
+                    print("layer {}: {} of {} sketched pruned filters differ from the exact ranking".format(
+                        index, mismatch, len(self.pruned_index[index])))
+        self.init_fused_mask()
         print("mask Ready")
 
+    def init_fused_mask(self):
+        masked = [(index, item) for index, item in enumerate(self.model.parameters()) if index in self.filter_mask]
+        params = [item for index, item in masked]
+        self.fused_mask = FusedMask(params, [self.filter_mask[index] for index, item in masked])
+        self.fused_similar_mask = FusedMask(params, [self.similar_filter_mask[index] for index, item in masked])
+        self.fused_grad_mask = FusedMask(params, [self.filter_mask[index] & self.similar_filter_mask[index]
+                                                  for index, item in masked])
+
+    def register_grad_hooks(self):
+        # mask gradients inside backward; do_grad_mask becomes a no-op
+        self.fused_grad_mask.register_grad_hooks()
+
     def do_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.data.view(self.model_length[index])
-                b = a * self.mat[index]
-                item.data = b.view(self.model_size[index])
+        self.fused_mask.apply_()
         print("mask Done")
 
     def do_similar_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.data.view(self.model_length[index])
-                b = a * self.similar_matrix[index]
-                item.data = b.view(self.model_size[index])
+        self.fused_similar_mask.apply_()
         print("mask similar Done")
 
+    def kept_filters(self):
+        # {parameter: filter mask} of the gradient masks, for masking.MaskedSGD
+        return dict(zip(self.fused_grad_mask.params, self.fused_grad_mask.keeps))
+
     def do_grad_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.grad.data.view(self.model_length[index])
-                # reverse the mask of model
-                # b = a * (1 - self.mat[index])
-                b = a * self.mat[index]
-                b = b * self.similar_matrix[index]
-                item.grad.data = b.view(self.model_size[index])
+        if not self.fused_grad_mask.hooks:
+            self.fused_grad_mask.apply_grad_()
         # print("grad zero Done")
 
     def if_zero(self):
@@ -14,11 +14,15 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torchvision.models
 from utils import convert_secs2time, time_string, time_file_str, timing
+from scoring import (filter_scores, batch_filter_scores, batch_multi_filter_scores, pruned_mismatch, map_layers,
+                     ranking_key, checkpoint_id, load_rankings, save_rankings, DIST_TYPES, SCORE_DTYPES)
+from masking import FilterCodebook, FusedMask, MaskedSGD, expand_filter_mask, residual_groups
+from loaders import (ShardDataset, ShuffledShards, is_packed, cache_val, has_val_cache, CachedLoader,
+                     DraftRandomResizedCrop, open_lazy, Prefetcher)
 # from models import print_log
 import models
 import random
 import numpy as np
-from scipy.spatial import distance
 from collections import OrderedDict
 
 model_names = sorted(name for name in models.__dict__
@@ -48,6 +52,7 @@ parser.add_argument('--print-freq', '-p', default=200, type=int, metavar='N', he
 parser.add_argument('--resume', default='', type=str, metavar='PATH', help='path to latest checkpoint (default: none)')
 parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true', help='evaluate model on validation set')
 parser.add_argument('--use_pretrain', dest='use_pretrain', action='store_true', help='use pre-trained model or not')
+parser.add_argument('--manualSeed', type=int, help='manual seed (default: random), e.g. of the packed shard order')
 
 # compress rate
 parser.add_argument('--rate_norm', type=float, default=0.9, help='the remaining ratio of pruning based on Norm')
@@ -68,10 +73,51 @@ parser.add_argument('--VGG_pruned_style', choices=["CP_5x", "Thinet_conv"],
 
 parser.add_argument('--batchsize_for_eval', default=None, type=int,  help='batchsize_for_eval')
 parser.add_argument('--method', default='None', help='Method')
+parser.add_argument('--score_dtype', default='float64', choices=['float32', 'float64'],
+                    help='precision of the pairwise filter scoring and of the scores (the Gram scoring always runs '
+                         'in float64)')
+parser.add_argument('--score_mode', default='gram', choices=['pairwise', 'gram'],
+                    help='pairwise: full criterion matrix; gram: closed form from one Gram matrix')
+parser.add_argument('--score_memory_mb', type=float, default=1024,
+                    help='memory cap of the scoring temporaries; larger layers are scored tile by tile (0: no cap)')
+parser.add_argument('--layerwise_scoring', dest='layerwise_scoring', action='store_true',
+                    help='score layers one by one instead of batching same-shaped layers')
+parser.add_argument('--ranking_cache', default='', type=str,
+                    help='folder of per-layer filter rankings shared across runs (empty: do not cache)')
+parser.add_argument('--grad_mask_hooks', dest='grad_mask_hooks', action='store_true',
+                    help='mask gradients with hooks during backward instead of after it')
+parser.add_argument('--sketch_eps', type=float, default=0,
+                    help='score from a random projection of the filters with this distortion bound, on the layers '
+                         'where that is cheaper than the exact Gram (0: exact)')
+parser.add_argument('--sketch_report', dest='sketch_report', action='store_true',
+                    help='log how many pruned filters per layer differ from the exact ranking')
+parser.add_argument('--mask_workers', type=int, default=1,
+                    help='threads scoring independent layers in parallel when building the masks')
+parser.add_argument('--all_criteria', dest='all_criteria', action='store_true',
+                    help='score every criterion in one pass and save all their rankings to the ranking cache')
+parser.add_argument('--share_residual_masks', dest='share_residual_masks', action='store_true',
+                    help='prune the convs summing into the same residual stream with one mask, '
+                         'scored on their joint filters')
+parser.add_argument('--masked_optimizer', dest='masked_optimizer', action='store_true',
+                    help='SGD keeping momentum and updating the kept filters only, instead of masking gradients')
+parser.add_argument('--shuffle_buffer', type=int, default=1024,
+                    help='images each loader worker shuffles when reading shards packed by pack_imagenet.py')
+parser.add_argument('--draft_decode', dest='draft_decode', action='store_true',
+                    help='decode the train JPEGs at the smallest DCT scale their random crop allows')
+parser.add_argument('--prefetch', type=int, default=0,
+                    help='batches staged on the device ahead of the step by a background thread (0: off)')
+parser.add_argument('--val_cache', default='', type=str,
+                    help='folder caching the resized and center-cropped val images, built on first use '
+                         '(empty: decode the val set every epoch)')
 
 
 args = parser.parse_args()
 args.use_cuda = torch.cuda.is_available()
+# the checkpoint the pruned weights come from keys the ranking cache (None: fingerprint the weights)
+args.weights_source = None
+args.score_max_bytes = int(args.score_memory_mb * 2 ** 20) or None
+if args.manualSeed is None:
+    args.manualSeed = random.randint(1, 10000)
 
 args.prefix = time_file_str()
 
@@ -105,6 +151,7 @@ def main():
     print_log("Workers         : {}".format(args.workers), log)
     print_log("Learning-Rate   : {}".format(args.lr), log)
     print_log("Use Pre-Trained : {}".format(args.use_pretrain), log)
+    print_log("Random Seed     : {}".format(args.manualSeed), log)
     print_log("lr adjust : {}".format(args.lr_adjust), log)
     print_log("VGG pruned style : {}".format(args.VGG_pruned_style), log)
 
@@ -127,6 +174,7 @@ def main():
         if os.path.isfile(args.resume):
             print_log("=> loading checkpoint '{}'".format(args.resume), log)
             checkpoint = torch.load(args.resume)
+            args.weights_source = checkpoint_id(args.resume)
             args.start_epoch = checkpoint['epoch']
             best_prec1 = checkpoint['best_prec1']
             model.load_state_dict(checkpoint['state_dict'])
@@ -140,32 +188,64 @@ def main():
     # Data loading code
     traindir = os.path.join(args.data, 'train')
     valdir = os.path.join(args.data, 'val')
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
-
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
-            transforms.RandomResizedCrop(224),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ]))
+    mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    normalize = transforms.Normalize(mean=mean, std=std)
+    train_transform = transforms.Compose([
+        DraftRandomResizedCrop(224) if args.draft_decode else transforms.RandomResizedCrop(224),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        normalize,
+    ])
+    val_crop = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+    ])
+    val_transform = transforms.Compose([
+        val_crop,
+        transforms.ToTensor(),
+        normalize,
+    ])
+
+    if is_packed(args.data):
+        # shards written by pack_imagenet.py, read sequentially through a shuffle buffer
+        print_log("=> packed dataset '{}'".format(args.data), log)
+        train_dataset = ShuffledShards(traindir, train_transform, buffer_size=args.shuffle_buffer,
+                                       seed=args.manualSeed, lazy=args.draft_decode)
+        val_dataset = ShardDataset(valdir, val_transform)
+    else:
+        # DraftRandomResizedCrop decodes the images itself
+        train_dataset = datasets.ImageFolder(traindir, train_transform,
+                                             loader=open_lazy if args.draft_decode else datasets.folder.default_loader)
+        val_dataset = datasets.ImageFolder(valdir, val_transform)
 
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=True,
+        train_dataset, batch_size=args.batch_size, shuffle=not isinstance(train_dataset, ShuffledShards),
         num_workers=args.workers, pin_memory=True, sampler=None)
 
     val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
+        val_dataset,
         batch_size=args.batch_size if args.batchsize_for_eval==None else args.batchsize_for_eval, shuffle=False,
         num_workers=args.workers, pin_memory=True)
 
+    if args.val_cache:
+        # the val crops never change: decode them once, then only normalize every epoch; rebuilt when the
+        # cache was made from another val set, crop or image count
+        val_meta = {'source': os.path.abspath(valdir), 'crop': repr(val_crop), 'length': len(val_dataset)}
+        if not has_val_cache(args.val_cache, val_meta):
+            print_log("=> caching the val crops in '{}'".format(args.val_cache), log)
+            val_dataset.transform = val_crop
+            cache_val(val_dataset, args.val_cache, val_meta, workers=args.workers)
+        val_loader = CachedLoader(args.val_cache,
+                                  args.batch_size if args.batchsize_for_eval==None else args.batchsize_for_eval,
+                                  mean, std, device='cuda' if args.use_cuda else 'cpu')
+    if args.prefetch > 0:
+        # the next batches are collated and copied while the current step runs
+        device = 'cuda' if args.use_cuda else 'cpu'
+        train_loader = Prefetcher(train_loader, device, args.prefetch)
+        if not isinstance(val_loader, CachedLoader):
+            # the cached val batches already come on the device
+            val_loader = Prefetcher(val_loader, device, args.prefetch)
+
     if args.evaluate:
         validate(val_loader, model, criterion, log)
         return
@@ -187,6 +267,11 @@ def main():
     # m.if_zero()
     m.do_mask()
     m.do_similar_mask()
+    if args.masked_optimizer:
+        # the pruned filters are skipped by the update and stay zero, no gradient masking needed
+        optimizer = MaskedSGD.from_optimizer(optimizer, m.kept_filters())
+    elif args.grad_mask_hooks:
+        m.register_grad_hooks()
     model = m.model
     # m.if_zero()
     print_log(str(m.pruned_index),log)
@@ -208,6 +293,8 @@ def main():
             log)
 
         # train for one epoch
+        if isinstance(train_dataset, ShuffledShards):
+            train_dataset.set_epoch(epoch)
         train(train_loader, model, criterion, optimizer, epoch, log, m)
         # evaluate on validation set
         # val_acc_1 = validate(val_loader, model, criterion, log)
@@ -231,6 +318,8 @@ def main():
             'epoch': epoch + 1,
             'arch': args.arch,
             'state_dict': model.state_dict(),
+            # for compact.resnet_small_from_checkpoint
+            'pruned_index': m.pruned_index,
             'best_prec1': best_prec1,
             'optimizer': optimizer.state_dict(),
         }, is_best, filename, bestname)
@@ -266,7 +355,7 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input)
         target_var = torch.autograd.Variable(target)
 
@@ -285,7 +374,8 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
         loss.backward()
 
         # Mask grad for iteration
-        m.do_grad_mask()
+        if not args.masked_optimizer:
+            m.do_grad_mask()
         optimizer.step()
 
         # measure elapsed time
@@ -301,6 +391,8 @@ def train(train_loader, model, criterion, optimizer, epoch, log, m):
                       'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
                 epoch, i, len(train_loader), batch_time=batch_time,
                 data_time=data_time, loss=losses, top1=top1, top5=top5), log)
+    print_log(' * Data-bound {:.1%} of the step time spent waiting for batches'.format(
+        data_time.sum / max(batch_time.sum, 1e-12)), log)
 
 
 def validate(val_loader, model, criterion, log):
@@ -314,7 +406,7 @@ def validate(val_loader, model, criterion, log):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
+        target = target.cuda(non_blocking=True)
         input_var = torch.autograd.Variable(input, volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
@@ -407,13 +499,25 @@ class Mask:
         self.model_length = {}
         self.compress_rate = {}
         self.distance_rate = {}
-        self.mat = {}
+        # per-filter boolean masks, True for kept filters
+        self.filter_mask = {}
+        self.similar_filter_mask = {}
         self.model = model
         self.mask_index = []
         self.filter_small_index = {}
         self.filter_large_index = {}
-        self.similar_matrix = {}
+        # flat codebooks, materialized from the filter masks on access
+        self.mat = FilterCodebook(self.filter_mask, self.model_length)
+        self.similar_matrix = FilterCodebook(self.similar_filter_mask, self.model_length)
+        # masked parameters with their masks, resolved once in init_fused_mask
+        self.fused_mask = None
+        self.fused_similar_mask = None
+        self.fused_grad_mask = None
         self.pruned_index = {}
+        self.ranking = {}
+        # residual groups: their convs by leader, and the leader of every conv
+        self.groups = {}
+        self.group_leader = {}
 
     def get_codebook(self, weight_torch, compress_rate, length):
         weight_vec = weight_torch.view(length)
@@ -430,29 +534,26 @@ class Mask:
         print("codebook done")
         return weight_np
 
-    def get_filter_codebook(self, weight_torch, compress_rate, length):
-        codebook = np.ones(length)
+    def get_filter_mask(self, weight_torch, compress_rate):
+        keep = torch.ones(weight_torch.size()[0], dtype=torch.bool, device=weight_torch.device)
         if len(weight_torch.size()) == 4:
             filter_pruned_num = int(weight_torch.size()[0] * (1 - compress_rate))
             weight_vec = weight_torch.view(weight_torch.size()[0], -1)
             # norm1 = torch.norm(weight_vec, 1, 1)
-            # norm1_np = norm1.cpu().numpy()
             norm2 = torch.norm(weight_vec, 2, 1)
-            norm2_np = norm2.cpu().numpy()
-            filter_index = norm2_np.argsort()[:filter_pruned_num]
-            #            norm1_sort = np.sort(norm1_np)
-            #            threshold = norm1_sort[int (weight_torch.size()[0] * (1-compress_rate) )]
-            kernel_length = weight_torch.size()[1] * weight_torch.size()[2] * weight_torch.size()[3]
-            for x in range(0, len(filter_index)):
-                codebook[filter_index[x] * kernel_length: (filter_index[x] + 1) * kernel_length] = 0
-            # print("filter codebook done")
+            filter_index = norm2.argsort()[:filter_pruned_num]
+            keep[filter_index] = False
+            # print("filter mask done")
         elif len(weight_torch.size()) == 2:
             weight_torch = weight_torch.view(weight_torch.size()[0], weight_torch.size()[1], 1, 1)
-            codebook = self.get_filter_codebook(weight_torch, compress_rate, length)
-            # print("filter codebook for fc done")
+            keep = self.get_filter_mask(weight_torch, compress_rate)
+            # print("filter mask for fc done")
         else:
             pass
-        return codebook
+        return keep
+
+    def get_filter_codebook(self, weight_torch, compress_rate, length):
+        return expand_filter_mask(self.get_filter_mask(weight_torch, compress_rate), length)
 
     @timing
     def get_filter_similar_old(self, weight_torch, compress_rate, distance_rate, length):
@@ -503,71 +604,41 @@ class Mask:
             pass
         return codebook
 
+    def get_filter_candidates(self, weight_torch, compress_rate):
+        # filters kept by the norm criterion, the ones scored by the distance criterion
+        filter_pruned_num = int(weight_torch.size()[0] * (1 - compress_rate))
+        weight_vec = weight_torch.view(weight_torch.size()[0], -1)
+        # norm1 = torch.norm(weight_vec, 1, 1)
+        norm2 = torch.norm(weight_vec, 2, 1)
+        filter_large_index = norm2.argsort()[filter_pruned_num:]
+        return weight_vec, filter_large_index
+
+    def get_filter_ranking(self, weight_torch, compress_rate):
+        # candidate filters sorted by ascending score; independent of the distance rate
+        weight_vec, filter_large_index = self.get_filter_candidates(weight_torch, compress_rate)
+
+        # distance using torch, on the device the weights live on
+        weight_vec_after_norm = torch.index_select(weight_vec, 0, filter_large_index)
+        similar_sum = filter_scores(weight_vec_after_norm, args.method, dtype=SCORE_DTYPES[args.score_dtype],
+                                    mode=args.score_mode, max_bytes=args.score_max_bytes,
+                                    sketch_eps=args.sketch_eps)
+        return filter_large_index[similar_sum.argsort()]
+
     # optimize for fast ccalculation
-    def get_filter_similar(self, weight_torch, compress_rate, distance_rate, length):
-        codebook = np.ones(length)
+    def get_filter_similar(self, weight_torch, compress_rate, distance_rate, length, ranking=None):
+        keep = torch.ones(weight_torch.size()[0], dtype=torch.bool, device=weight_torch.device)
         if len(weight_torch.size()) == 4:
-            filter_pruned_num = int(weight_torch.size()[0] * (1 - compress_rate))
             similar_pruned_num = int(weight_torch.size()[0] * distance_rate)
-            weight_vec = weight_torch.view(weight_torch.size()[0], -1)
-            # norm1 = torch.norm(weight_vec, 1, 1)
-            # norm1_np = norm1.cpu().numpy()
-            norm2 = torch.norm(weight_vec, 2, 1)
-            norm2_np = norm2.cpu().numpy()
-            filter_small_index = []
-            filter_large_index = []
-            filter_large_index = norm2_np.argsort()[filter_pruned_num:]
-            filter_small_index = norm2_np.argsort()[:filter_pruned_num]
-
-            # # distance using pytorch function
-            # similar_matrix = torch.zeros((len(filter_large_index), len(filter_large_index)))
-            # for x1, x2 in enumerate(filter_large_index):
-            #     for y1, y2 in enumerate(filter_large_index):
-            #         # cos = torch.nn.CosineSimilarity(dim=1, eps=1e-6)
-            #         # similar_matrix[x1, y1] = cos(weight_vec[x2].view(1, -1), weight_vec[y2].view(1, -1))[0]
-            #         pdist = torch.nn.PairwiseDistance(p=2)
-            #         similar_matrix[x1, y1] = pdist(weight_vec[x2].view(1, -1), weight_vec[y2].view(1, -1))[0][0]
-            # # more similar with other filter indicates large in the sum of row
-            # similar_sum = torch.sum(torch.abs(similar_matrix), 0).numpy()
-
-            # distance using numpy function
-            indices = torch.LongTensor(filter_large_index).cuda()
-            weight_vec_after_norm = torch.index_select(weight_vec, 0, indices).cpu().numpy()
-
-
-            # for euclidean distance
-            # similar_matrix = distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'euclidean')
-            # for cos similarity
-            # similar_matrix = 1 - distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine')
-            # similar_sum = np.sum(np.abs(similar_matrix), axis=0)
-
-
-            # WHC
-            if args.method=='proposed_one_abs_cos':
-                l2_norm = np.linalg.norm(weight_vec_after_norm, 2, 1)
-                assert(len(l2_norm.shape)==1)
-                similar_matrix = 1-np.abs(1-distance.cdist(weight_vec_after_norm, weight_vec_after_norm, 'cosine'))
-                similar_matrix = np.matmul(np.diag(l2_norm),np.matmul(similar_matrix, np.diag(l2_norm)))  #the larger, the better
-                similar_sum = np.sum(similar_matrix, axis=0)      
-
-            else:
-                assert (0)
-
-
+            if ranking is None:
+                ranking = self.get_filter_ranking(weight_torch, compress_rate)
 
             # for distance similar: get the filter index with largest similarity == small distance
-            similar_large_index = similar_sum.argsort()[similar_pruned_num:]
-            similar_small_index = similar_sum.argsort()[:  similar_pruned_num]
-            similar_index_for_filter = [filter_large_index[i] for i in similar_small_index]
-
-            kernel_length = weight_torch.size()[1] * weight_torch.size()[2] * weight_torch.size()[3]
-            for x in range(0, len(similar_index_for_filter)):
-                codebook[
-                similar_index_for_filter[x] * kernel_length: (similar_index_for_filter[x] + 1) * kernel_length] = 0
+            keep[ranking[:  similar_pruned_num]] = False
+            similar_index_for_filter = ranking[:  similar_pruned_num].tolist()
             # print("similar index done")
         else:
             pass
-        return codebook, similar_index_for_filter
+        return keep, similar_index_for_filter
 
     def convert2tensor(self, x):
         x = torch.FloatTensor(x)
@@ -645,51 +716,136 @@ class Mask:
             else:
                 pass
 
+    def init_groups(self):
+        # convs summing into the same residual stream are pruned with the mask of the first one, the leader
+        self.groups = {}
+        self.group_leader = {}
+        if not args.share_residual_masks:
+            return
+        for group in residual_groups(self.model):
+            group = [index for index in group if index in self.mask_index]
+            if len(group) > 1:
+                self.groups[group[0]] = group
+                self.group_leader.update((index, group[0]) for index in group)
+
+    def scored_weight(self, index, weight_torch):
+        # a group is scored on the joint filters of its convs, each scaled to unit norm so no conv dominates
+        if index not in self.groups:
+            return weight_torch
+        params = list(self.model.parameters())
+        return torch.cat([params[member].data.view(weight_torch.size()[0], -1, 1, 1) /
+                          params[member].data.norm().clamp(min=1e-12) for member in self.groups[index]], 1)
+
+    def init_ranking(self):
+        # rankings do not depend on the distance rate, so a rate sweep shares one scoring pass
+        self.ranking = {}
+        # group members other than the leader take its masks, so only leaders are scored
+        masked = [(index, self.scored_weight(index, item.data)) for index, item in enumerate(self.model.parameters())
+                  if index in self.mask_index and self.group_leader.get(index, index) == index]
+        if args.ranking_cache:
+            # every criterion scored on a set of weights gets its own file under that key; both score
+            # modes give the same rankings, so --all_criteria (always gram) fills the cache for either;
+            # the norm criterion picks the candidates, so its per-layer rate is part of the key
+            key = ranking_key(args.weights_source, [item.data for index, item in masked], args.arch,
+                              [index for index, item in masked], args.share_residual_masks,
+                              args.score_dtype, [self.compress_rate[index] for index, item in masked],
+                              args.sketch_eps)
+            rankings = load_rankings(args.ranking_cache, key)
+            if rankings is not None and args.method in rankings:
+                print("{} ranking loaded from {}".format(args.method, args.ranking_cache))
+                self.ranking = {index: rankings[args.method][index].to(item.device) for index, item in masked}
+                return
+        if args.layerwise_scoring and not args.all_criteria:
+            def rank(masked_item):
+                index, item = masked_item
+                return self.get_filter_ranking(item.data, self.compress_rate[index])
+
+            # layers are independent, so they are scored on a thread pool and merged in layer order
+            rankings = map_layers(rank, masked, args.mask_workers)
+            self.ranking = {index: ranking for (index, item), ranking in zip(masked, rankings)}
+            rankings = {args.method: self.ranking}
+        else:
+            # layers with the same shape and norm rate are scored together in one batched call
+            candidates, weights_after_norm = {}, OrderedDict()
+            for index, item in masked:
+                weight_vec, candidates[index] = self.get_filter_candidates(item.data, self.compress_rate[index])
+                weights_after_norm[index] = torch.index_select(weight_vec, 0, candidates[index])
+            if args.all_criteria:
+                # every criterion from one shared Gram matrix per layer, all written to the ranking cache
+                similar_sums = batch_multi_filter_scores(weights_after_norm, DIST_TYPES,
+                                                         dtype=SCORE_DTYPES[args.score_dtype],
+                                                         max_bytes=args.score_max_bytes, sketch_eps=args.sketch_eps,
+                                                         workers=args.mask_workers)
+            else:
+                similar_sums = {args.method: batch_filter_scores(weights_after_norm, args.method,
+                                                                 dtype=SCORE_DTYPES[args.score_dtype],
+                                                                 mode=args.score_mode, max_bytes=args.score_max_bytes,
+                                                                 sketch_eps=args.sketch_eps, workers=args.mask_workers)}
+            rankings = {name: {index: candidates[index][similar_sum[index].argsort()] for index, item in masked}
+                        for name, similar_sum in similar_sums.items()}
+            self.ranking = rankings[args.method]
+        if args.ranking_cache:
+            print("rankings saved to {}".format(save_rankings(args.ranking_cache, key, rankings)))
+
     def init_mask(self, rate_norm_per_layer, rate_dist_per_layer):
         self.init_rate(rate_norm_per_layer, rate_dist_per_layer)
+        self.init_groups()
+        self.init_ranking()
         for index, item in enumerate(self.model.parameters()):
             if index in self.mask_index:
+                leader = self.group_leader.get(index, index)
+                if leader != index:
+                    # the leader comes first, so its masks are already set
+                    self.filter_mask[index] = self.filter_mask[leader].clone()
+                    self.similar_filter_mask[index] = self.similar_filter_mask[leader].clone()
+                    self.pruned_index[index] = list(self.pruned_index[leader])
+                    continue
+                weight = self.scored_weight(index, item.data)
                 # mask for norm criterion
-                self.mat[index] = self.get_filter_codebook(item.data, self.compress_rate[index],
-                                                           self.model_length[index])
-                self.mat[index] = self.convert2tensor(self.mat[index])
-                if args.use_cuda:
-                    self.mat[index] = self.mat[index].cuda()
+                self.filter_mask[index] = self.get_filter_mask(weight, self.compress_rate[index])
 
                 # mask for distance criterion
-                self.similar_matrix[index],self.pruned_index[index] = self.get_filter_similar(item.data, self.compress_rate[index],
+                self.similar_filter_mask[index],self.pruned_index[index] = self.get_filter_similar(weight, self.compress_rate[index],
                                                                      self.distance_rate[index],
-                                                                     self.model_length[index])
-                self.similar_matrix[index] = self.convert2tensor(self.similar_matrix[index])
-                if args.use_cuda:
-                    self.similar_matrix[index] = self.similar_matrix[index].cuda()
+                                                                     self.model_length[index],
+                                                                     ranking=self.ranking.get(index))
+                if args.sketch_eps and args.sketch_report:
+                    weight_vec, candidates = self.get_filter_candidates(weight, self.compress_rate[index])
+                    mismatch = pruned_mismatch(torch.index_select(weight_vec, 0, candidates), self.pruned_index[index],
+                                               args.method, dtype=SCORE_DTYPES[args.score_dtype], mode=args.score_mode,
+                                               max_bytes=args.score_max_bytes, candidates=candidates)
+                    print("layer {}: {} of {} sketched pruned filters differ from the exact ranking".format(
+                        index, mismatch, len(self.pruned_index[index])))
+        self.init_fused_mask()
         print("mask Ready")
 
+    def init_fused_mask(self):
+        masked = [(index, item) for index, item in enumerate(self.model.parameters()) if index in self.filter_mask]
+        params = [item for index, item in masked]
+        self.fused_mask = FusedMask(params, [self.filter_mask[index] for index, item in masked])
+        self.fused_similar_mask = FusedMask(params, [self.similar_filter_mask[index] for index, item in masked])
+        self.fused_grad_mask = FusedMask(params, [self.filter_mask[index] & self.similar_filter_mask[index]
+                                                  for index, item in masked])
+
+    def register_grad_hooks(self):
+        # mask gradients inside backward; do_grad_mask becomes a no-op
+        self.fused_grad_mask.register_grad_hooks()
+
     def do_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.data.view(self.model_length[index])
-                b = a * self.mat[index]
-                item.data = b.view(self.model_size[index])
+        self.fused_mask.apply_()
         print("mask Done")
 
     def do_similar_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.data.view(self.model_length[index])
-                b = a * self.similar_matrix[index]
-                item.data = b.view(self.model_size[index])
+        self.fused_similar_mask.apply_()
         print("mask similar Done")
 
+    def kept_filters(self):
+        # {parameter: filter mask} of the gradient masks, for masking.MaskedSGD
+        return dict(zip(self.fused_grad_mask.params, self.fused_grad_mask.keeps))
+
     def do_grad_mask(self):
-        for index, item in enumerate(self.model.parameters()):
-            if index in self.mask_index:
-                a = item.grad.data.view(self.model_length[index])
-                # reverse the mask of model
-                # b = a * (1 - self.mat[index])
-                b = a * self.mat[index]
-                b = b * self.similar_matrix[index]
-                item.grad.data = b.view(self.model_size[index])
+        if not self.fused_grad_mask.hooks:
+            self.fused_grad_mask.apply_grad_()
         # print("grad zero Done")
 
     def if_zero(self):
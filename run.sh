@@ -1,6 +1,6 @@
 #!/bin/bash
-CUDA_VISIBLE_DEVICES=1 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_cos --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.968750 --layer_begin 0  --layer_end 324 --layer_inter 3 --date GITGHUBTEST&
-CUDA_VISIBLE_DEVICES=2 python  pruning_cifar10_orig.py --dist_type literally_cosine --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.968750 --layer_begin 0  --layer_end 324 --layer_inter 3 --date GITGHUBTEST
-CUDA_VISIBLE_DEVICES=3 python  pruning_cifar10_orig.py --dist_type one_minus_abs_cos --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --date GITGHUBTEST&
-CUDA_VISIBLE_DEVICES=4 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_corr --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --date GITGHUBTEST&
-CUDA_VISIBLE_DEVICES=5 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_cos_L1_norm --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --date GITGHUBTEST&
+CUDA_VISIBLE_DEVICES=1 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_cos --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.968750 --layer_begin 0  --layer_end 324 --layer_inter 3 --ranking_cache ./ckpt/rankings --date GITGHUBTEST&
+CUDA_VISIBLE_DEVICES=2 python  pruning_cifar10_orig.py --dist_type literally_cosine --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.968750 --layer_begin 0  --layer_end 324 --layer_inter 3 --ranking_cache ./ckpt/rankings --date GITGHUBTEST
+CUDA_VISIBLE_DEVICES=3 python  pruning_cifar10_orig.py --dist_type one_minus_abs_cos --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --ranking_cache ./ckpt/rankings --date GITGHUBTEST&
+CUDA_VISIBLE_DEVICES=4 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_corr --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --ranking_cache ./ckpt/rankings --date GITGHUBTEST&
+CUDA_VISIBLE_DEVICES=5 python  pruning_cifar10_orig.py --dist_type proposed_one_abs_cos_L1_norm --dataset cifar10 --arch resnet110 --use_pretrain --use_state_dict --epochs 200 --schedule 1 60 120 160 --gammas 10 0.2 0.2 0.2 --learning_rate 0.001 --decay 0.0005 --batch_size 128 --rate_norm 1 --rate_dist 0.900000 --layer_begin 0  --layer_end 324 --layer_inter 3 --ranking_cache ./ckpt/rankings --date GITGHUBTEST&
@@ -0,0 +1,436 @@
+"""Torch-native filter scoring for the criteria of ``Mask.get_filter_similar``, on the device of the
+weights: pairwise N x N matrices or the closed form from the Gram matrix, optionally tiled or sketched."""
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+DIST_TYPES = ['l2', 'l1', 'proposed_one_abs_cos', 'literally_cosine', 'L2_Norm', 'one_minus_abs_cos',
+              'proposed_one_abs_corr', 'proposed_one_abs_cos_L1_norm']
+
+SCORE_DTYPES = {'float32': torch.float32, 'float64': torch.float64}
+
+SCORE_MODES = ['pairwise', 'gram']
+
+_EPS = 1e-12
+
+# the Gram scorer recovers distances as n_i^2 + n_j^2 - 2 G_ij, which cancels for near-duplicate
+# filters, so it always runs in float64 whatever the requested score dtype
+_GRAM_DTYPE = torch.float64
+
+# dense scoring keeps about this many N x N temporaries alive at once
+_DENSE_TEMPORARIES = 3
+
+
+def _cosine_matrix(weight_vec, eps=_EPS):
+    # zero filters get a cosine of 0 instead of scipy's nan
+    unit = weight_vec / weight_vec.norm(2, -1, keepdim=True).clamp(min=eps)
+    return torch.matmul(unit, unit.transpose(-1, -2))
+
+
+def _pairwise_filter_scores(weight_vec, dist_type):
+    # column sums of the [..., N, N] criterion matrix, like np.sum(axis=0)
+
+    # FPGM
+    if dist_type == 'l2' or dist_type == 'l1':
+        similar_matrix = torch.cdist(weight_vec, weight_vec)
+        return similar_matrix.abs().sum(-2)
+
+    # WHC and its L1 norm version
+    elif dist_type == 'proposed_one_abs_cos' or dist_type == 'proposed_one_abs_cos_L1_norm':
+        p = 1 if dist_type == 'proposed_one_abs_cos_L1_norm' else 2
+        norm = weight_vec.norm(p, -1)
+        similar_matrix = 1 - _cosine_matrix(weight_vec).abs()
+        similar_matrix = norm.unsqueeze(-1) * similar_matrix * norm.unsqueeze(-2)  # the larger, the better
+        return similar_matrix.sum(-2)
+
+    # literally_cosine in the Decoupling experiment
+    elif dist_type == 'literally_cosine':
+        return _cosine_matrix(weight_vec).sum(-2)
+
+    # L2_Norm in the Decoupling experiment
+    elif dist_type == 'L2_Norm':
+        return weight_vec.norm(2, -1)
+
+    # DM in the Decoupling experiment
+    elif dist_type == 'one_minus_abs_cos':
+        return (1 - _cosine_matrix(weight_vec).abs()).sum(-2)
+
+    # the correlation version of WHC: centered cosine, uncentered L2 norm
+    elif dist_type == 'proposed_one_abs_corr':
+        norm = weight_vec.norm(2, -1)
+        centered = weight_vec - weight_vec.mean(-1, keepdim=True)
+        similar_matrix = 1 - _cosine_matrix(centered).abs()
+        similar_matrix = norm.unsqueeze(-1) * similar_matrix * norm.unsqueeze(-2)
+        return similar_matrix.sum(-2)
+
+    raise ValueError('Unknown dist_type : {}'.format(dist_type))
+
+
+def _filter_stats(weight_vec):
+    """Per-filter quantities the Gram-based criteria need, for [..., N, D] weights."""
+    norm = weight_vec.norm(2, -1)
+    mean = weight_vec.mean(-1)
+    centered_norm = (weight_vec - mean.unsqueeze(-1)).norm(2, -1)
+    return {'norm': norm, 'inv_norm': 1 / norm.clamp(min=_EPS), 'l1': weight_vec.norm(1, -1), 'mean': mean,
+            'centered_norm': centered_norm, 'inv_centered_norm': 1 / centered_norm.clamp(min=_EPS)}
+
+
+def _select_stats(stats, index):
+    return {key: value[..., index] for key, value in stats.items()}
+
+
+def _matvec(matrix, vec):
+    return torch.matmul(matrix, vec.unsqueeze(-1)).squeeze(-1)
+
+
+def _gram_row_sums(gram, rows, cols, dist_type, dim, diagonal=False):
+    """Row sums of the pairwise term of ``dist_type`` over a [..., R, C] Gram block of the ``rows`` and
+    ``cols`` filters; ``diagonal`` marks a block whose rows and columns are the same filters."""
+    if dist_type == 'l2' or dist_type == 'l1':
+        square = rows['norm'].unsqueeze(-1) ** 2 + cols['norm'].unsqueeze(-2) ** 2 - 2 * gram
+        if diagonal:
+            # the distance of a filter to itself is exactly 0, not a rounding residue
+            square.diagonal(dim1=-2, dim2=-1).zero_()
+        return square.clamp(min=0).sqrt().sum(-1)
+    elif dist_type == 'literally_cosine':
+        return _matvec(gram, cols['inv_norm'])
+    elif dist_type == 'one_minus_abs_cos':
+        return _matvec(gram.abs(), cols['inv_norm'])
+    elif dist_type == 'proposed_one_abs_cos':
+        return gram.abs().sum(-1)
+    elif dist_type == 'proposed_one_abs_cos_L1_norm':
+        return _matvec(gram.abs(), cols['l1'] * cols['inv_norm'])
+    elif dist_type == 'proposed_one_abs_corr':
+        # centered Gram: <w_i - m_i, w_j - m_j> = G_ij - D * m_i * m_j
+        centered = gram - dim * rows['mean'].unsqueeze(-1) * cols['mean'].unsqueeze(-2)
+        return _matvec(centered.abs(), cols['norm'] * cols['inv_centered_norm'])
+    raise ValueError('Unknown dist_type : {}'.format(dist_type))
+
+
+def _gram_combine(row_sums, rows, totals, dist_type):
+    """Turn ``_gram_row_sums`` over all columns into the final filter scores."""
+    if dist_type == 'l2' or dist_type == 'l1':
+        return row_sums
+    elif dist_type == 'literally_cosine':
+        return rows['inv_norm'] * row_sums
+    elif dist_type == 'one_minus_abs_cos':
+        return totals['count'] - rows['inv_norm'] * row_sums
+    elif dist_type == 'proposed_one_abs_cos':
+        return rows['norm'] * totals['norm'] - row_sums
+    elif dist_type == 'proposed_one_abs_cos_L1_norm':
+        return rows['l1'] * totals['l1'] - rows['l1'] * rows['inv_norm'] * row_sums
+    elif dist_type == 'proposed_one_abs_corr':
+        return rows['norm'] * totals['norm'] - rows['norm'] * rows['inv_centered_norm'] * row_sums
+    raise ValueError('Unknown dist_type : {}'.format(dist_type))
+
+
+def _totals(stats):
+    return {'norm': stats['norm'].sum(-1, keepdim=True), 'l1': stats['l1'].sum(-1, keepdim=True),
+            'count': stats['norm'].size(-1)}
+
+
+def _shared_row_sums(sources, stats, block_size=None):
+    """``_gram_row_sums`` of every criterion of ``sources`` ({dist_type: (filters, dim)}), sharing one
+    Gram matrix per filters, built tile by tile when ``block_size`` is given."""
+    groups = OrderedDict()
+    for dist_type, (filters, dim) in sources.items():
+        groups.setdefault(id(filters), (filters, []))[1].append((dist_type, dim))
+    row_sums = {}
+    for filters, criteria in groups.values():
+        if block_size is None:
+            gram = torch.matmul(filters, filters.transpose(-1, -2))
+            # G is symmetric, so every reduction runs along the contiguous last dim
+            for dist_type, dim in criteria:
+                row_sums[dist_type] = _gram_row_sums(gram, stats, stats, dist_type, dim, diagonal=True)
+            continue
+        for dist_type, dim in criteria:
+            row_sums[dist_type] = filters.new_zeros(filters.size(0))
+        starts = range(0, filters.size(0), block_size)
+        for i in starts:
+            row_block = slice(i, i + block_size)
+            rows = _select_stats(stats, row_block)
+            for j in starts[i // block_size:]:
+                col_block = slice(j, j + block_size)
+                cols = _select_stats(stats, col_block)
+                gram = torch.mm(filters[row_block], filters[col_block].t())
+                for dist_type, dim in criteria:
+                    row_sums[dist_type][row_block] += _gram_row_sums(gram, rows, cols, dist_type, dim,
+                                                                     diagonal=j == i)
+                    # the mirrored tile below the diagonal is the transpose of this one
+                    if j != i:
+                        row_sums[dist_type][col_block] += _gram_row_sums(gram.t(), cols, rows, dist_type, dim)
+    return row_sums
+
+
+def _dense_bytes(weight_vec, dtype):
+    filter_num = weight_vec.size(-2)
+    layer_num = weight_vec[..., 0, 0].numel()
+    element_size = torch.empty((), dtype=dtype).element_size()
+    return layer_num * filter_num * filter_num * element_size * _DENSE_TEMPORARIES
+
+
+def _block_size(max_bytes, dtype):
+    element_size = torch.empty((), dtype=dtype).element_size()
+    return max(1, int(math.sqrt(max_bytes / (element_size * _DENSE_TEMPORARIES))))
+
+
+def sketch_dim(filter_num, eps):
+    """Johnson-Lindenstrauss dimension k that keeps all pairwise distances of
+    ``filter_num`` filters within a factor (1 +- eps) with high probability."""
+    return int(math.ceil(4 * math.log(max(filter_num, 2)) / (eps ** 2 / 2 - eps ** 3 / 3)))
+
+
+def sketch_dim_if_faster(filter_num, filter_dim, eps, grams=1):
+    """``sketch_dim`` when projecting and scoring from ``grams`` sketched Gram matrices costs less than
+    the exact Gram (N * D * k + grams * N * N * k < N * N * D), else None."""
+    if not eps:
+        return None
+    dim = sketch_dim(filter_num, eps)
+    if dim * (filter_num * filter_dim + grams * filter_num * filter_num) >= filter_num * filter_num * filter_dim:
+        return None
+    return dim
+
+
+_projections = {}
+_projections_lock = threading.Lock()
+
+
+def _projection(filter_dim, dim, seed, dtype, device):
+    # drawn once per (D, k, seed) from a seeded CPU generator, so every run and every device projects
+    # with the same matrix, then kept on the device of the weights for the following calls
+    key = (filter_dim, dim, seed, dtype, str(device))
+    with _projections_lock:
+        if key not in _projections:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+            projection = torch.randn(filter_dim, dim, generator=generator, dtype=dtype)
+            _projections[key] = projection.to(device)
+        return _projections[key]
+
+
+def _rescale(sketch, norm):
+    # rescale each row to its exact norm: only the angles between filters are approximated,
+    # which keeps the diagonal of the sketched Gram consistent with the exact per-filter stats
+    return sketch * (norm.unsqueeze(-1) / sketch.norm(2, -1, keepdim=True).clamp(min=_EPS))
+
+
+def _sketches(weight_vec, stats, dim, seed, plain=True, centered=False):
+    """Sketches of the filters and of the centered filters, from a single projection of the filters."""
+    projection = _projection(weight_vec.size(-1), dim, seed, weight_vec.dtype, weight_vec.device)
+    sketch = torch.matmul(weight_vec, projection)
+    sketches = {}
+    if plain:
+        sketches['plain'] = _rescale(sketch, stats['norm'])
+    if centered:
+        # the projection is linear: (w - m) P = w P - m * (1^T P)
+        sketches['centered'] = _rescale(sketch - stats['mean'].unsqueeze(-1) * projection.sum(0),
+                                        stats['centered_norm'])
+    return sketches
+
+
+def _check_dist_types(dist_types):
+    for dist_type in dist_types:
+        if dist_type not in DIST_TYPES:
+            raise ValueError('Unknown dist_type : {}'.format(dist_type))
+
+
+def multi_filter_scores(weight_vec, dist_types=None, dtype=torch.float64, max_bytes=None, sketch_eps=None, seed=0):
+    """Gram-based scores of every criterion of ``dist_types`` (default: all of them), as {dist_type: scores},
+    sharing the norms and the Gram matrix; computed in float64 and returned in ``dtype``."""
+    dist_types = DIST_TYPES if dist_types is None else list(dist_types)
+    _check_dist_types(dist_types)
+    weight_vec = weight_vec.to(_GRAM_DTYPE)
+    block_size = None
+    if max_bytes is not None and _dense_bytes(weight_vec, _GRAM_DTYPE) > max_bytes:
+        if weight_vec.dim() > 2:
+            layers = [multi_filter_scores(layer, dist_types, dtype, max_bytes, sketch_eps, seed) for layer in weight_vec]
+            return {dist_type: torch.stack([layer[dist_type] for layer in layers]) for dist_type in dist_types}
+        block_size = _block_size(max_bytes, _GRAM_DTYPE)
+    stats = _filter_stats(weight_vec)
+    dim = weight_vec.size(-1)
+    plain = any(dist_type not in ('L2_Norm', 'proposed_one_abs_corr') for dist_type in dist_types)
+    centered = 'proposed_one_abs_corr' in dist_types
+    sketched_dim = sketch_dim_if_faster(weight_vec.size(-2), dim, sketch_eps, grams=int(plain) + int(centered))
+    if sketched_dim is not None:
+        # the centered filters get their own sketch, whose Gram then needs no further centering
+        sketches = _sketches(weight_vec, stats, sketched_dim, seed, plain, centered)
+        sources = {dist_type: (sketches['centered'], 0) if dist_type == 'proposed_one_abs_corr' else
+                   (sketches['plain'], dim) for dist_type in dist_types if dist_type != 'L2_Norm'}
+    else:
+        sources = {dist_type: (weight_vec, dim) for dist_type in dist_types if dist_type != 'L2_Norm'}
+    row_sums = _shared_row_sums(sources, stats, block_size)
+    totals = _totals(stats)
+    return {dist_type: (stats['norm'] if dist_type == 'L2_Norm' else
+                        _gram_combine(row_sums[dist_type], stats, totals, dist_type)).to(dtype)
+            for dist_type in dist_types}
+
+
+def filter_scores(weight_vec, dist_type='l2', dtype=torch.float64, mode='pairwise', max_bytes=None,
+                  sketch_eps=None, seed=0):
+    """Score every filter of ``weight_vec`` ([N, D], or [L, N, D] for L layers) with ``dist_type``, tiled
+    above ``max_bytes`` and from a random projection of the filters with ``sketch_eps``."""
+    _check_dist_types([dist_type])
+    if mode not in SCORE_MODES:
+        raise ValueError('Unknown score mode : {}'.format(mode))
+    sketched = sketch_dim_if_faster(weight_vec.size(-2), weight_vec.size(-1), sketch_eps) is not None
+    tiled = max_bytes is not None and _dense_bytes(weight_vec, dtype) > max_bytes
+    if mode == 'pairwise' and not sketched and not tiled:
+        return _pairwise_filter_scores(weight_vec.to(dtype), dist_type)
+    return multi_filter_scores(weight_vec, [dist_type], dtype, max_bytes, sketch_eps, seed)[dist_type]
+
+
+def rank_filters(weight_vec, pruned_num, dist_type='l2', dtype=torch.float64, mode='pairwise', max_bytes=None,
+                 sketch_eps=None):
+    """Return (kept, pruned) filter indices as LongTensors on the weight device."""
+    order = filter_scores(weight_vec, dist_type, dtype, mode, max_bytes, sketch_eps).argsort()
+    return order[pruned_num:], order[:pruned_num]
+
+
+def pruned_mismatch(weight_vec, pruned, dist_type='l2', dtype=torch.float64, mode='pairwise', max_bytes=None,
+                    candidates=None):
+    """Number of the ``pruned`` filter indices that the exact ranking of ``weight_vec`` would have kept."""
+    pruned = [int(i) for i in pruned]
+    exact = filter_scores(weight_vec, dist_type, dtype, mode, max_bytes).argsort()[:len(pruned)]
+    if candidates is not None:
+        exact = candidates[exact]
+    return len(set(pruned) - set(exact.tolist()))
+
+
+def map_layers(fn, items, workers=1):
+    """``list(map(fn, items))``, spread over ``workers`` threads when workers > 1."""
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, items))
+
+
+def _batch_map(weights, score, dtype, max_bytes, workers):
+    # stacks of same-shaped layers, at most as many per call as fit under max_bytes
+    groups = OrderedDict()
+    for key, weight in weights.items():
+        groups.setdefault((tuple(weight.size()), weight.device), []).append(key)
+    chunks = []
+    for keys in groups.values():
+        chunk = len(keys)
+        if max_bytes is not None:
+            layer_vec = weights[keys[0]].reshape(weights[keys[0]].size(0), -1)
+            # every worker holds its own temporaries
+            chunk = max(1, int(max_bytes // (_dense_bytes(layer_vec, dtype) * max(1, workers))))
+        chunks.extend(keys[start:start + chunk] for start in range(0, len(keys), chunk))
+
+    def score_chunk(chunk_keys):
+        return score(torch.stack([weights[key].reshape(weights[key].size(0), -1) for key in chunk_keys]))
+
+    return zip(chunks, map_layers(score_chunk, chunks, workers))
+
+
+def batch_filter_scores(weights, dist_type='l2', dtype=torch.float64, mode='pairwise', max_bytes=None,
+                        sketch_eps=None, workers=1):
+    """Score {key: weight} layers at once, stacking same-shaped layers into batched calls on ``workers``
+    threads; returns {key: [N] scores}."""
+    scores = {}
+    for chunk_keys, chunk_scores in _batch_map(
+            weights, lambda stack: filter_scores(stack, dist_type, dtype, mode, max_bytes, sketch_eps),
+            dtype, max_bytes, workers):
+        for key, score in zip(chunk_keys, chunk_scores):
+            scores[key] = score
+    return scores
+
+
+def batch_multi_filter_scores(weights, dist_types=None, dtype=torch.float64, max_bytes=None, sketch_eps=None,
+                              workers=1):
+    """``multi_filter_scores`` of many layers, batched like ``batch_filter_scores``."""
+    dist_types = DIST_TYPES if dist_types is None else list(dist_types)
+    scores = {dist_type: {} for dist_type in dist_types}
+    for chunk_keys, chunk_scores in _batch_map(
+            weights, lambda stack: multi_filter_scores(stack, dist_types, dtype, max_bytes, sketch_eps),
+            dtype, max_bytes, workers):
+        for dist_type in dist_types:
+            for key, score in zip(chunk_keys, chunk_scores[dist_type]):
+                scores[dist_type][key] = score
+    return scores
+
+
+def checkpoint_id(path):
+    """(absolute path, mtime, size) of a checkpoint file; any rewrite of the file changes it."""
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def weights_fingerprint(weights):
+    """Sum, sum of squares and position-weighted sum of every weight, reduced on its
+    device and copied to the host in one small transfer."""
+    rows = []
+    for weight in weights:
+        flat = weight.detach().reshape(-1).to(torch.float64)
+        position = torch.arange(1, flat.numel() + 1, dtype=flat.dtype, device=flat.device)
+        rows.append(torch.stack([flat.sum(), flat.dot(flat), flat.dot(position)]).to(weights[0].device))
+    return tuple(torch.stack(rows).cpu().view(-1).tolist())
+
+
+def ranking_key(source, weights, *config):
+    """Hash of the ``checkpoint_id`` the weights were loaded from (else their ``weights_fingerprint``)
+    and everything else a ranking depends on."""
+    if source is None:
+        source = weights_fingerprint(weights)
+    return hashlib.sha1(repr((source,) + config).encode('utf-8')).hexdigest()
+
+
+def _ranking_path(cache_dir, key, dist_type):
+    return os.path.join(cache_dir, 'rankings_{}_{}.pth'.format(key, dist_type))
+
+
+def load_rankings(cache_dir, key):
+    """Rankings saved under ``key`` as {dist_type: {param index: LongTensor}}, or None."""
+    rankings = {}
+    for dist_type in DIST_TYPES:
+        path = _ranking_path(cache_dir, key, dist_type)
+        if os.path.isfile(path):
+            rankings[dist_type] = torch.load(path, map_location='cpu')
+    return rankings or None
+
+
+def save_rankings(cache_dir, key, rankings):
+    """Save {dist_type: {param index: ranking}} under ``key``, one file per criterion."""
+    os.makedirs(cache_dir, exist_ok=True)
+    for dist_type, ranking in rankings.items():
+        path = _ranking_path(cache_dir, key, dist_type)
+        # write then rename, so concurrent runs of a rate sweep never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save({index: layer_ranking.cpu() for index, layer_ranking in ranking.items()}, tmp_path)
+        os.replace(tmp_path, path)
+    return cache_dir
+
+
+def scipy_filter_scores(weight_np, dist_type='l2'):
+    """Reference scipy implementation the torch engine replaces; kept for parity checks."""
+    import numpy as np
+    from scipy.spatial import distance
+
+    if dist_type == 'l2' or dist_type == 'l1':
+        similar_matrix = distance.cdist(weight_np, weight_np, 'euclidean')
+        return np.sum(np.abs(similar_matrix), axis=0)
+    elif dist_type == 'L2_Norm':
+        return np.linalg.norm(weight_np, 2, 1)
+    elif dist_type == 'literally_cosine':
+        return np.sum(1 - distance.cdist(weight_np, weight_np, 'cosine'), axis=0)
+    elif dist_type == 'one_minus_abs_cos':
+        return np.sum(1 - np.abs(1 - distance.cdist(weight_np, weight_np, 'cosine')), axis=0)
+
+    if dist_type == 'proposed_one_abs_cos':
+        norm_diag, metric = np.diag(np.linalg.norm(weight_np, 2, 1)), 'cosine'
+    elif dist_type == 'proposed_one_abs_corr':
+        norm_diag, metric = np.diag(np.linalg.norm(weight_np, 2, 1)), 'correlation'
+    elif dist_type == 'proposed_one_abs_cos_L1_norm':
+        norm_diag, metric = np.diag(np.linalg.norm(weight_np, 1, 1)), 'cosine'
+    else:
+        raise ValueError('Unknown dist_type : {}'.format(dist_type))
+    similar_matrix = 1 - np.abs(1 - distance.cdist(weight_np, weight_np, metric))
+    similar_matrix = np.matmul(norm_diag, np.matmul(similar_matrix, norm_diag))
+    return np.sum(similar_matrix, axis=0)